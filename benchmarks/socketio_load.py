@@ -0,0 +1,518 @@
+"""
+Load test of the Socket.IO server of a single worker.
+
+Starts the app with uvicorn against a stub JWKS endpoint, connects simulated clients
+as freshly seeded users, runs the scenarios, and prints a JSON report:
+
+    python -m benchmarks.socketio_load --connections 500 --output report.json
+
+MongoDB and Redis are the ones configured for the app (see `infrastructure/`), the
+users are seeded into a throwaway database that is dropped afterwards.
+
+Scenarios:
+    connect      connection and authentication of every client
+    events_seen  clients emit `relationship:events_seen` and wait for the acknowledgement
+    fanout       one event per user emitted through `SocketIOManager.emit_many`
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import math
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from typing import TYPE_CHECKING
+from typing import Any
+
+import aiohttp
+import jwt
+import orjson
+import socketio
+
+from aiohttp import web
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable
+    from collections.abc import Callable
+    from collections.abc import Iterator
+
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+
+SCENARIOS = ("connect", "events_seen", "fanout")
+FANOUT_EVENT_NAME = "benchmark:fanout"
+
+_AUTH0_DOMAIN = "benchmark.invalid"
+_AUTH0_AUDIENCE = "https://benchmark.invalid/api"
+_KEY_ID = "benchmark"
+_REPOSITORY_ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+
+@dataclasses.dataclass(slots=True)
+class ScenarioResult:
+    count: int = 0
+    errors: int = 0
+    duration: float = 0.0
+    latencies: list[float] = dataclasses.field(default_factory=list)
+
+    def to_report(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "duration_s": round(self.duration, 3),
+            "throughput_per_s": (
+                round(self.count / self.duration, 1) if self.duration else None
+            ),
+            "latency_ms": {
+                "p50": _percentile(latencies, 50),
+                "p99": _percentile(latencies, 99),
+                "max": _percentile(latencies, 100),
+                "mean": (
+                    round(sum(latencies) / len(latencies) * 1000, 3)
+                    if latencies
+                    else None
+                ),
+            },
+        }
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float | None:
+    """Nearest-rank percentile in milliseconds."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(percentile / 100 * len(sorted_values)), 1)
+    return round(sorted_values[rank - 1] * 1000, 3)
+
+
+class JWKSStub:
+    """Serves the public key of a freshly generated RSA key and signs tokens with it."""
+
+    def __init__(self):
+        self._private_key: RSAPrivateKey = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    async def start(self) -> None:
+        jwk = orjson.loads(RSAAlgorithm.to_jwk(self._private_key.public_key()))
+        jwks = {"keys": [{**jwk, "kid": _KEY_ID, "use": "sig", "alg": "RS256"}]}
+
+        async def get_jwks(_: web.Request) -> web.Response:
+            return web.json_response(jwks)
+
+        app = web.Application()
+        app.router.add_get("/.well-known/jwks.json", get_jwks)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/.well-known/jwks.json"
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def issue_token(self, subject: str, email: str) -> str:
+        now = int(time.time())
+        return jwt.encode(
+            {
+                "sub": subject,
+                "email": email,
+                "iss": f"https://{_AUTH0_DOMAIN}/",
+                "aud": _AUTH0_AUDIENCE,
+                "iat": now,
+                "exp": now + 60 * 60,
+            },
+            self._private_key,
+            algorithm="RS256",
+            headers={"kid": _KEY_ID},
+        )
+
+
+@dataclasses.dataclass(slots=True)
+class SimulatedUser:
+    email: str
+    token: str
+    client: socketio.AsyncClient | None = None
+
+
+class FanoutTracker:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.expected = 0
+        self.done = asyncio.Event()
+
+    def record(self, data: dict[str, Any]) -> None:
+        self.latencies.append(time.time() - data["sent_at"])
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+def _build_server_env(args: argparse.Namespace, jwks_url: str) -> dict[str, str]:
+    env = {
+        **os.environ,
+        "AUTH0_DOMAIN": _AUTH0_DOMAIN,
+        "AUTH0_AUDIENCE": _AUTH0_AUDIENCE,
+        "JWKS_URL": jwks_url,
+        "DATABASE_NAME": args.database_name,
+        "DEBUG": "False",
+        "LOGGING_LEVEL": "WARNING",
+    }
+    if not args.keep_rate_limits:
+        # The limits are per user, they would cap the measured throughput
+        env["RATE_LIMIT_SOCKETIO_DEFAULT"] = "null"
+    return env
+
+
+@contextlib.contextmanager
+def _run_server(
+    args: argparse.Namespace, env: dict[str, str]
+) -> Iterator[subprocess.Popen[bytes]]:
+    with open(args.server_log, "wb") as log_file:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "src.main:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(args.port),
+                "--log-level",
+                "warning",
+            ],
+            env=env,
+            cwd=_REPOSITORY_ROOT,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        try:
+            yield process
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def _wait_until_ready(url: str, process: subprocess.Popen[bytes]) -> None:
+    async with aiohttp.ClientSession() as session:
+        for _ in range(300):
+            if process.poll() is not None:
+                raise RuntimeError("The server exited, see the server log")
+            with contextlib.suppress(aiohttp.ClientError):
+                async with session.get(f"{url}/openapi.json"):
+                    return
+            await asyncio.sleep(0.1)
+    raise RuntimeError("The server didn't start in 30 seconds")
+
+
+def _read_rss(pid: int) -> int | None:
+    """Resident memory of the process in bytes, only available on Linux."""
+    try:
+        status = pathlib.Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+async def _seed_users(
+    count: int, jwks_stub: JWKSStub, run_id: str
+) -> list[SimulatedUser]:
+    from src.db.models import Account
+    from src.db.models import User
+
+    users = [
+        User(
+            username=f"benchmark_{run_id}_{index}",
+            email=f"benchmark-{run_id}-{index}@example.com",
+            emailVerified=None,
+        )
+        for index in range(count)
+    ]
+    result = await User.insert_many(users)
+    for user, user_id in zip(users, result.inserted_ids, strict=True):
+        user.id = user_id
+
+    await Account.insert_many(
+        [
+            Account(
+                user_id=user.id,
+                user=user,
+                provider_name="benchmark",
+                provider_account_id=f"benchmark|{user.id}",
+            )
+            for user in users
+        ]
+    )
+    return [
+        SimulatedUser(
+            email=user.email,
+            token=jwks_stub.issue_token(f"benchmark|{user.id}", user.email),
+        )
+        for user in users
+    ]
+
+
+async def _gather_bounded(
+    coroutines: list[Awaitable[Any]], concurrency: int
+) -> list[Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine: Awaitable[Any]) -> Any:
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(
+        *(run(coroutine) for coroutine in coroutines), return_exceptions=True
+    )
+
+
+async def _run_connect(
+    users: list[SimulatedUser],
+    url: str,
+    concurrency: int,
+    on_fanout: Callable[[dict[str, Any]], None],
+) -> ScenarioResult:
+    result = ScenarioResult()
+
+    async def connect(user: SimulatedUser) -> None:
+        client = socketio.AsyncClient(reconnection=False)
+        client.on(FANOUT_EVENT_NAME, on_fanout)
+
+        @client.on("batch")
+        def on_batch(events: list[dict[str, Any]]) -> None:
+            for event in events:
+                if event["event"] == FANOUT_EVENT_NAME:
+                    on_fanout(event["data"])
+
+        started_at = time.perf_counter()
+        await client.connect(
+            url,
+            socketio_path="/ws/socket.io",
+            transports=["websocket"],
+            headers={"Authorization": f"Bearer {user.token}"},
+            wait_timeout=30,
+        )
+        result.latencies.append(time.perf_counter() - started_at)
+        user.client = client
+
+    started_at = time.perf_counter()
+    outcomes = await _gather_bounded([connect(user) for user in users], concurrency)
+    result.duration = time.perf_counter() - started_at
+    result.errors = sum(isinstance(outcome, BaseException) for outcome in outcomes)
+    result.count = len(users) - result.errors
+    return result
+
+
+async def _run_events_seen(
+    users: list[SimulatedUser], events_per_connection: int
+) -> ScenarioResult:
+    result = ScenarioResult()
+
+    async def emit(client: socketio.AsyncClient) -> None:
+        for _ in range(events_per_connection):
+            started_at = time.perf_counter()
+            try:
+                response = await client.call(
+                    "relationship:events_seen", {"type": 1}, timeout=30
+                )
+            except socketio.exceptions.TimeoutError:
+                result.errors += 1
+                continue
+
+            if isinstance(response, dict) and "error" in response:
+                result.errors += 1
+            else:
+                result.latencies.append(time.perf_counter() - started_at)
+                result.count += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(emit(user.client) for user in users if user.client))
+    result.duration = time.perf_counter() - started_at
+    return result
+
+
+async def _run_fanout(
+    users: list[SimulatedUser], rounds: int, tracker: FanoutTracker
+) -> ScenarioResult:
+    from redis.asyncio import Redis
+
+    from src.config import app_config
+    from src.utils.socketio.presence import PresenceRegistry
+    from src.utils.socketio.socket_manager import Emission
+    from src.utils.socketio.socket_manager import SocketIOManager
+
+    redis = Redis.from_url(str(app_config.redis_dsn))
+    manager = SocketIOManager(
+        socketio.AsyncRedisManager(str(app_config.redis_dsn), write_only=True),
+        PresenceRegistry(
+            redis,
+            ttl=app_config.presence_ttl,
+            heartbeat_interval=app_config.presence_heartbeat_interval,
+        ),
+    )
+    connected_users = [user for user in users if user.client]
+    tracker.expected = len(connected_users) * rounds
+
+    result = ScenarioResult()
+    started_at = time.perf_counter()
+    try:
+        for _ in range(rounds):
+            await manager.emit_many(
+                [
+                    Emission(
+                        email=user.email,
+                        event_name=FANOUT_EVENT_NAME,
+                        payload={"sent_at": time.time()},
+                    )
+                    for user in connected_users
+                ]
+            )
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(tracker.done.wait(), timeout=30)
+    finally:
+        await redis.close()
+
+    result.duration = time.perf_counter() - started_at
+    result.latencies = tracker.latencies
+    result.count = len(tracker.latencies)
+    result.errors = tracker.expected - result.count
+    return result
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    jwks_stub = JWKSStub()
+    await jwks_stub.start()
+    env = _build_server_env(args, jwks_stub.url)
+    # The app settings are read on import, so they must see the same environment
+    os.environ.update(env)
+
+    from beanie import init_beanie
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from src.config import app_config
+    from src.db.models import gather_documents
+
+    mongodb_client = AsyncIOMotorClient(app_config.db_url)
+    await init_beanie(
+        database=mongodb_client[args.database_name],
+        document_models=gather_documents(),
+    )
+
+    report: dict[str, Any] = {
+        "config": {
+            "connections": args.connections,
+            "scenarios": args.scenarios,
+            "events_per_connection": args.events_per_connection,
+            "fanout_rounds": args.fanout_rounds,
+            "connect_concurrency": args.connect_concurrency,
+            "server_log": str(args.server_log),
+        },
+        "scenarios": {},
+    }
+    tracker = FanoutTracker()
+    users: list[SimulatedUser] = []
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        users = await _seed_users(args.connections, jwks_stub, uuid.uuid4().hex[:8])
+        with _run_server(args, env) as process:
+            await _wait_until_ready(url, process)
+            rss_before = _read_rss(process.pid)
+
+            connect_result = await _run_connect(
+                users, url, args.connect_concurrency, tracker.record
+            )
+            rss_after = _read_rss(process.pid)
+            if "connect" in args.scenarios:
+                report["scenarios"]["connect"] = connect_result.to_report()
+            report["server"] = {
+                "rss_before_bytes": rss_before,
+                "rss_after_bytes": rss_after,
+                "memory_per_connection_bytes": (
+                    round((rss_after - rss_before) / connect_result.count)
+                    if rss_before and rss_after and connect_result.count
+                    else None
+                ),
+            }
+
+            if "events_seen" in args.scenarios:
+                report["scenarios"]["events_seen"] = (
+                    await _run_events_seen(users, args.events_per_connection)
+                ).to_report()
+            if "fanout" in args.scenarios:
+                report["scenarios"]["fanout"] = (
+                    await _run_fanout(users, args.fanout_rounds, tracker)
+                ).to_report()
+
+            await asyncio.gather(
+                *(user.client.disconnect() for user in users if user.client),
+                return_exceptions=True,
+            )
+    finally:
+        await mongodb_client.drop_database(args.database_name)
+        await jwks_stub.close()
+
+    return report
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--events-per-connection", type=int, default=10)
+    parser.add_argument("--fanout-rounds", type=int, default=10)
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument(
+        "--database-name", default=f"nightingale-benchmark-{uuid.uuid4().hex[:8]}"
+    )
+    parser.add_argument(
+        "--keep-rate-limits",
+        action="store_true",
+        help="Don't disable the rate limits of Socket.IO events",
+    )
+    parser.add_argument(
+        "--server-log",
+        type=pathlib.Path,
+        default=pathlib.Path(tempfile.gettempdir())
+        / "nightingale-benchmark-server.log",
+    )
+    parser.add_argument(
+        "--output", type=pathlib.Path, help="Write the report here instead of stdout"
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = _parse_args()
+    report = orjson.dumps(asyncio.run(run(args)), option=orjson.OPT_INDENT_2)
+    if args.output is None:
+        sys.stdout.buffer.write(report + b"\n")
+    else:
+        args.output.write_bytes(report)
+
+
+if __name__ == "__main__":
+    main()
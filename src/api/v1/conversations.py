@@ -10,13 +10,13 @@ from fastapi import Query
 from pydantic import PositiveInt
 from starlette.status import HTTP_404_NOT_FOUND
 
+from src.db.models import User
 from src.schemas.conversations import ConversationPreviewSchema
 from src.schemas.conversations import ConversationPreviewSchemaCursorPayload
 from src.schemas.conversations import CreateConversationSchema
 from src.schemas.pagination import PaginatedResponse
 from src.services.conversation_service import ConversationService
-from src.utils.auth import UserCredentials
-from src.utils.auth import get_current_user_credentials
+from src.utils.auth import get_current_user
 from src.utils.auth import validate_jwt_token
 from src.utils.pagination import pagination
 from src.utils.stub import DependencyStub
@@ -38,7 +38,7 @@ async def get_conversation_previews(
     conversation_service: Annotated[
         ConversationService, Depends(DependencyStub("conversation_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
     limit: Annotated[PositiveInt, Query(le=50, ge=10)] = 10,
     next_cursor_payload: Annotated[
         ConversationPreviewSchemaCursorPayload | None,
@@ -50,7 +50,7 @@ async def get_conversation_previews(
     ] = None,
 ):
     paginated_result = await conversation_service.get_conversation_previews(
-        user_credentials.email, limit=limit, cursor_payload=next_cursor_payload
+        current_user.email, limit=limit, cursor_payload=next_cursor_payload
     )
 
     return PaginatedResponse[ConversationPreviewSchema].from_paginated_result(
@@ -79,10 +79,10 @@ async def get_conversation_preview_by_id(
     conversation_service: Annotated[
         ConversationService, Depends(DependencyStub("conversation_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
 ):
     conversation_preview = await conversation_service.get_conversation_preview_by_id(
-        conversation_id, user_credentials.email
+        conversation_id, current_user.email
     )
     if conversation_preview is None:
         raise HTTPException(
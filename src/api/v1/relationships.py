@@ -10,6 +10,7 @@ from starlette.responses import Response
 from starlette.status import HTTP_200_OK
 from starlette.status import HTTP_201_CREATED
 
+from src.db.models import User
 from src.db.models.relationship import RelationshipType
 from src.schemas.relationship import BlockUserSchema
 from src.schemas.relationship import DeleteFriendPayload
@@ -17,8 +18,7 @@ from src.schemas.relationship import FriendRequestPayload
 from src.schemas.relationship import RelationshipListItemSchema
 from src.schemas.relationship import UpdateRelationshipStatusPayload
 from src.services.relationship_service import RelationshipService
-from src.utils.auth import UserCredentials
-from src.utils.auth import get_current_user_credentials
+from src.utils.auth import get_current_user
 from src.utils.auth import validate_jwt_token
 from src.utils.depends import int_enum_query
 from src.utils.stub import DependencyStub
@@ -38,7 +38,7 @@ async def get_relationships(
     relationship_service: Annotated[
         RelationshipService, Depends(DependencyStub("relationship_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
     relationship_type: Annotated[
         RelationshipType,
         Depends(
@@ -49,7 +49,7 @@ async def get_relationships(
 ):
     return await relationship_service.get_relationships(
         relationship_type=relationship_type,
-        email=user_credentials.email,
+        email=current_user.email,
         limit=limit,
     )
 
@@ -61,10 +61,10 @@ async def send_friend_request(
     relationship_service: Annotated[
         RelationshipService, Depends(DependencyStub("relationship_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
 ):
     await relationship_service.create_friend_request(
-        username=friend_request_payload.username, initiator_email=user_credentials.email
+        username=friend_request_payload.username, initiator_email=current_user.email
     )
 
     response.status_code = HTTP_201_CREATED
@@ -89,10 +89,10 @@ async def block_user(
     relationship_service: Annotated[
         RelationshipService, Depends(DependencyStub("relationship_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
 ):
     await relationship_service.block_user(
-        initiator_user_id=user_credentials.email,
+        initiator_user_id=current_user.id,
         partner_user_id=block_user_payload.user_id,
     )
 
@@ -103,9 +103,9 @@ async def delete_a_friend(
     relationship_service: Annotated[
         RelationshipService, Depends(DependencyStub("relationship_service"))
     ],
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    current_user: Annotated[User, Depends(get_current_user)],
 ):
     await relationship_service.delete_friend(
         relationship_id=delete_friend_payload.relationship_id,
-        user_email=user_credentials.email,
+        user_email=current_user.email,
     )
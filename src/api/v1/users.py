@@ -9,20 +9,28 @@ from fastapi import Depends
 from fastapi import File
 from fastapi import Form
 from fastapi import HTTPException
+from fastapi import Query
 from fastapi import Response
 from fastapi import UploadFile
 from starlette.status import HTTP_204_NO_CONTENT
 from starlette.status import HTTP_404_NOT_FOUND
 
+from src.db.models import User
 from src.schemas.user import AccountScheme
+from src.schemas.user import AvatarUploadCompleteSchema
+from src.schemas.user import AvatarUploadInputSchema
+from src.schemas.user import AvatarUploadSchema
 from src.schemas.user import CheckUsernameAvailabilitySchema
 from src.schemas.user import ExistsResponseSchema
+from src.schemas.user import UserAccountLinkSchema
+from src.schemas.user import UserBatchInputSchema
 from src.schemas.user import UserInputSchema
 from src.schemas.user import UserOutputSchema
+from src.schemas.user import UserPublicSchema
+from src.schemas.user import UserSearchResultSchema
 from src.schemas.user import UserUpdateSchema
 from src.services.user_service import UserService
-from src.utils.auth import UserCredentials
-from src.utils.auth import get_current_user_credentials
+from src.utils.auth import get_current_user
 from src.utils.auth import validate_jwt_token
 from src.utils.pydantic_utils import Username
 from src.utils.stub import DependencyStub
@@ -58,6 +66,37 @@ async def check_if_username_is_available(
     }
 
 
+@router.get(
+    "/search",
+    response_model_by_alias=False,
+    response_model=list[UserSearchResultSchema],
+    summary="Search users by username prefix",
+)
+async def search_users(
+    q: Annotated[str, Query(min_length=1, max_length=32, pattern=r"^[a-zA-Z0-9_]+$")],
+    current_user: Annotated[User, Depends(get_current_user)],
+    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+    limit: Annotated[int, Query(ge=1, le=20)] = 10,
+):
+    return await user_service.search_users_by_username_prefix(
+        q, requester_id=current_user.id, limit=limit
+    )
+
+
+@router.post(
+    "/batch",
+    response_model_by_alias=False,
+    summary="Get users by ids",
+    response_description="Public fields of the users in the order of the requested ids, "
+    "null for missing ones",
+)
+async def get_users_batch(
+    payload: UserBatchInputSchema,
+    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+) -> list[UserPublicSchema | None]:
+    return await user_service.get_users_by_ids(payload.ids)
+
+
 @router.post(
     "/{user_id}",
     status_code=HTTP_204_NO_CONTENT,
@@ -68,7 +107,7 @@ async def check_if_username_is_available(
 async def update_user(
     user_id: PydanticObjectId,
     user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
-    bio: Annotated[str, Form()] = None,
+    bio: Annotated[str | None, Form()] = None,
     image: Annotated[UploadFile, File()] = None,
     username: Username = Form(None),
 ):
@@ -78,6 +117,34 @@ async def update_user(
     )
 
 
+@router.post(
+    "/me/avatar/upload",
+    summary="Start an avatar upload",
+    description="Get a pre-signed form to upload the avatar straight to S3, "
+    "the upload has to be completed afterwards",
+)
+async def create_avatar_upload(
+    payload: AvatarUploadInputSchema,
+    user: Annotated[User, Depends(get_current_user)],
+    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+) -> AvatarUploadSchema:
+    return await user_service.create_avatar_upload(user.id, payload.content_type)
+
+
+@router.post(
+    "/me/avatar/complete",
+    summary="Complete an avatar upload",
+    description="Validate the uploaded avatar and set it as the image of the user",
+)
+async def complete_avatar_upload(
+    payload: AvatarUploadCompleteSchema,
+    user: Annotated[User, Depends(get_current_user)],
+    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+) -> UserOutputSchema:
+    updated_user = await user_service.complete_avatar_upload(user.id, payload.key)
+    return UserOutputSchema.model_validate(updated_user)
+
+
 @router.get(
     "/",
     status_code=200,
@@ -102,15 +169,26 @@ async def get_user_by_filters(
 
 
 @router.get("/me", status_code=200, summary="Get current user")
-async def get_current_user(
-    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
-    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+async def get_me(
+    user: Annotated[User, Depends(get_current_user)],
 ) -> UserOutputSchema:
-    user = await user_service.get_user_by_email(user_credentials.email)
+    return UserOutputSchema.model_validate(user)
 
-    if user is None:
-        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="User not found")
 
+@router.post(
+    "/account/upsert",
+    summary="Get or create the user signing in with an account",
+    description="Get the user linked to the account. If there is none, link the account "
+    "to the user with the same email if the provider has verified it, creating the user "
+    "if needed",
+)
+async def upsert_user_and_link_account(
+    payload: UserAccountLinkSchema,
+    user_service: Annotated[UserService, Depends(DependencyStub("user_service"))],
+) -> UserOutputSchema:
+    user = await user_service.upsert_user_and_link_account(
+        payload.user, payload.account
+    )
     return UserOutputSchema.model_validate(user)
 
 
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-from typing import Literal
 from typing import NoReturn
 
 import socketio.exceptions
@@ -8,20 +7,32 @@ import structlog
 
 from fastapi import HTTPException
 from pydantic import ValidationError
+from redis.asyncio import Redis
 from starlette.requests import Request
 
 from src.config import app_config
-from src.db.models import User
 from src.schemas.websockets.relationships import RelationshipEventsSeenPayload
 from src.services.relationship_stats_service import RelationshipStatsService
-from src.services.user_service import UserService
+from src.services.user_loader import UserLoader
+from src.services.user_profile_cache import UserProfileCache
 from src.utils.auth import TokenInvalidError
 from src.utils.auth import get_current_user_credentials
 from src.utils.auth import get_token_payload
 from src.utils.auth import token_auth_scheme
+from src.utils.rate_limit import RateLimiter
+from src.utils.socketio.common import rate_limit
 from src.utils.socketio.common import validate_data
 from src.utils.socketio.common import with_request
+from src.utils.socketio.dispatcher import OverflowPolicy
+from src.utils.socketio.inbox import INBOX_REPLAY_EVENT_NAME
+from src.utils.socketio.inbox import EventInbox
+from src.utils.socketio.inbox import is_valid_event_id
+from src.utils.socketio.presence import PresenceRegistry
+from src.utils.socketio.presence import get_user_room
+from src.utils.socketio.serializer import OrjsonModule
+from src.utils.socketio.serializer import get_packet_class
 from src.utils.socketio.server import AsyncSocketIOServer
+from src.utils.socketio.session import SocketSession
 
 
 client_manager = socketio.AsyncRedisManager(str(app_config.redis_dsn))
@@ -32,12 +43,16 @@ socketio_server = AsyncSocketIOServer(
     logger=True,
     engineio_logger=True,
     client_manager=client_manager,
+    json=OrjsonModule,
+    serializer=get_packet_class(app_config.socketio_serializer),
+    handler_concurrency_per_connection=app_config.socketio_handler_concurrency_per_connection,
+    handler_queue_depth=app_config.socketio_handler_queue_depth,
+    handler_concurrency=app_config.socketio_handler_concurrency,
+    handler_overflow_policy=OverflowPolicy(app_config.socketio_handler_overflow_policy),
 )
 asgi_app = socketio.ASGIApp(socketio_server)
 logger = structlog.get_logger(__name__)
 
-SessionType = dict[Literal["user"], User]
-
 
 @socketio_server.event
 @with_request
@@ -51,16 +66,24 @@ async def connect(request: Request, sid: str) -> bool | NoReturn:
         raise socketio.exceptions.ConnectionRefusedError(ex.detail) from ex
 
     try:
-        user_credentials = get_current_user_credentials(
-            token_payload=await get_token_payload(authorization_header_data.credentials)
+        redis = socketio_server.services.get(Redis)
+        user_credentials = await get_current_user_credentials(
+            token_payload=await get_token_payload(
+                authorization_header_data.credentials, redis
+            ),
+            redis=redis,
         )
     except (ValidationError, TokenInvalidError) as ex:
         logger.error("The access token is invalid", extra={"sid": sid})
         detail = ex.json() if isinstance(ex, ValidationError) else ex.reason
         raise socketio.exceptions.ConnectionRefusedError(detail) from ex
 
-    user_service = socketio_server.services.get(UserService)
-    user = await user_service.get_user_by_email(user_credentials.email)
+    # `user_id` is resolved from the token subject, it's None for unknown users
+    user = None
+    if user_credentials.user_id is not None:
+        user_loader = UserLoader(socketio_server.services.get(UserProfileCache))
+        user = await user_loader.load_by_id(user_credentials.user_id)
+
     if user is None:
         logger.error(
             "The user with the provided email does not exist",
@@ -70,26 +93,59 @@ async def connect(request: Request, sid: str) -> bool | NoReturn:
             "Token payload is invalid: the user with the provided email does not exist."
         )
 
-    async with socketio_server.session(sid) as session:
-        session["user"] = user
-
-    await client_manager.redis.set(f"socketio:email:sid:{user_credentials.email}", sid)
+    socketio_server.sessions.set(sid, SocketSession.from_user(user))
+    socketio_server.enter_room(sid, get_user_room(user.email))
+    await socketio_server.services.get(PresenceRegistry).add(user.email, sid)
+
+
+@socketio_server.on_connected
+async def replay_inbox(sid: str) -> None:
+    if not app_config.socketio_inbox_enabled:
+        return
+
+    # Clients that don't present the last event they have seen don't use the inbox
+    request = Request(socketio_server.get_environ(sid)["asgi.scope"])
+    last_event_id = request.query_params.get("last_event_id")
+    if last_event_id is None or not is_valid_event_id(last_event_id):
+        return
+
+    # The events are read after the connection is registered in the presence registry,
+    # so an event that is stored after the read is still replayed on the next reconnect
+    email = socketio_server.sessions.get(sid).email
+    events = await socketio_server.services.get(EventInbox).read_since(
+        email, last_event_id
+    )
+    if events:
+        await socketio_server.emit(
+            INBOX_REPLAY_EVENT_NAME,
+            [event.to_dict() for event in events],
+            to=sid,
+            ignore_queue=True,
+        )
 
 
 @socketio_server.event
 async def disconnect(sid: str):
-    async with socketio_server.session(sid) as session:  # type: SessionType
-        email = session["user"].email
-        await client_manager.redis.delete(f"socketio:email:sid:{email}")
+    socketio_server.dispatcher.discard(sid)
+    session = socketio_server.sessions.pop(sid)
+    if session is None:
+        # The connection was refused
+        return
+
+    # The room is left by Socket.IO itself
+    await socketio_server.services.get(PresenceRegistry).remove(session.email, sid)
 
 
 @socketio_server.on("relationship:events_seen")
+@rate_limit(
+    "relationship:events_seen",
+    get_rate_limiter=lambda: socketio_server.services.get(RateLimiter),
+    get_key=lambda sid: str(socketio_server.sessions.get(sid).user_id),
+)
 @validate_data(pydantic_model=RelationshipEventsSeenPayload)
 async def on_relationship_events_seen(
     sid: str, _, parsed_data: RelationshipEventsSeenPayload
 ):
-    async with socketio_server.session(sid) as session:  # type: SessionType
-        user_id = session["user"].id
-
+    user_id = socketio_server.sessions.get(sid).user_id
     service = socketio_server.services.get(RelationshipStatsService)
     await service.reset_relationship_stats(user_id, parsed_data.type)
@@ -7,12 +7,14 @@ from typing import Final
 from typing import Literal
 
 from pydantic import Field
+from pydantic import SecretStr
 from pydantic import model_validator
 from pydantic.networks import RedisDsn
 from pydantic_settings import BaseSettings
 from pydantic_settings import SettingsConfigDict
 
 from src.utils import git
+from src.utils.rate_limit import RateLimit
 
 
 ENV_EXAMPLE_FILE_PATH = pathlib.Path(__file__).parent / ".env.example"
@@ -41,11 +43,102 @@ class AppConfig(BaseSettings):
     auth0_domain: str = Field(validation_alias="AUTH0_DOMAIN")
     auth0_audience: str = Field(validation_alias="AUTH0_AUDIENCE")
     auth0_jwt_issuer: str
+    auth_user_id_cache_ttl: int = 24 * 60 * 60
+    jwt_leeway: int = 30
+    jwt_cache_maxsize: int = 10_000
+    jwt_cache_max_ttl: int = 60 * 60
+    jwt_cache_shared: bool = False
+    # Defaults to the key set of the Auth0 tenant, overridden by local stubs
+    jwks_url: str | None = None
+    jwks_cache_lifespan: int = 5 * 60
+    jwks_min_refresh_interval: int = 30
+    jwks_request_timeout: int = 10
+    jwks_snapshot_path: pathlib.Path | None = None
 
     s3_bucket_name: str
     s3_access_key: str
     s3_secret_key: str
     s3_region_name: str
+    # Points the client at an S3-compatible stand-in, like MinIO, for local development
+    s3_endpoint_url: str | None = None
+    s3_max_pool_connections: int = 50
+    s3_connect_timeout: float = 5
+    s3_read_timeout: float = 30
+    s3_max_attempts: int = 3
+    s3_stats_interval: int = 60
+    s3_known_keys_cache_size: int = 10_000
+
+    avatar_max_upload_size: int = 10 * 1024 * 1024
+    avatar_max_pixels: int = 40_000_000
+    avatar_upload_url_ttl: int = 10 * 60
+    # Uploads that were never completed are deleted once they are older than that
+    avatar_upload_max_age: int = 24 * 60 * 60
+    avatar_upload_cleanup_interval: int = 60 * 60
+    # Variants made from an uploaded image are reused when the same image is uploaded again,
+    # as long as they are still stored
+    avatar_variants_cache_ttl: int = 30 * 24 * 60 * 60
+    image_processing_max_workers: int = 2
+    image_processing_max_pending: int = 16
+
+    username_search_cache_ttl: int = 30
+    username_search_candidate_window: int = 50
+
+    username_filter_capacity: int = 1_000_000
+    username_filter_error_rate: float = 0.01
+    username_filter_rebuild_interval: int = 60 * 60
+
+    user_profile_cache_enabled: bool = True
+    user_profile_cache_maxsize: int = 10_000
+    user_profile_cache_ttl: int = 5 * 60
+    user_profile_cache_stats_interval: int = 60
+
+    # msgpack requires a client with the msgpack parser and the `msgpack` extra installed
+    socketio_serializer: Literal["json", "msgpack"] = "json"
+    # Events emitted to a user within the window are sent in one `batch` event, which
+    # clients have to handle. `None` disables it, and then every emit is awaited until
+    # the event is published, while batched emits are best-effort.
+    socketio_batch_window: float | None = None
+    presence_ttl: int = 60
+    presence_heartbeat_interval: int = 20
+    # Events of different names handled at once per connection, and in total
+    socketio_handler_concurrency_per_connection: int = 4
+    socketio_handler_concurrency: int = 256
+    # Events waiting per connection before the overflow policy applies
+    socketio_handler_queue_depth: int = 64
+    socketio_handler_overflow_policy: Literal["drop", "disconnect"] = "drop"
+    # Events emitted to offline users are kept for them to be replayed on reconnect,
+    # which clients have to request with the `last_event_id` query parameter
+    socketio_inbox_enabled: bool = False
+    socketio_inbox_maxlen: int = 100
+    socketio_inbox_ttl: int = 24 * 60 * 60
+
+    user_deletion_batch_size: int = 500
+    user_deletion_batch_pause: float = 0.05
+    user_deletion_poll_interval: int = 5
+    user_deletion_lease_ttl: int = 60
+
+    # "local" keeps the buckets in every process, so the limits are per app instance
+    rate_limit_mode: Literal["redis", "local"] = "redis"
+    rate_limit_local_maxsize: int = 100_000
+    # Header with the client address set by the proxies in front of the app, such as
+    # "X-Forwarded-For", only the last `rate_limit_trusted_proxy_count` entries are trusted
+    rate_limit_client_ip_header: str | None = None
+    rate_limit_trusted_proxy_count: int = 1
+    # Keyed by the method and the path of the route
+    rate_limit_routes: dict[str, RateLimit] = Field(
+        default_factory=lambda: {
+            "PUT /api/v1/relationships/": RateLimit(limit=10, period=60),
+            "POST /api/v1/users/availability": RateLimit(limit=30, period=60),
+        }
+    )
+    # Keyed by the event name, events that aren't listed get the default limit
+    rate_limit_socketio_events: dict[str, RateLimit] = Field(default_factory=dict)
+    rate_limit_socketio_default: RateLimit | None = RateLimit(limit=20, period=1)
+
+    # Signs the pagination cursors, so that clients can't forge them
+    pagination_cursor_secret: SecretStr = Field(
+        validation_alias="PAGINATION_CURSOR_SECRET"
+    )
 
     test_db_name: str = "test_database"
 
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from typing import Final
+
+import pymongo
+import structlog
+
+from src.db.models import Account
+from src.db.models import User
+
+
+if TYPE_CHECKING:
+    from bson import ObjectId
+    from motor.motor_asyncio import AsyncIOMotorCollection
+    from motor.motor_asyncio import AsyncIOMotorDatabase
+
+
+_ACCOUNT_UNIQUE_INDEX_KEY: Final[list[tuple[str, int]]] = [
+    ("provider_account_id", pymongo.ASCENDING),
+    ("provider_name", pymongo.ASCENDING),
+]
+
+_USER_EMAIL_UNIQUE_INDEX_KEY: Final[list[tuple[str, int]]] = [
+    ("email", pymongo.ASCENDING)
+]
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+async def deduplicate_accounts(database: AsyncIOMotorDatabase) -> None:
+    """
+    Remove the duplicate links of the same provider account, which were possible before
+    accounts got a unique index. Beanie can't build the index while they exist, so this
+    has to run before `init_beanie`. The oldest link of every account is kept.
+    """
+    collection = database[Account.Settings.name]
+    if await _has_unique_index(collection, _ACCOUNT_UNIQUE_INDEX_KEY):
+        return
+
+    duplicate_ids = [
+        duplicate_id
+        async for group in collection.aggregate(
+            [
+                {"$sort": {"_id": pymongo.ASCENDING}},
+                {
+                    "$group": {
+                        "_id": {
+                            "provider_account_id": "$provider_account_id",
+                            "provider_name": "$provider_name",
+                        },
+                        "ids": {"$push": "$_id"},
+                    }
+                },
+                {"$match": {"ids.1": {"$exists": True}}},
+            ],
+            allowDiskUse=True,
+        )
+        for duplicate_id in group["ids"][1:]
+    ]
+    if duplicate_ids:
+        delete_result = await collection.delete_many({"_id": {"$in": duplicate_ids}})
+        logger.warning("Removed duplicate accounts", count=delete_result.deleted_count)
+
+
+async def find_users_with_duplicate_emails(
+    database: AsyncIOMotorDatabase,
+) -> list[list[ObjectId]]:
+    """
+    Find the users that share an email, which was possible before users got a unique
+    email index. Unlike duplicate accounts, they own data of their own, so they aren't
+    merged automatically, and the index can't be built until they are resolved by hand.
+    Returns the ids of every group of users with the same email.
+    """
+    collection = database[User.Settings.name]
+    if await _has_unique_index(collection, _USER_EMAIL_UNIQUE_INDEX_KEY):
+        return []
+
+    return [
+        group["ids"]
+        async for group in collection.aggregate(
+            [
+                {"$group": {"_id": "$email", "ids": {"$push": "$_id"}}},
+                {"$match": {"ids.1": {"$exists": True}}},
+            ],
+            allowDiskUse=True,
+        )
+    ]
+
+
+async def _has_unique_index(
+    collection: AsyncIOMotorCollection, key: list[tuple[str, int]]
+) -> bool:
+    return any(
+        index.get("unique") and list(index["key"]) == key
+        for index in (await collection.index_information()).values()
+    )
@@ -8,6 +8,7 @@ from src.db.models.relationship import Relationship
 from src.db.models.relationship import RelationshipStats
 from src.db.models.user import Account
 from src.db.models.user import User
+from src.db.models.user import UserDeletionJob
 
 
 Relationship.model_rebuild()
@@ -15,7 +16,15 @@ Conversation.model_rebuild()
 
 
 def gather_documents() -> list[type[Document]]:
-    return [Account, Relationship, User, Conversation, Message, RelationshipStats]
+    return [
+        Account,
+        Relationship,
+        User,
+        Conversation,
+        Message,
+        RelationshipStats,
+        UserDeletionJob,
+    ]
 
 
 __all__ = [
@@ -24,5 +33,6 @@ __all__ = [
     "Account",
     "Conversation",
     "Message",
+    "UserDeletionJob",
     "gather_documents",
 ]
@@ -36,6 +36,7 @@ class Message(Document):
         indexes = [
             IndexModel([("created_at", pymongo.DESCENDING)]),
             IndexModel([("text", pymongo.TEXT)]),
+            IndexModel("author._id"),
         ]
 
     # TODO: add attachments
@@ -90,4 +91,7 @@ class Conversation(Document):
         name = "conversations"
         indexes = [
             IndexModel([("created_at", pymongo.DESCENDING)]),
+            # Links are stored as DBRefs, these match whole DBRefs of users and messages
+            IndexModel("members"),
+            IndexModel("messages"),
         ]
@@ -56,5 +56,7 @@ class Relationship(Document):
                 ],
                 unique=True,
             ),
+            # Relationships of a user are looked up in both directions
+            IndexModel("initiator_user_id"),
         ]
         name = "relationships"
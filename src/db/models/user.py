@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import enum
+
+import pymongo
+
 from beanie import Document
 from beanie import Link
 from beanie import PydanticObjectId
@@ -13,9 +17,16 @@ from src.utils.datetime_utils import current_timeaware_utc_datetime
 from src.utils.pydantic_utils import Username
 
 
+# Case-insensitive comparison of usernames, the index and every query on `username`
+# have to use the same collation for MongoDB to be able to use the index.
+USERNAME_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+
 class User(Document):
     username: Username | None = None
     image: str | None = None
+    # Resized copies of `image` keyed by their size in pixels
+    image_variants: dict[str, str] | None = None
     bio: str | None = None
     email: str
     email_verified_at: AwareDatetime | None = Field(alias="emailVerified")
@@ -30,8 +41,9 @@ class User(Document):
             IndexModel(
                 "username",
                 unique=True,
-                collation=Collation(locale="en", strength=CollationStrength.SECONDARY),
+                collation=USERNAME_COLLATION,
             ),
+            IndexModel("email", unique=True),
         ]
 
 
@@ -47,3 +59,53 @@ class Account(Document):
     class Settings:
         name = "accounts"
         use_state_management = True
+        indexes = [
+            # `provider_account_id` goes first, so lookups without the provider use it too
+            IndexModel(
+                [
+                    ("provider_account_id", pymongo.ASCENDING),
+                    ("provider_name", pymongo.ASCENDING),
+                ],
+                unique=True,
+            ),
+            IndexModel("user_id"),
+        ]
+
+
+class UserDeletionStep(enum.StrEnum):
+    # Accounts are deleted along with the user now, the step only finishes
+    # the jobs that were queued before
+    accounts = enum.auto()
+    relationship_stats = enum.auto()
+    relationships = enum.auto()
+    conversations = enum.auto()
+    messages = enum.auto()
+    group_memberships = enum.auto()
+
+
+class UserDeletionJob(Document):
+    """
+    Removal of everything that references a deleted user, done in the background.
+    `step` is the first step that isn't finished yet, so a job can be resumed
+    by another worker once the lease of the previous one expires.
+    """
+
+    user_id: PydanticObjectId
+    step: UserDeletionStep = UserDeletionStep.relationship_stats
+    deleted_counts: dict[str, int] = Field(default_factory=dict)
+    attempts: int = 0
+    lease_expires_at: AwareDatetime | None = None
+    created_at: AwareDatetime = Field(default_factory=current_timeaware_utc_datetime)
+    completed_at: AwareDatetime | None = None
+
+    class Settings:
+        name = "user_deletion_jobs"
+        indexes = [
+            IndexModel("user_id", unique=True),
+            IndexModel(
+                [
+                    ("completed_at", pymongo.ASCENDING),
+                    ("lease_expires_at", pymongo.ASCENDING),
+                ]
+            ),
+        ]
@@ -17,6 +17,7 @@ import uvicorn
 from beanie import init_beanie
 from bson import CodecOptions
 from ddtrace.contrib.asgi import TraceMiddleware
+from fastapi import Depends
 from fastapi import FastAPI
 from fastapi import Header
 from fastapi import Request
@@ -38,14 +39,27 @@ from src.api.v1 import create_root_router
 from src.api.websockets.server import asgi_app
 from src.api.websockets.server import socketio_server
 from src.config import app_config
+from src.db.migrations import deduplicate_accounts
+from src.db.migrations import find_users_with_duplicate_emails
 from src.db.models import gather_documents
 from src.exceptions import BusinessLogicError
 from src.middlewares.logging_middleware import logging_middleware
+from src.middlewares.rate_limit_middleware import RateLimitMiddleware
 from src.services.conversation_service import ConversationService
 from src.services.relationship_service import RelationshipService
 from src.services.relationship_stats_service import RelationshipStatsService
+from src.services.user_deletion_service import UserDeletionService
+from src.services.user_loader import UserLoader
+from src.services.user_profile_cache import UserProfileCache
 from src.services.user_service import UserService
+from src.utils.auth import jwks_client
 from src.utils.custom_logging import setup_logging
+from src.utils.depends import get_user_loader
+from src.utils.images import ImageProcessor
+from src.utils.rate_limit import RateLimiter
+from src.utils.s3 import S3Storage
+from src.utils.socketio.inbox import EventInbox
+from src.utils.socketio.presence import PresenceRegistry
 from src.utils.socketio.socket_manager import SocketIOManager
 from src.utils.stub import DependencyStub
 from src.utils.stub import SingletonDependency
@@ -56,16 +70,81 @@ logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
 def create_app() -> FastAPI:
     mongodb_client = AsyncIOMotorClient(app_config.db_url)
+    redis_client = Redis.from_url(
+        str(app_config.redis_dsn), socket_keepalive=True, socket_timeout=300
+    )
+    presence_registry = PresenceRegistry(
+        redis_client,
+        ttl=app_config.presence_ttl,
+        heartbeat_interval=app_config.presence_heartbeat_interval,
+    )
+    event_inbox = (
+        EventInbox(
+            redis_client,
+            maxlen=app_config.socketio_inbox_maxlen,
+            ttl=app_config.socketio_inbox_ttl,
+        )
+        if app_config.socketio_inbox_enabled
+        else None
+    )
     socketio_manager = SocketIOManager(
-        socketio.AsyncRedisManager(str(app_config.redis_dsn), write_only=True)
+        socketio.AsyncRedisManager(str(app_config.redis_dsn), write_only=True),
+        presence_registry,
+        batch_window=app_config.socketio_batch_window,
+        local_server=socketio_server,
+        inbox=event_inbox,
     )
-    boto3_session = aioboto3.Session(
-        aws_access_key_id=app_config.s3_access_key,
-        aws_secret_access_key=app_config.s3_secret_key,
-        region_name=app_config.s3_region_name,
+    rate_limiter = RateLimiter(
+        redis_client,
+        mode=app_config.rate_limit_mode,
+        local_maxsize=app_config.rate_limit_local_maxsize,
+    )
+    s3_storage = S3Storage(
+        aioboto3.Session(
+            aws_access_key_id=app_config.s3_access_key,
+            aws_secret_access_key=app_config.s3_secret_key,
+            region_name=app_config.s3_region_name,
+        ),
+        bucket_name=app_config.s3_bucket_name,
+        endpoint_url=app_config.s3_endpoint_url,
+        max_pool_connections=app_config.s3_max_pool_connections,
+        connect_timeout=app_config.s3_connect_timeout,
+        read_timeout=app_config.s3_read_timeout,
+        max_attempts=app_config.s3_max_attempts,
+        known_keys_cache_size=app_config.s3_known_keys_cache_size,
     )
 
-    lifespan_fn = functools.partial(lifespan, mongodb_client=mongodb_client)
+    user_profile_cache = UserProfileCache(
+        redis_client,
+        maxsize=app_config.user_profile_cache_maxsize,
+        ttl=app_config.user_profile_cache_ttl,
+        enabled=app_config.user_profile_cache_enabled,
+    )
+    image_processor = ImageProcessor(
+        max_workers=app_config.image_processing_max_workers,
+        max_pending=app_config.image_processing_max_pending,
+        max_pixels=app_config.avatar_max_pixels,
+    )
+    user_service = UserService(
+        mongodb_client,
+        s3_storage,
+        redis_client,
+        user_profile_cache,
+        image_processor,
+    )
+
+    lifespan_fn = functools.partial(
+        lifespan,
+        mongodb_client=mongodb_client,
+        redis_client=redis_client,
+        user_service=user_service,
+        user_profile_cache=user_profile_cache,
+        image_processor=image_processor,
+        s3_storage=s3_storage,
+        user_deletion_service=UserDeletionService(mongodb_client),
+        presence_registry=presence_registry,
+        socketio_manager=socketio_manager,
+    )
 
     app = FastAPI(
         docs_url="/api/v1/docs",
@@ -81,14 +160,20 @@ def create_app() -> FastAPI:
         version=app_config.version,
         lifespan=lifespan_fn,
     )
-    _setup_middlewares(app)
+    _setup_middlewares(app, rate_limiter, redis_client)
 
     # Setup dependency injection using third-party library for SocketIO
     # since it doesn't support it out of the box and
     # one can't really use FastAPI's dependency injection system for it
     container = Container()
     container.add_instance(RelationshipStatsService(mongodb_client))
-    container.add_instance(UserService(mongodb_client, boto3_session))
+    container.add_instance(user_service)
+    container.add_instance(user_profile_cache)
+    container.add_instance(redis_client, Redis)
+    container.add_instance(presence_registry)
+    container.add_instance(rate_limiter)
+    if event_inbox is not None:
+        container.add_instance(event_inbox)
     provider = container.build_provider()
     _mount_websocket_app(app, provider)
 
@@ -99,17 +184,38 @@ def create_app() -> FastAPI:
         BusinessLogicError, transform_business_logic_exception_handler
     )
 
+    # Services are created per request, so they share the request-scoped user loader
+    def provide_user_service(
+        user_loader: Annotated[UserLoader, Depends(get_user_loader)]
+    ) -> UserService:
+        return UserService(
+            mongodb_client,
+            s3_storage,
+            redis_client,
+            user_profile_cache,
+            image_processor,
+            user_loader=user_loader,
+        )
+
+    def provide_relationship_service(
+        user_loader: Annotated[UserLoader, Depends(get_user_loader)]
+    ) -> RelationshipService:
+        return RelationshipService(
+            mongodb_client, socketio_manager, user_loader=user_loader
+        )
+
+    def provide_conversation_service(
+        user_loader: Annotated[UserLoader, Depends(get_user_loader)]
+    ) -> ConversationService:
+        return ConversationService(mongodb_client, user_loader=user_loader)
+
     app.dependency_overrides = {
-        DependencyStub("user_service"): lambda: UserService(
-            mongodb_client, boto3_session
-        ),
-        DependencyStub("relationship_service"): lambda: RelationshipService(
-            mongodb_client, socketio_manager
-        ),
-        DependencyStub("conversation_service"): lambda: ConversationService(
-            mongodb_client
-        ),
-        DependencyStub("boto3_session"): SingletonDependency(boto3_session),
+        DependencyStub("user_service"): provide_user_service,
+        DependencyStub("relationship_service"): provide_relationship_service,
+        DependencyStub("conversation_service"): provide_conversation_service,
+        DependencyStub("s3_storage"): SingletonDependency(s3_storage),
+        DependencyStub("redis"): SingletonDependency(redis_client),
+        DependencyStub("user_profile_cache"): SingletonDependency(user_profile_cache),
     }
 
     return app
@@ -123,7 +229,18 @@ def _mount_websocket_app(app: FastAPI, services: Services):
     app.mount("/ws", app=asgi_app, name="socketio")
 
 
-def _setup_middlewares(app: FastAPI) -> None:
+def _setup_middlewares(
+    app: FastAPI, rate_limiter: RateLimiter, redis_client: Redis
+) -> None:
+    # Rejected requests are still logged, as the logging middleware is added after it
+    app.add_middleware(
+        RateLimitMiddleware,
+        rate_limiter=rate_limiter,
+        rate_limits=app_config.rate_limit_routes,
+        redis=redis_client,
+        client_ip_header=app_config.rate_limit_client_ip_header,
+        trusted_proxy_count=app_config.rate_limit_trusted_proxy_count,
+    )
     app.middleware("http")(logging_middleware)
 
     # This middleware must be placed after the logging, to populate the context with the request ID
@@ -192,13 +309,21 @@ async def transform_business_logic_exception_handler(
 
 
 @asynccontextmanager
-async def lifespan(application: FastAPI, mongodb_client: AsyncIOMotorClient):
+async def lifespan(
+    application: FastAPI,
+    mongodb_client: AsyncIOMotorClient,
+    redis_client: Redis,
+    user_service: UserService,
+    user_profile_cache: UserProfileCache,
+    image_processor: ImageProcessor,
+    s3_storage: S3Storage,
+    user_deletion_service: UserDeletionService,
+    presence_registry: PresenceRegistry,
+    socketio_manager: SocketIOManager,
+):
     logger.info("Trying to connect to Redis and check if it's alive...")
-    redis_instance = Redis.from_url(
-        str(app_config.redis_dsn), socket_keepalive=True, socket_timeout=300
-    )
     try:
-        await redis_instance.ping()
+        await redis_client.ping()
     except redis.exceptions.ConnectionError:
         logger.error(
             "Failed to connect to Redis. Check credentials of redis and is the redis instance running. Exiting application..."
@@ -206,16 +331,23 @@ async def lifespan(application: FastAPI, mongodb_client: AsyncIOMotorClient):
         sys.exit(1)
     logger.info("Successfully connected to Redis.")
 
+    database = mongodb_client.get_database(
+        app_config.database_name, CodecOptions(tz_aware=True, tzinfo=datetime.UTC)
+    )
+    # Unique indexes can't be built over the documents that violate them
+    await deduplicate_accounts(database)
+    if duplicate_user_ids := await find_users_with_duplicate_emails(database):
+        logger.error(
+            "Some users share an email, so the unique email index can't be built. "
+            "Merge or delete them before starting the application. Exiting application...",
+            user_ids=[list(map(str, user_ids)) for user_ids in duplicate_user_ids],
+        )
+        sys.exit(1)
+
     logger.info("Trying to init beanie and connect to MongoDB...")
     try:
         async with asyncio.timeout(5):
-            await init_beanie(
-                database=mongodb_client.get_database(
-                    app_config.database_name,
-                    CodecOptions(tz_aware=True, tzinfo=datetime.UTC),
-                ),
-                document_models=gather_documents(),
-            )
+            await init_beanie(database=database, document_models=gather_documents())
     except asyncio.TimeoutError:
         logger.error(
             "Failed to connect to MongoDB within 5 seconds. "
@@ -223,7 +355,32 @@ async def lifespan(application: FastAPI, mongodb_client: AsyncIOMotorClient):
         )
         sys.exit(1)
     logger.info("Successfully connected to MongoDB and initialized beanie")
+
+    image_processor.start()
+    await jwks_client.start()
+    await s3_storage.start()
+
+    background_tasks = [
+        asyncio.create_task(user_service.maintain_username_filter()),
+        asyncio.create_task(user_service.clean_up_avatar_uploads()),
+        asyncio.create_task(user_profile_cache.listen_for_invalidations()),
+        asyncio.create_task(user_deletion_service.run_worker()),
+        asyncio.create_task(jwks_client.run_refresher()),
+        asyncio.create_task(presence_registry.maintain()),
+        asyncio.create_task(s3_storage.report_stats(app_config.s3_stats_interval)),
+    ]
     yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await socketio_manager.flush()
+
+    # Waits for the images that are being processed right now
+    await asyncio.to_thread(image_processor.shutdown)
+
+    await jwks_client.close()
+    await s3_storage.close()
+    await redis_client.close()
 
 
 app = create_app()
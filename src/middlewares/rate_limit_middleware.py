@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from fastapi.responses import ORJSONResponse
+from fastapi.security.utils import get_authorization_scheme_param
+from starlette.datastructures import Headers
+from starlette.datastructures import MutableHeaders
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from src.utils.auth import TokenInvalidError
+from src.utils.auth import get_token_payload
+
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+    from starlette.types import ASGIApp
+    from starlette.types import Message
+    from starlette.types import Receive
+    from starlette.types import Scope
+    from starlette.types import Send
+
+    from src.utils.rate_limit import RateLimit
+    from src.utils.rate_limit import RateLimiter
+
+
+class RateLimitMiddleware:
+    """
+    Limits the requests to the routes in `rate_limits`, which are keyed by the method
+    and the path, e.g. `"PUT /api/v1/relationships/"`. The hits are counted per access
+    token, or per client address for anonymous requests, and the responses of the
+    limited routes carry the `RateLimit-*` headers.
+
+    Only verified tokens count, as any made-up token would get a bucket of its own
+    otherwise, and requests with an invalid one are counted by the address. Behind
+    proxies the address is taken from `client_ip_header`, which every proxy appends
+    the address it was connected from to, so the `trusted_proxy_count`-th address from
+    the end is the last one that can't be spoofed by the client.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        rate_limiter: RateLimiter,
+        rate_limits: dict[str, RateLimit],
+        redis: Redis | None = None,
+        client_ip_header: str | None = None,
+        trusted_proxy_count: int = 1,
+    ):
+        self.app = app
+        self._rate_limiter = rate_limiter
+        self._rate_limits = rate_limits
+        self._redis = redis
+        self._client_ip_header = client_ip_header
+        self._trusted_proxy_count = trusted_proxy_count
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = f"{scope['method']} {scope['path']}"
+        rate_limit = self._rate_limits.get(route)
+        if rate_limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        result = await self._rate_limiter.hit(
+            f"http:{route}:{await self._get_client_key(scope)}", rate_limit
+        )
+        if not result.allowed:
+            response = ORJSONResponse(
+                {"detail": "Too many requests", "code": "rate_limited"},
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                headers=result.headers,
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).update(result.headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    async def _get_client_key(self, scope: Scope) -> str:
+        headers = Headers(scope=scope)
+        scheme, token = get_authorization_scheme_param(headers.get("authorization"))
+        if scheme.lower() == "bearer" and token:
+            try:
+                payload = await get_token_payload(token, self._redis)
+            except TokenInvalidError:
+                pass
+            else:
+                if subject := payload.get("sub"):
+                    return f"sub:{subject}"
+
+        return f"ip:{self._get_client_ip(scope, headers)}"
+
+    def _get_client_ip(self, scope: Scope, headers: Headers) -> str:
+        if self._client_ip_header is not None:
+            addresses = [
+                address.strip()
+                for value in headers.getlist(self._client_ip_header)
+                for address in value.split(",")
+                if address.strip()
+            ]
+            if addresses:
+                return addresses[-min(self._trusted_proxy_count, len(addresses))]
+
+        client = scope.get("client")
+        return client[0] if client else "anonymous"
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+from typing import Annotated
+from typing import Literal
+
 from beanie import PydanticObjectId
 from fastapi import UploadFile
 from pydantic import AwareDatetime
@@ -27,6 +30,23 @@ class UserUpdateSchema(BaseModel):
     image: UploadFile | None
 
 
+class AvatarUploadInputSchema(BaseModel):
+    content_type: Literal["image/jpeg", "image/png", "image/webp", "image/gif"]
+
+
+class AvatarUploadSchema(BaseModel):
+    key: str
+    # The file is sent to `url` as a multipart form with `fields`, followed by `file`
+    url: str
+    fields: dict[str, str]
+    max_size: int
+    expires_at: AwareDatetime
+
+
+class AvatarUploadCompleteSchema(BaseModel):
+    key: str
+
+
 class CheckUsernameAvailabilitySchema(BaseModel):
     username: str
 
@@ -35,13 +55,33 @@ class ExistsResponseSchema(BaseModel):
     exists: bool
 
 
+class UserBatchInputSchema(BaseModel):
+    ids: Annotated[list[PydanticObjectId], Field(min_length=1, max_length=100)]
+
+
+class UserSearchResultSchema(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    username: Username
+    image: str | None = None
+
+
+class UserPublicSchema(BaseModel):
+    """Fields of a user that anyone signed in is allowed to see."""
+
+    id: PydanticObjectId = Field(alias="_id")
+    username: Username | None = None
+    image: str | None = None
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
+
+
 class UserOutputSchema(BaseModel):
     id: str
     bio: str | None = None
     username: Username | None = None
     email: EmailStr
     email_verified: AwareDatetime | None = None
-    image: str = None
+    image: str | None = None
+    image_variants: dict[str, str] | None = None
     created_at: AwareDatetime | None = None
     model_config = ConfigDict(from_attributes=True)
 
@@ -51,8 +91,7 @@ class UserOutputSchema(BaseModel):
         return str(value)
 
 
-class AccountScheme(BaseModel):
-    user_id: str = Field(alias="userId")
+class AccountBaseScheme(BaseModel):
     provider_name: str = Field(alias="type")
     provider_account_id: str = Field(alias="providerAccountId")
     refresh_token: str | None = None
@@ -70,3 +109,12 @@ class AccountScheme(BaseModel):
     scope: str | None = None
     id_token: str | None = None
     session_state: str | None = None
+
+
+class AccountScheme(AccountBaseScheme):
+    user_id: str = Field(alias="userId")
+
+
+class UserAccountLinkSchema(BaseModel):
+    user: UserInputSchema
+    account: AccountBaseScheme
@@ -3,16 +3,24 @@ from __future__ import annotations
 from contextlib import AbstractAsyncContextManager
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from typing import TYPE_CHECKING
 from typing import Any
 from typing import Generic
 from typing import TypeVar
 
+from beanie import PydanticObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
 from motor.motor_asyncio import AsyncIOMotorClientSession
 from pymongo import ReadPreference
 from pymongo import WriteConcern
 from pymongo.read_concern import ReadConcern
 
+from src.db.models import User
+
+
+if TYPE_CHECKING:
+    from src.services.user_loader import UserLoader
+
 
 _T = TypeVar("_T")
 
@@ -31,9 +39,26 @@ class PaginatedResult(Generic[_T]):
 
 
 class BaseService:
-    def __init__(self, db_client: AsyncIOMotorClient):
+    def __init__(
+        self, db_client: AsyncIOMotorClient, *, user_loader: UserLoader | None = None
+    ):
         self.__db_client = db_client
         self._current_session: AsyncIOMotorClientSession | None = None
+        self._user_loader = user_loader
+
+    async def _get_user_by_email(self, email: str) -> User | None:
+        # Inside a transaction the user has to be read through the session,
+        # so the request-scoped loader can't be used there
+        if self._user_loader is not None and self._current_session is None:
+            return await self._user_loader.load_by_email(email)
+
+        return await User.find_one(User.email == email, session=self._current_session)
+
+    async def _get_user_by_id(self, user_id: PydanticObjectId | str) -> User | None:
+        if self._user_loader is not None and self._current_session is None:
+            return await self._user_loader.load_by_id(user_id)
+
+        return await User.get(user_id, session=self._current_session)
 
     @asynccontextmanager
     async def transaction(
@@ -24,9 +24,7 @@ class ConversationService(BaseService):
         limit: int = 30,
         cursor_payload: ConversationPreviewSchemaCursorPayload | None = None,
     ) -> PaginatedResult[dict[str, Any]]:
-        user: User = await User.find_one(
-            User.email == email, session=self._current_session
-        )
+        user = await self._get_user_by_email(email)
         limit_plus_one_entry_to_check_if_has_more = limit + 1
 
         pagination_cond_aggregation_steps: list[dict[str, Any]] = []
@@ -104,9 +102,7 @@ class ConversationService(BaseService):
     async def get_conversation_preview_by_id(
         self, conversation_id: PydanticObjectId, user_email: str
     ):
-        user: User = await User.find_one(
-            User.email == user_email, session=self._current_session
-        )
+        user = await self._get_user_by_email(user_email)
 
         try:
             return (
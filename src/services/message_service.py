@@ -4,7 +4,6 @@ from beanie import WriteRules
 
 from src.db.models import Conversation
 from src.db.models import Message
-from src.db.models import User
 from src.exceptions import BusinessLogicError
 from src.services.base_service import BaseService
 
@@ -14,14 +13,12 @@ class MessageService(BaseService):
         conversation = await Conversation.get(
             conversation_id, session=self._current_session
         )
-        sender = await User.get(sender_id, session=self._current_session)
+        sender = await self._get_user_by_id(sender_id)
 
         if not sender:
             raise BusinessLogicError("Sender not found.", "sender_not_found")
 
-        conversation.messages.append(
-            Message(text=text, author=await User.get(sender_id))
-        )
+        conversation.messages.append(Message(text=text, author=sender))
         await conversation.save(
             link_rule=WriteRules.WRITE, session=self._current_session
         )
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
-import asyncio
-
+from typing import TYPE_CHECKING
 from typing import Any
 
 from beanie import PydanticObjectId
@@ -20,14 +19,23 @@ from src.schemas.relationship import UpdateRelationshipStatusPayload
 from src.schemas.websockets.relationships import RelationshipDeletePayload
 from src.services.base_service import BaseService
 from src.utils.orm_utils import get_collection_name_from_model
+from src.utils.socketio.socket_manager import Emission
 from src.utils.socketio.socket_manager import SocketIOManager
 
 
+if TYPE_CHECKING:
+    from src.services.user_loader import UserLoader
+
+
 class RelationshipService(BaseService):
     def __init__(
-        self, db_client: AsyncIOMotorClient, socketio_manager: SocketIOManager
+        self,
+        db_client: AsyncIOMotorClient,
+        socketio_manager: SocketIOManager,
+        *,
+        user_loader: UserLoader | None = None,
     ):
-        super().__init__(db_client)
+        super().__init__(db_client, user_loader=user_loader)
         self._socketio_manager = socketio_manager
 
     async def get_relationships(
@@ -53,7 +61,7 @@ class RelationshipService(BaseService):
                 },
             }
 
-        user = await User.find_one(User.email == email, session=self._current_session)
+        user = await self._get_user_by_email(email)
 
         return (
             await Relationship.find(Relationship.type == relationship_type)
@@ -157,9 +165,7 @@ class RelationshipService(BaseService):
                 "user_not_found",
             )
 
-        initiator = await User.find_one(
-            User.email == initiator_email, session=self._current_session
-        )
+        initiator = await self._get_user_by_email(initiator_email)
         if initiator.id == target_user.id:
             raise BusinessLogicError(
                 "You can't send a friend request to yourself", "self_reference_error"
@@ -191,9 +197,9 @@ class RelationshipService(BaseService):
                 "already_send_request",
             ) from ex
 
-        await asyncio.gather(
-            *[
-                self._socketio_manager.emit_to_user_by_email(
+        await self._socketio_manager.emit_many(
+            [
+                Emission(
                     email=target_user.email,
                     event_name="relationship:new",
                     payload=RelationshipListItemSchema(
@@ -201,9 +207,8 @@ class RelationshipService(BaseService):
                         target=initiator,
                         type=RelationshipTypeExpanded.ingoing_request,
                     ),
-                    raise_if_recipient_not_connected=False,
                 ),
-                self._socketio_manager.emit_to_user_by_email(
+                Emission(
                     email=initiator_email,
                     event_name="relationship:new",
                     payload=RelationshipListItemSchema(
@@ -211,7 +216,6 @@ class RelationshipService(BaseService):
                         target=target_user,
                         type=RelationshipTypeExpanded.outgoing_request,
                     ),
-                    raise_if_recipient_not_connected=False,
                 ),
             ]
         )
@@ -228,7 +232,7 @@ class RelationshipService(BaseService):
             session=self._current_session,
             fetch_links=True,
         )
-        initiator = await User.get(relationship.initiator_user_id)
+        initiator = await self._get_user_by_id(relationship.initiator_user_id)
 
         if payload.new_state == "accepted":
             async with self.transaction():
@@ -264,11 +268,14 @@ class RelationshipService(BaseService):
             raise_if_recipient_not_connected=False,
         )
 
-    async def block_user(self, *, initiator_user_id: str, partner_user_id: str) -> None:
+    async def block_user(
+        self, *, initiator_user_id: PydanticObjectId, partner_user_id: str
+    ) -> None:
         await Relationship.find_one(
-            Relationship.partner.id == PydanticObjectId(partner_user_id),
-            Relationship.initiator.email == initiator_user_id,
-            fetch_links=True,
+            {
+                "target.$id": PydanticObjectId(partner_user_id),
+                "initiator_user_id": initiator_user_id,
+            },
             session=self._current_session,
         ).update_one(
             Set({Relationship.type: RelationshipType.blocked}),
@@ -278,9 +285,7 @@ class RelationshipService(BaseService):
     async def delete_friend(
         self, *, relationship_id: PydanticObjectId, user_email: str
     ) -> None:
-        user = await User.find_one(
-            User.email == user_email, session=self._current_session
-        )
+        user = await self._get_user_by_email(user_email)
         if not user:
             raise BusinessLogicError(
                 "You can't delete a relationship that you are not a part of.",
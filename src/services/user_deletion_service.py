@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import functools
+
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import NoReturn
+
+import pymongo
+import structlog
+
+from bson import DBRef
+
+from src.config import app_config
+from src.db.models import Account
+from src.db.models import Conversation
+from src.db.models import Message
+from src.db.models import Relationship
+from src.db.models import User
+from src.db.models import UserDeletionJob
+from src.db.models.relationship import RelationshipStats
+from src.db.models.user import UserDeletionStep
+from src.services.base_service import BaseService
+from src.utils.datetime_utils import current_timeaware_utc_datetime
+
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable
+    from collections.abc import Callable
+
+    from bson import ObjectId
+    from motor.motor_asyncio import AsyncIOMotorCollection
+
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class UserDeletionService(BaseService):
+    """
+    Removes the documents that reference deleted users. Every step deletes documents
+    in small batches with a pause in between, so that the deletion of a user with
+    a lot of data doesn't hold long locks or starve the requests that run meanwhile.
+    Steps are idempotent, so a job interrupted in the middle of a step is safe to resume.
+    """
+
+    async def run_worker(self) -> NoReturn:
+        while True:
+            try:
+                job = await self._claim_job()
+            except Exception:
+                logger.exception("Failed to claim a user deletion job")
+                job = None
+
+            if job is None:
+                await asyncio.sleep(app_config.user_deletion_poll_interval)
+                continue
+
+            try:
+                await self._run_job(job)
+            except Exception:
+                # The job will be picked up again once its lease expires
+                logger.exception("User deletion job failed", user_id=str(job.user_id))
+
+    async def _claim_job(self) -> UserDeletionJob | None:
+        now = current_timeaware_utc_datetime()
+        raw_job = await UserDeletionJob.get_motor_collection().find_one_and_update(
+            {
+                "completed_at": None,
+                "$or": [
+                    {"lease_expires_at": None},
+                    {"lease_expires_at": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {"lease_expires_at": self._next_lease_expiry()},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        return UserDeletionJob.model_validate(raw_job) if raw_job else None
+
+    async def _run_job(self, job: UserDeletionJob) -> None:
+        logger.info(
+            "Running user deletion job",
+            user_id=str(job.user_id),
+            step=job.step,
+            attempt=job.attempts,
+        )
+
+        steps = list(UserDeletionStep)
+        for step in steps[steps.index(job.step) :]:
+            await self._run_step(job, step)
+
+            next_step_index = steps.index(step) + 1
+            update: dict[str, Any] = {
+                "lease_expires_at": self._next_lease_expiry(),
+            }
+            if next_step_index < len(steps):
+                update["step"] = steps[next_step_index]
+            else:
+                update["completed_at"] = current_timeaware_utc_datetime()
+            await self._update_job(job, {"$set": update})
+
+        logger.info("User deletion job completed", user_id=str(job.user_id))
+
+    async def _run_step(self, job: UserDeletionJob, step: UserDeletionStep) -> None:
+        user_id = job.user_id
+        # Links are stored as DBRefs, and a whole DBRef is what `$pull` matches against
+        user_ref = DBRef(User.get_motor_collection().name, user_id)
+
+        match step:
+            case UserDeletionStep.accounts:
+                await self._delete_in_batches(
+                    job, step, Account.get_motor_collection(), {"user_id": user_id}
+                )
+            case UserDeletionStep.relationship_stats:
+                await self._delete_in_batches(
+                    job,
+                    step,
+                    RelationshipStats.get_motor_collection(),
+                    {"user_id": user_id},
+                )
+            case UserDeletionStep.relationships:
+                await self._delete_in_batches(
+                    job,
+                    step,
+                    Relationship.get_motor_collection(),
+                    {"$or": [{"target.$id": user_id}, {"initiator_user_id": user_id}]},
+                )
+            case UserDeletionStep.conversations:
+                # Conversations that would be left with less than 2 members
+                await self._delete_in_batches(
+                    job,
+                    step,
+                    Conversation.get_motor_collection(),
+                    {
+                        "members": user_ref,
+                        "$or": [
+                            {"is_group": False},
+                            {"members.2": {"$exists": False}},
+                        ],
+                    },
+                    before_delete=functools.partial(
+                        self._delete_conversation_messages, job
+                    ),
+                )
+            case UserDeletionStep.messages:
+                await self._delete_in_batches(
+                    job,
+                    step,
+                    Message.get_motor_collection(),
+                    {"author._id": user_id},
+                    before_delete=self._unlink_messages,
+                )
+            case UserDeletionStep.group_memberships:
+                await self._leave_group_conversations(job, step, user_ref)
+
+    async def _delete_in_batches(
+        self,
+        job: UserDeletionJob,
+        step: UserDeletionStep,
+        collection: AsyncIOMotorCollection,
+        query: dict[str, Any],
+        *,
+        before_delete: Callable[[list[ObjectId]], Awaitable[None]] | None = None,
+    ) -> None:
+        while batch_ids := await self._find_batch_ids(collection, query):
+            if before_delete is not None:
+                await before_delete(batch_ids)
+
+            delete_result = await collection.delete_many({"_id": {"$in": batch_ids}})
+            await self._record_progress(job, step, delete_result.deleted_count)
+
+    async def _leave_group_conversations(
+        self, job: UserDeletionJob, step: UserDeletionStep, user_ref: DBRef
+    ) -> None:
+        collection = Conversation.get_motor_collection()
+
+        while batch_ids := await self._find_batch_ids(
+            collection, {"members": user_ref}
+        ):
+            update_result = await collection.update_many(
+                {"_id": {"$in": batch_ids}}, {"$pull": {"members": user_ref}}
+            )
+            await self._record_progress(job, step, update_result.modified_count)
+
+    async def _delete_conversation_messages(
+        self, job: UserDeletionJob, conversation_ids: list[ObjectId]
+    ) -> None:
+        message_ids = [
+            message_link.id
+            async for conversation in Conversation.get_motor_collection().find(
+                {"_id": {"$in": conversation_ids}}, {"messages": 1}
+            )
+            for message_link in conversation.get("messages", [])
+        ]
+        messages = Message.get_motor_collection()
+        # A conversation can have a lot of messages, so they are deleted in batches as well
+        batch_size = app_config.user_deletion_batch_size
+        for i in range(0, len(message_ids), batch_size):
+            await messages.delete_many(
+                {"_id": {"$in": message_ids[i : i + batch_size]}}
+            )
+            # This can outlast the lease, and then another worker would claim the job
+            await self._renew_lease(job)
+            await asyncio.sleep(app_config.user_deletion_batch_pause)
+
+    async def _unlink_messages(self, message_ids: list[ObjectId]) -> None:
+        messages_collection_name = Message.get_motor_collection().name
+        message_refs = [
+            DBRef(messages_collection_name, message_id) for message_id in message_ids
+        ]
+        await Conversation.get_motor_collection().update_many(
+            {"messages": {"$in": message_refs}},
+            {"$pull": {"messages": {"$in": message_refs}}},
+        )
+
+    async def _find_batch_ids(
+        self, collection: AsyncIOMotorCollection, query: dict[str, Any]
+    ) -> list[ObjectId]:
+        # Yield to the other operations before every batch
+        await asyncio.sleep(app_config.user_deletion_batch_pause)
+        return [
+            document["_id"]
+            async for document in collection.find(
+                query, {"_id": 1}, limit=app_config.user_deletion_batch_size
+            )
+        ]
+
+    async def _record_progress(
+        self, job: UserDeletionJob, step: UserDeletionStep, count: int
+    ) -> None:
+        await self._update_job(
+            job,
+            {
+                "$inc": {f"deleted_counts.{step}": count},
+                "$set": {"lease_expires_at": self._next_lease_expiry()},
+            },
+        )
+
+    async def _renew_lease(self, job: UserDeletionJob) -> None:
+        await self._update_job(
+            job, {"$set": {"lease_expires_at": self._next_lease_expiry()}}
+        )
+
+    async def _update_job(self, job: UserDeletionJob, update: dict[str, Any]) -> None:
+        await UserDeletionJob.get_motor_collection().update_one({"_id": job.id}, update)
+
+    @staticmethod
+    def _next_lease_expiry() -> datetime.datetime:
+        return current_timeaware_utc_datetime() + datetime.timedelta(
+            seconds=app_config.user_deletion_lease_ttl
+        )
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Literal
+
+from beanie import PydanticObjectId
+from beanie.odm.operators.find.comparison import In
+
+from src.db.models import User
+from src.utils.dataloader import DataLoader
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from src.services.user_profile_cache import UserProfileCache
+
+
+class UserLoader:
+    """
+    Request-scoped identity map of users. Lookups made during the same event loop
+    iteration are batched into one `$in` query and every user is fetched at most once
+    per request, no matter whether it was requested by id or by email.
+    Users found in the process-wide profile cache don't hit the database at all.
+    """
+
+    def __init__(self, profile_cache: UserProfileCache | None = None) -> None:
+        self._profile_cache = profile_cache
+        self._by_id: DataLoader[PydanticObjectId, User] = DataLoader(self._load_by_ids)
+        self._by_email: DataLoader[str, User] = DataLoader(self._load_by_emails)
+
+    async def load_by_id(self, user_id: PydanticObjectId | str) -> User | None:
+        return await self._by_id.load(PydanticObjectId(user_id))
+
+    async def load_many_by_id(
+        self, user_ids: Iterable[PydanticObjectId | str]
+    ) -> list[User | None]:
+        return await self._by_id.load_many(
+            PydanticObjectId(user_id) for user_id in user_ids
+        )
+
+    async def load_by_email(self, email: str) -> User | None:
+        return await self._by_email.load(email)
+
+    async def _load_by_ids(
+        self, user_ids: list[PydanticObjectId]
+    ) -> dict[PydanticObjectId, User]:
+        users, missing_user_ids = self._get_cached(user_ids, by="id")
+        if missing_user_ids:
+            users.extend(await self._fetch(In(User.id, missing_user_ids)))
+
+        for user in users:
+            self._by_email.prime(user.email, user)
+        return {user.id: user for user in users}
+
+    async def _load_by_emails(self, emails: list[str]) -> dict[str, User]:
+        users, missing_emails = self._get_cached(emails, by="email")
+        if missing_emails:
+            users.extend(await self._fetch(In(User.email, missing_emails)))
+
+        for user in users:
+            self._by_id.prime(user.id, user)
+        return {user.email: user for user in users}
+
+    def _get_cached(
+        self, keys: list[Any], *, by: Literal["id", "email"]
+    ) -> tuple[list[User], list[Any]]:
+        if self._profile_cache is None:
+            return [], keys
+
+        get_cached = (
+            self._profile_cache.get_by_id
+            if by == "id"
+            else self._profile_cache.get_by_email
+        )
+        users: list[User] = []
+        missing_keys: list[Any] = []
+        for key in keys:
+            if (user := get_cached(key)) is not None:
+                users.append(user)
+            else:
+                missing_keys.append(key)
+
+        return users, missing_keys
+
+    async def _fetch(self, query: Any) -> list[User]:
+        users = await User.find(query).to_list()
+        if self._profile_cache is not None:
+            for user in users:
+                self._profile_cache.put(user)
+        return users
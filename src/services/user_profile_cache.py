@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+
+from typing import Any
+from typing import Final
+from typing import NoReturn
+
+import structlog
+
+from beanie import PydanticObjectId
+from redis.asyncio import Redis
+
+from src.config import app_config
+from src.db.models import User
+from src.utils.cache import CacheStats
+from src.utils.cache import LRUCache
+
+
+_INVALIDATION_CHANNEL: Final[str] = "users:profile_cache:invalidate"
+# Delays between the attempts to resubscribe, in seconds
+_MIN_RETRY_DELAY: Final[float] = 1.0
+_MAX_RETRY_DELAY: Final[float] = 30.0
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class UserProfileCache:
+    """
+    Per-worker cache of user profiles. Writes have to go through `invalidate`, which
+    evicts the user locally and publishes the id to Redis, so that all the other workers
+    evict it as well. The TTL bounds staleness if an invalidation message gets lost.
+    """
+
+    def __init__(self, redis: Redis, *, maxsize: int, ttl: float, enabled: bool = True):
+        self._redis = redis
+        self._enabled = enabled
+        # Raw documents are stored, so every caller gets its own `User` instance
+        self._users: LRUCache[PydanticObjectId, dict[str, Any]] = LRUCache(maxsize, ttl)
+        self._user_ids_by_email: LRUCache[str, PydanticObjectId] = LRUCache(
+            maxsize, ttl
+        )
+        self.stats = CacheStats()
+
+    def get_by_id(self, user_id: PydanticObjectId) -> User | None:
+        if not self._enabled:
+            return None
+
+        data = self._users.get(user_id)
+        if data is None:
+            self.stats.misses += 1
+            return None
+
+        self.stats.hits += 1
+        return User.model_validate(data)
+
+    def get_by_email(self, email: str) -> User | None:
+        if not self._enabled:
+            return None
+
+        user_id = self._user_ids_by_email.get(email)
+        if user_id is None:
+            self.stats.misses += 1
+            return None
+
+        return self.get_by_id(user_id)
+
+    def put(self, user: User) -> None:
+        if not self._enabled:
+            return
+
+        self._users.set(user.id, user.model_dump(by_alias=True))
+        self._user_ids_by_email.set(user.email, user.id)
+
+    async def invalidate(self, user_id: PydanticObjectId) -> None:
+        self._evict(user_id)
+        await self._redis.publish(_INVALIDATION_CHANNEL, str(user_id))
+
+    async def listen_for_invalidations(self) -> NoReturn:
+        stats_interval = app_config.user_profile_cache_stats_interval
+        next_stats_report_at = time.monotonic() + stats_interval
+        retry_delay = _MIN_RETRY_DELAY
+        resubscribing = False
+
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(_INVALIDATION_CHANNEL)
+                    if resubscribing:
+                        # Invalidations published while nobody was listening are lost,
+                        # so nothing that was cached before now can be trusted
+                        self._clear()
+                        resubscribing = False
+                    retry_delay = _MIN_RETRY_DELAY
+
+                    while True:
+                        message = await pubsub.get_message(
+                            ignore_subscribe_messages=True, timeout=1.0
+                        )
+                        if message is not None:
+                            self._evict(PydanticObjectId(message["data"].decode()))
+
+                        if time.monotonic() >= next_stats_report_at:
+                            self._report_stats()
+                            next_stats_report_at += stats_interval
+            except Exception:
+                logger.exception(
+                    "User profile cache invalidations failed, resubscribing...",
+                    retry_delay=retry_delay,
+                )
+                self._clear()
+                resubscribing = True
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, _MAX_RETRY_DELAY)
+
+    def _clear(self) -> None:
+        self._users.clear()
+        self._user_ids_by_email.clear()
+
+    def _evict(self, user_id: PydanticObjectId) -> None:
+        data = self._users.pop(user_id)
+        if data is not None:
+            self._user_ids_by_email.pop(data["email"])
+
+    def _report_stats(self) -> None:
+        logger.info(
+            "User profile cache stats",
+            pid=os.getpid(),
+            enabled=self._enabled,
+            size=len(self._users),
+            hits=self.stats.hits,
+            misses=self.stats.misses,
+            hit_rate=round(self.stats.hit_rate, 4),
+            evictions=self._users.stats.evictions,
+        )
@@ -1,37 +1,125 @@
 from __future__ import annotations
 
+import asyncio
+import datetime
+import hashlib
+import uuid
+
 from typing import TYPE_CHECKING
 from typing import Any
+from typing import Final
+from typing import NoReturn
 
-import aioboto3
+import orjson
+import pymongo
+import structlog
 
 from beanie import PydanticObjectId
+from beanie.odm.operators.find.comparison import In
 from beanie.odm.operators.update.general import Set
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.collation import Collation
-from pymongo.collation import CollationStrength
+from pymongo.errors import DuplicateKeyError
+from pymongo.errors import OperationFailure
+from redis.asyncio import Redis
 
+from src.config import app_config
 from src.db.models import Account
 from src.db.models import User
+from src.db.models import UserDeletionJob
+from src.db.models.relationship import Relationship
+from src.db.models.relationship import RelationshipType
+from src.db.models.user import USERNAME_COLLATION
 from src.exceptions import BusinessLogicError
+from src.schemas.user import AvatarUploadSchema
+from src.schemas.user import UserPublicSchema
+from src.schemas.user import UserSearchResultSchema
 from src.services.base_service import BaseService
+from src.utils.auth import forget_resolved_user_ids
+from src.utils.bloom_filter import RedisBloomFilter
+from src.utils.datetime_utils import current_timeaware_utc_datetime
+from src.utils.images import AVATAR_SIZES
+from src.utils.images import InvalidImageError
 from src.utils.orm_utils import compare_id
 from src.utils.pydantic_utils import map_raw_data_to_pydantic_fields
-from src.utils.s3 import upload_file
+from src.utils.s3 import S3Object
+from src.utils.s3 import S3Storage
+from src.utils.s3 import get_public_url
 
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from fastapi import UploadFile
+
+    from src.schemas.user import AccountBaseScheme
     from src.schemas.user import AccountScheme
+    from src.schemas.user import UserInputSchema
     from src.schemas.user import UserUpdateSchema
+    from src.services.user_loader import UserLoader
+    from src.services.user_profile_cache import UserProfileCache
+    from src.utils.images import ImageProcessor
+
+
+# ICU collation gives U+FFFF the highest primary weight, so `[prefix, prefix + U+FFFF)`
+# is exactly the range of strings starting with the prefix under `USERNAME_COLLATION`
+_COLLATION_MAX_CHARACTER: Final[str] = "\uffff"
+
+# Avatars uploaded straight to S3 wait here until the upload is completed
+_AVATAR_UPLOAD_KEY_PREFIX: Final[str] = "uploads/avatars/"
+_AVATAR_UPLOAD_CLEANUP_KEY: Final[str] = "users:avatar_uploads:cleaned_up"
+# S3 keys of the variants by the SHA-256 of the image they were made from
+_AVATAR_VARIANTS_KEY_PREFIX: Final[str] = "users:avatar_variant_keys:"
+_AVATAR_READ_CHUNK_SIZE: Final[int] = 64 * 1024
+
+# Lower rank is shown first in the search results
+_SEARCH_RANK_BY_RELATIONSHIP_TYPE: Final[dict[RelationshipType, int]] = {
+    RelationshipType.settled: 0,
+    RelationshipType.pending: 1,
+}
+_SEARCH_RANK_NO_RELATIONSHIP: Final[int] = 2
+
+_USERNAME_FILTER_KEY: Final[str] = "users:usernames:bloom"
+
+_ACCOUNT_UPSERT_ATTEMPTS: Final[int] = 3
+# Unique indexes that concurrent first sign-ins of the same user can violate, the one
+# that is retried finds the documents of the other then
+_SIGN_IN_RACE_INDEX_KEYS: Final[tuple[dict[str, int], ...]] = (
+    {"provider_account_id": 1, "provider_name": 1},
+    {"email": 1},
+)
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
 
 
 class UserService(BaseService):
-    def __init__(self, db_client: AsyncIOMotorClient, boto3_session: aioboto3.Session):
-        super().__init__(db_client)
-        self._s3_client = boto3_session
+    def __init__(
+        self,
+        db_client: AsyncIOMotorClient,
+        s3_storage: S3Storage,
+        redis: Redis,
+        profile_cache: UserProfileCache,
+        image_processor: ImageProcessor,
+        *,
+        user_loader: UserLoader | None = None,
+    ):
+        super().__init__(db_client, user_loader=user_loader)
+        self._s3_storage = s3_storage
+        self._redis = redis
+        self._profile_cache = profile_cache
+        self._image_processor = image_processor
+        # Casefolded usernames, so it matches the case-insensitive unique index
+        self._username_filter = RedisBloomFilter(
+            redis,
+            _USERNAME_FILTER_KEY,
+            capacity=app_config.username_filter_capacity,
+            error_rate=app_config.username_filter_error_rate,
+        )
 
     async def create_user(self, **data: Any) -> User:
-        return await User(**data).create(session=self._current_session)
+        user = await User(**data).create(session=self._current_session)
+        if user.username:
+            await self._username_filter.add(user.username.casefold())
+        return user
 
     async def get_user_by_filters(self, **filters: Any) -> User | None:
         provider_account_id = filters.pop("provider_account_id", None)
@@ -46,14 +134,17 @@ class UserService(BaseService):
         )
 
     async def does_user_exists_caseinsensetive(self, username: str) -> bool:
+        # Most of the usernames typed during sign-up are free, and the filter answers
+        # "definitely not taken" for them without a round trip to MongoDB
+        if not await self._username_filter.might_contain(username.casefold()):
+            return False
+
         return (
             len(
                 await User.find(
                     User.username == username,
                     session=self._current_session,
-                    collation=Collation(
-                        locale="en", strength=CollationStrength.SECONDARY
-                    ),
+                    collation=USERNAME_COLLATION,
                 )
                 .limit(1)
                 .to_list()
@@ -61,8 +152,150 @@ class UserService(BaseService):
             > 0
         )
 
+    async def search_users_by_username_prefix(
+        self, prefix: str, *, requester_id: PydanticObjectId, limit: int = 10
+    ) -> list[UserSearchResultSchema]:
+        """
+        Case-insensitive prefix search over usernames, backed by the collation index.
+        Friends go first, then users with a pending request and then everyone else.
+        Blocked users (in both directions) and the requester are excluded.
+        """
+        rank_by_user_id, blocked_user_ids = await self._get_search_ranks(requester_id)
+
+        candidates = {
+            candidate.id: candidate
+            for candidate in await self._get_username_prefix_candidates(prefix)
+        }
+        # The shared candidates are the first ones in alphabetical order, so the users
+        # the requester has a relationship with are looked up on their own. Otherwise
+        # a friend further down the alphabet would never be ranked first.
+        if rank_by_user_id:
+            for candidate in await self._find_users_by_username_prefix(
+                prefix, user_ids=list(rank_by_user_id)
+            ):
+                candidates[candidate.id] = candidate
+
+        ranked_candidates = sorted(
+            (
+                c
+                for c in candidates.values()
+                if c.id != requester_id and c.id not in blocked_user_ids
+            ),
+            key=lambda c: (
+                rank_by_user_id.get(c.id, _SEARCH_RANK_NO_RELATIONSHIP),
+                c.username.casefold(),
+            ),
+        )
+        return ranked_candidates[:limit]
+
+    async def _get_search_ranks(
+        self, requester_id: PydanticObjectId
+    ) -> tuple[dict[PydanticObjectId, int], set[PydanticObjectId]]:
+        relationships = await Relationship.find(
+            {
+                "$or": [
+                    {"initiator_user_id": requester_id},
+                    {"target.$id": requester_id},
+                ]
+            },
+            session=self._current_session,
+        ).to_list()
+
+        rank_by_user_id: dict[PydanticObjectId, int] = {}
+        blocked_user_ids: set[PydanticObjectId] = set()
+        for relationship in relationships:
+            partner_id = (
+                relationship.target.ref.id
+                if relationship.initiator_user_id == requester_id
+                else relationship.initiator_user_id
+            )
+            if relationship.type == RelationshipType.blocked:
+                blocked_user_ids.add(partner_id)
+            else:
+                rank_by_user_id[partner_id] = _SEARCH_RANK_BY_RELATIONSHIP_TYPE[
+                    relationship.type
+                ]
+        return rank_by_user_id, blocked_user_ids
+
+    async def _get_username_prefix_candidates(
+        self, prefix: str
+    ) -> list[UserSearchResultSchema]:
+        # The candidates don't depend on the requester, so hot prefixes
+        # typed by many users at the same time are shared in the cache
+        cache_key = f"users:search:prefix:{prefix.casefold()}"
+        if cached_candidates := await self._redis.get(cache_key):
+            return [
+                UserSearchResultSchema.model_validate(candidate)
+                for candidate in orjson.loads(cached_candidates)
+            ]
+
+        candidates = await self._find_users_by_username_prefix(prefix)
+        await self._redis.set(
+            cache_key,
+            orjson.dumps(
+                [
+                    candidate.model_dump(mode="json", by_alias=True)
+                    for candidate in candidates
+                ]
+            ),
+            ex=app_config.username_search_cache_ttl,
+        )
+        return candidates
+
+    async def _find_users_by_username_prefix(
+        self, prefix: str, *, user_ids: list[PydanticObjectId] | None = None
+    ) -> list[UserSearchResultSchema]:
+        filters: dict[str, Any] = {
+            "username": {
+                "$gte": prefix,
+                "$lt": prefix + _COLLATION_MAX_CHARACTER,
+            }
+        }
+        if user_ids is not None:
+            filters["_id"] = {"$in": user_ids}
+
+        return (
+            await User.find(
+                filters,
+                session=self._current_session,
+                collation=USERNAME_COLLATION,
+            )
+            .sort([(User.username, pymongo.ASCENDING)])
+            .limit(app_config.username_search_candidate_window)
+            .project(UserSearchResultSchema)
+            .to_list()
+        )
+
+    async def get_users_by_ids(
+        self, user_ids: list[PydanticObjectId]
+    ) -> list[UserPublicSchema | None]:
+        """
+        Return the public fields of the users in the order of `user_ids`, `None` for
+        the ones that don't exist. Users missing in the profile cache are fetched with
+        one query that projects only the public fields.
+        """
+        users_by_id: dict[PydanticObjectId, UserPublicSchema] = {}
+        missing_user_ids: list[PydanticObjectId] = []
+        for user_id in dict.fromkeys(user_ids):
+            if (user := self._profile_cache.get_by_id(user_id)) is not None:
+                users_by_id[user_id] = UserPublicSchema.model_validate(user)
+            else:
+                missing_user_ids.append(user_id)
+
+        if missing_user_ids:
+            for user in (
+                await User.find(
+                    In(User.id, missing_user_ids), session=self._current_session
+                )
+                .project(UserPublicSchema)
+                .to_list()
+            ):
+                users_by_id[user.id] = user
+
+        return [users_by_id.get(user_id) for user_id in user_ids]
+
     async def get_user_by_id(self, user_id: str) -> User | None:
-        return await User.get(user_id, fetch_links=True, session=self._current_session)
+        return await self._get_user_by_id(user_id)
 
     async def get_users_to_chat_with(self, email: str) -> list[User]:
         return await User.find(
@@ -70,19 +303,35 @@ class UserService(BaseService):
         ).to_list()
 
     async def get_user_by_email(self, email: str) -> User | None:
-        return await User.find_one(
-            {"email": email},
-            fetch_links=True,
-            session=self._current_session,
-        )
+        return await self._get_user_by_email(email)
 
-    async def get_user_by_account(self, provider_account_id: str) -> User | None:
-        account = await Account.find_one(
-            {"provider_account_id": provider_account_id},
-            fetch_links=True,
+    async def get_user_by_account(
+        self, provider_account_id: str, provider_name: str | None = None
+    ) -> User | None:
+        match_filter = {"provider_account_id": provider_account_id}
+        if provider_name is not None:
+            match_filter["provider_name"] = provider_name
+
+        # Joins the user on the server, so it's a single round trip to MongoDB
+        users = await Account.aggregate(
+            [
+                {"$match": match_filter},
+                {"$limit": 1},
+                {
+                    "$lookup": {
+                        "from": User.get_motor_collection().name,
+                        "localField": "user_id",
+                        "foreignField": "_id",
+                        "as": "user",
+                    }
+                },
+                {"$unwind": "$user"},
+                {"$replaceRoot": {"newRoot": "$user"}},
+            ],
+            projection_model=User,
             session=self._current_session,
-        )
-        return account.user if account else None
+        ).to_list()
+        return users[0] if users else None
 
     async def update_user(
         self,
@@ -95,26 +344,295 @@ class UserService(BaseService):
             raise BusinessLogicError("No data to update", "no_data_to_update")
 
         if image := data.pop("image", None):
-            image_url = await upload_file(
-                self._s3_client,
-                image,
-                return_public_url=True,
-                cache_file=False,
-                file_name_prefix=str(user_id),
+            data.update(await self._store_avatar(*await self._read_avatar(image)))
+
+        await User.find_one(User.id == user_id).update(
+            Set(map_raw_data_to_pydantic_fields(data, User)),
+            session=self._current_session,
+        )
+
+        await self._profile_cache.invalidate(user_id)
+
+        if username := data.get("username"):
+            await self._username_filter.add(username.casefold())
+
+    async def create_avatar_upload(
+        self, user_id: PydanticObjectId, content_type: str
+    ) -> AvatarUploadSchema:
+        """
+        Issue a pre-signed form for the client to upload a new avatar straight to S3,
+        it's applied by `complete_avatar_upload` once the upload is done. Uploads that
+        are never completed are deleted by `clean_up_avatar_uploads`.
+        """
+        key = f"{_AVATAR_UPLOAD_KEY_PREFIX}{user_id}/{uuid.uuid4().hex}"
+        presigned_post = await self._s3_storage.generate_presigned_post(
+            key,
+            content_type=content_type,
+            max_size=app_config.avatar_max_upload_size,
+            expires_in=app_config.avatar_upload_url_ttl,
+        )
+        return AvatarUploadSchema(
+            key=key,
+            url=presigned_post.url,
+            fields=presigned_post.fields,
+            max_size=app_config.avatar_max_upload_size,
+            expires_at=current_timeaware_utc_datetime()
+            + datetime.timedelta(seconds=app_config.avatar_upload_url_ttl),
+        )
+
+    async def complete_avatar_upload(self, user_id: PydanticObjectId, key: str) -> User:
+        if not key.startswith(f"{_AVATAR_UPLOAD_KEY_PREFIX}{user_id}/"):
+            raise BusinessLogicError("Unknown upload", "unknown_upload")
+
+        object_info = await self._s3_storage.get_object_info(key)
+        if object_info is None:
+            raise BusinessLogicError("The upload was not found", "upload_not_found")
+
+        try:
+            # S3 enforces the size already, it's checked again before the download
+            if object_info.size > app_config.avatar_max_upload_size:
+                raise BusinessLogicError("Image is too large", "image_too_large")
+
+            content = await self._s3_storage.download(key)
+            data = await self._store_avatar(
+                content, hashlib.sha256(content).hexdigest()
             )
-            data["image"] = image_url
+        finally:
+            # The uploaded original is never served, only the variants made from it
+            await self._s3_storage.delete(key)
 
         await User.find_one(User.id == user_id).update(
             Set(map_raw_data_to_pydantic_fields(data, User)),
             session=self._current_session,
         )
+        await self._profile_cache.invalidate(user_id)
+
+        user = await User.get(user_id, session=self._current_session)
+        if user is None:
+            raise BusinessLogicError("User not found", "user_not_found")
+        return user
+
+    @staticmethod
+    async def _read_avatar(image: UploadFile) -> tuple[bytes, str]:
+        """Read the uploaded image, hashing it on the way, and check its size."""
+        chunks = []
+        size = 0
+        digest = hashlib.sha256()
+        while chunk := await image.read(_AVATAR_READ_CHUNK_SIZE):
+            size += len(chunk)
+            if size > app_config.avatar_max_upload_size:
+                raise BusinessLogicError("Image is too large", "image_too_large")
+            digest.update(chunk)
+            chunks.append(chunk)
+
+        return b"".join(chunks), digest.hexdigest()
+
+    async def _store_avatar(self, content: bytes, digest: str) -> dict[str, Any]:
+        """
+        Make the avatar variants, upload them and return the fields of the user.
+        The same image uploaded again, like a popular default avatar, reuses the variants.
+
+        The variants of a replaced avatar are kept on purpose: other users may have
+        the same image, and its URLs may be cached by clients as immutable.
+        """
+        variants_key = f"{_AVATAR_VARIANTS_KEY_PREFIX}{digest}"
+        if cached_variants := await self._redis.get(variants_key):
+            variant_keys: dict[str, str] = orjson.loads(cached_variants)
+            # The objects are checked like the ones that are uploaded, in case
+            # the bucket was cleaned up since
+            if all(
+                await asyncio.gather(
+                    *(self._s3_storage.exists(key) for key in variant_keys.values())
+                )
+            ):
+                return _get_avatar_fields(
+                    {size: get_public_url(key) for size, key in variant_keys.items()}
+                )
+
+        try:
+            variants = await self._image_processor.make_avatar_variants(content)
+        except InvalidImageError as ex:
+            raise BusinessLogicError(
+                f"Invalid image: {ex.reason}", "invalid_image"
+            ) from None
+
+        # Keys are derived from the content, so the objects can be cached forever
+        s3_objects = [
+            S3Object(
+                key=f"avatars/{hashlib.sha256(variant.content).hexdigest()}.webp",
+                content=variant.content,
+                content_type=variant.content_type,
+            )
+            for variant in variants
+        ]
+        urls = await self._s3_storage.upload_objects(s3_objects, skip_existing=True)
+
+        await self._redis.set(
+            variants_key,
+            orjson.dumps(
+                {
+                    str(variant.size): s3_object.key
+                    for variant, s3_object in zip(variants, s3_objects, strict=True)
+                }
+            ),
+            ex=app_config.avatar_variants_cache_ttl,
+        )
+        return _get_avatar_fields(
+            {
+                str(variant.size): url
+                for variant, url in zip(variants, urls, strict=True)
+            }
+        )
+
+    async def maintain_username_filter(self) -> NoReturn:
+        """
+        Periodically rebuild the username filter, since usernames that are not taken anymore
+        can't be removed from it. Only one worker in the cluster rebuilds it per interval.
+        """
+        interval = app_config.username_filter_rebuild_interval
+        while True:
+            try:
+                if await self._redis.set(
+                    f"{_USERNAME_FILTER_KEY}:rebuilt", 1, nx=True, ex=interval
+                ):
+                    logger.info("Rebuilding the username filter...")
+                    await self._username_filter.rebuild(self._iterate_usernames())
+                    logger.info("The username filter was rebuilt")
+            except Exception:
+                logger.exception("Failed to rebuild the username filter")
+
+            await asyncio.sleep(interval)
+
+    async def clean_up_avatar_uploads(self) -> NoReturn:
+        """
+        Periodically delete the uploaded avatars that were never completed, since
+        nothing else removes them from the bucket. Only one worker in the cluster
+        cleans them up per interval.
+        """
+        interval = app_config.avatar_upload_cleanup_interval
+        while True:
+            try:
+                if await self._redis.set(
+                    _AVATAR_UPLOAD_CLEANUP_KEY, 1, nx=True, ex=interval
+                ):
+                    deleted_count = await self._s3_storage.delete_older_than(
+                        _AVATAR_UPLOAD_KEY_PREFIX,
+                        datetime.timedelta(seconds=app_config.avatar_upload_max_age),
+                    )
+                    if deleted_count:
+                        logger.info(
+                            "Deleted abandoned avatar uploads", count=deleted_count
+                        )
+            except Exception:
+                logger.exception("Failed to clean up the avatar uploads")
+
+            await asyncio.sleep(interval)
+
+    async def _iterate_usernames(self) -> AsyncIterator[str]:
+        async for user in User.get_motor_collection().find(
+            {"username": {"$ne": None}}, {"username": 1, "_id": 0}
+        ):
+            yield user["username"].casefold()
 
     async def delete_user(self, user_id: str) -> bool:
-        delete_result = await User.find_one(
-            compare_id(User.id, user_id), session=self._current_session
-        ).delete()
+        # Accounts are deleted along with the user, so that the user can sign up again
+        # right away. Everything else that references the user is deleted later
+        # by `UserDeletionService`
+        async with self.transaction():
+            accounts = await Account.find(
+                Account.user_id == PydanticObjectId(user_id),
+                session=self._current_session,
+            ).to_list()
+            delete_result = await User.find_one(
+                compare_id(User.id, user_id), session=self._current_session
+            ).delete()
+            if delete_result.deleted_count:
+                await Account.find(
+                    Account.user_id == PydanticObjectId(user_id),
+                    session=self._current_session,
+                ).delete()
+                await UserDeletionJob(user_id=PydanticObjectId(user_id)).insert(
+                    session=self._current_session
+                )
+
+        # Only once the accounts are gone, so that a request made meanwhile
+        # can't resolve the deleted user and cache it again
+        if delete_result.deleted_count:
+            await forget_resolved_user_ids(
+                self._redis, *(account.provider_account_id for account in accounts)
+            )
+        await self._profile_cache.invalidate(PydanticObjectId(user_id))
         return delete_result.deleted_count > 0
 
+    async def upsert_user_and_link_account(
+        self, user_data: UserInputSchema, account: AccountBaseScheme
+    ) -> User:
+        """
+        Resolve the user signing in with the account, creating the user and linking
+        the account if it's their first sign-in with it. The account is linked to an
+        existing user with the same email only if the provider has verified the email,
+        otherwise anyone who registers the email with some provider could take the user over.
+        """
+        for attempt in range(1, _ACCOUNT_UPSERT_ATTEMPTS + 1):
+            try:
+                user, is_new_user = await self._upsert_user_and_link_account(
+                    user_data, account
+                )
+            except OperationFailure as ex:
+                # The first sign-ins of the same user can run concurrently, and the one
+                # that loses the race on the unique indexes sees the other one's writes
+                # once it's retried
+                if not _is_write_conflict(ex) or attempt == _ACCOUNT_UPSERT_ATTEMPTS:
+                    raise
+                logger.info("Account sign-in conflicted, retrying...", attempt=attempt)
+            else:
+                break
+
+        if is_new_user and user.username:
+            await self._username_filter.add(user.username.casefold())
+        return user
+
+    async def _upsert_user_and_link_account(
+        self, user_data: UserInputSchema, account: AccountBaseScheme
+    ) -> tuple[User, bool]:
+        async with self.transaction():
+            user = await self.get_user_by_account(
+                account.provider_account_id, account.provider_name
+            )
+            if user is not None:
+                return user, False
+
+            # Retrying wouldn't help, the account would conflict with itself every time
+            if await Account.find_one(
+                Account.provider_account_id == account.provider_account_id,
+                Account.provider_name == account.provider_name,
+                session=self._current_session,
+            ):
+                raise BusinessLogicError(
+                    "The account is linked to a user that doesn't exist",
+                    "account_user_not_found",
+                )
+
+            user = await User.find_one(
+                User.email == user_data.email, session=self._current_session
+            )
+            is_new_user = user is None
+            if is_new_user:
+                user = await User(**user_data.model_dump()).create(
+                    session=self._current_session
+                )
+            elif user_data.email_verified_at is None:
+                raise BusinessLogicError(
+                    "The email is already used by another account, sign in with it "
+                    "to link this one",
+                    "account_not_linked",
+                )
+
+            await Account(**account.model_dump(), user_id=user.id, user=user).create(
+                session=self._current_session
+            )
+            return user, is_new_user
+
     async def link_account(self, user_id: str, account: AccountScheme):
         user = await User.get(user_id, fetch_links=False, session=self._current_session)
         if not user:
@@ -134,5 +652,19 @@ class UserService(BaseService):
             },
             session=self._current_session,
         ).delete()
+        await forget_resolved_user_ids(self._redis, provider_account_id)
 
     # TODO: Implement create_verification_token, get_verification_token, delete_verification_token
+
+
+def _is_write_conflict(ex: OperationFailure) -> bool:
+    if isinstance(ex, DuplicateKeyError):
+        return (ex.details or {}).get("keyPattern") in _SIGN_IN_RACE_INDEX_KEYS
+    return ex.has_error_label("TransientTransactionError")
+
+
+def _get_avatar_fields(image_variants: dict[str, str]) -> dict[str, Any]:
+    return {
+        "image": image_variants[str(max(AVATAR_SIZES))],
+        "image_variants": image_variants,
+    }
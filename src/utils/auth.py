@@ -1,13 +1,21 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import logging
+import math
+import time
 
+from typing import TYPE_CHECKING
 from typing import Annotated
 from typing import Any
+from typing import NoReturn
 
 import aiohttp
 import jwt
+import orjson
 
+from beanie import PydanticObjectId
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi.security import HTTPAuthorizationCredentials
@@ -21,8 +29,19 @@ from pydantic import BaseModel
 from pydantic import ConfigDict
 from pydantic import Field
 from pydantic import ValidationError
+from redis.asyncio import Redis
 
 from src.config import app_config
+from src.db.models import Account
+from src.db.models import User
+from src.services.user_loader import UserLoader
+from src.utils.cache import LRUCache
+from src.utils.depends import get_user_loader
+from src.utils.stub import DependencyStub
+
+
+if TYPE_CHECKING:
+    import pathlib
 
 
 logger = logging.getLogger(__name__)
@@ -36,25 +55,64 @@ class TokenInvalidError(Exception):
 
 
 class AsyncJWKClient(jwt.PyJWKClient):
-    async def fetch_data(self) -> Any:
-        jwk_set: Any = None
-        timeout = aiohttp.ClientTimeout(total=self.timeout)
+    """
+    Keeps the last fetched key set in memory. An expired key set is still served
+    while it's being refreshed, and also when Auth0 can't be reached, so an outage
+    there doesn't fail the requests with known keys. Concurrent refreshes share
+    a single request, and forced refreshes for unknown `kid`s are rate limited.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        *,
+        lifespan: float,
+        min_refresh_interval: float,
+        timeout: int,
+        snapshot_path: pathlib.Path | None = None,
+    ):
+        super().__init__(uri, cache_jwk_set=False, timeout=timeout)
+        self.lifespan = lifespan
+        self.min_refresh_interval = min_refresh_interval
+        self.snapshot_path = snapshot_path
+        self._session: aiohttp.ClientSession | None = None
+        self._jwk_set: PyJWKSet | None = None
+        # Monotonic time of the last successful fetch, `None` if not fetched yet
+        self._fetched_at: float | None = None
+        self._refresh_task: asyncio.Task[PyJWKSet] | None = None
+
+    async def start(self) -> None:
+        self._get_session()
+        if self._jwk_set is None and self.snapshot_path is not None:
+            await asyncio.to_thread(self._load_snapshot)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def run_refresher(self) -> NoReturn:
+        """Refresh the key set before it expires, so requests never wait for it."""
+        while True:
+            try:
+                await self._refresh()
+            except Exception:
+                logger.exception("Failed to refresh the JWK set")
+                await asyncio.sleep(self.min_refresh_interval)
+            else:
+                await asyncio.sleep(self.lifespan * 0.8)
 
+    async def fetch_data(self) -> Any:
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with await session.get(
-                    self.uri, headers=self.headers
-                ) as response:
-                    jwk_set = await response.json()
-        except aiohttp.ClientError as e:
+            async with self._get_session().get(
+                self.uri, headers=self.headers
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise PyJWKClientConnectionError(
                 f'Fail to fetch data from the url, err: "{e}"'
             ) from e
-        else:
-            return jwk_set
-        finally:
-            if self.jwk_set_cache is not None:
-                self.jwk_set_cache.put(jwk_set)
 
     async def get_signing_key(self, kid: str) -> PyJWK:
         signing_keys = await self.get_signing_keys()
@@ -88,62 +146,247 @@ class AsyncJWKClient(jwt.PyJWKClient):
         return signing_keys
 
     async def get_jwk_set(self, refresh: bool = False) -> PyJWKSet:
-        data = None
-        if self.jwk_set_cache is not None and not refresh:
-            data = self.jwk_set_cache.get()
-
-        if data is None:
-            data = await self.fetch_data()
+        if self._jwk_set is None:
+            return await self._refresh()
 
-        if not isinstance(data, dict):
-            raise PyJWKClientError(
-                "The JWKS endpoint did not return a JSON object"
-            ) from None
+        age = (
+            time.monotonic() - self._fetched_at
+            if self._fetched_at is not None
+            else math.inf
+        )
+        if refresh and age >= self.min_refresh_interval:
+            try:
+                return await self._refresh()
+            except PyJWKClientError:
+                logger.exception("Failed to refresh the JWK set, using the stale one")
+        elif age >= self.lifespan and self._refresh_task is None:
+            # Stale while revalidate, the refresh happens in the background
+            self._start_refresh().add_done_callback(self._log_refresh_error)
 
-        return PyJWKSet.from_dict(data)
+        return self._jwk_set
 
     async def get_signing_key_from_jwt(self, token: str) -> PyJWK:
         unverified = decode_complete(token, options={"verify_signature": False})
         header = unverified["header"]
         return await self.get_signing_key(header.get("kid"))
 
+    async def _refresh(self) -> PyJWKSet:
+        refresh_task = self._refresh_task or self._start_refresh()
+        # A cancelled request must not cancel the refresh shared with other requests
+        return await asyncio.shield(refresh_task)
+
+    def _start_refresh(self) -> asyncio.Task[PyJWKSet]:
+        self._refresh_task = asyncio.create_task(self._fetch_jwk_set())
+        return self._refresh_task
 
-_async_jwks_client = AsyncJWKClient(
-    f"https://{app_config.auth0_domain}/.well-known/jwks.json"
+    async def _fetch_jwk_set(self) -> PyJWKSet:
+        try:
+            data = await self.fetch_data()
+            if not isinstance(data, dict):
+                raise PyJWKClientError(
+                    "The JWKS endpoint did not return a JSON object"
+                ) from None
+
+            try:
+                self._jwk_set = PyJWKSet.from_dict(data)
+            except jwt.PyJWKSetError as e:
+                raise PyJWKClientError(str(e)) from e
+            self._fetched_at = time.monotonic()
+            if self.snapshot_path is not None:
+                # The snapshot is best-effort, the key set is in use already
+                try:
+                    await asyncio.to_thread(self._save_snapshot, data)
+                except Exception:
+                    logger.exception("Failed to save the JWK set snapshot")
+            return self._jwk_set
+        finally:
+            self._refresh_task = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    def _load_snapshot(self) -> None:
+        try:
+            self._jwk_set = PyJWKSet.from_dict(
+                orjson.loads(self.snapshot_path.read_bytes())
+            )
+        except FileNotFoundError:
+            return
+        except (orjson.JSONDecodeError, jwt.PyJWKSetError):
+            logger.exception("The JWK set snapshot is corrupted, ignoring it")
+            return
+
+        # `_fetched_at` stays unset, so the snapshot is refreshed on the first use
+        logger.info("Loaded the JWK set snapshot from %s", self.snapshot_path)
+
+    def _save_snapshot(self, data: dict[str, Any]) -> None:
+        # Written to a temporary file first, so a crash never leaves a partial snapshot
+        temporary_path = self.snapshot_path.with_suffix(".tmp")
+        temporary_path.write_bytes(orjson.dumps(data))
+        temporary_path.replace(self.snapshot_path)
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task[PyJWKSet]) -> None:
+        if not task.cancelled() and (error := task.exception()) is not None:
+            logger.error("Failed to refresh the JWK set: %s", error)
+
+
+jwks_client = AsyncJWKClient(
+    app_config.jwks_url or f"https://{app_config.auth0_domain}/.well-known/jwks.json",
+    lifespan=app_config.jwks_cache_lifespan,
+    min_refresh_interval=app_config.jwks_min_refresh_interval,
+    timeout=app_config.jwks_request_timeout,
+    snapshot_path=app_config.jwks_snapshot_path,
+)
+
+# Verified payloads by the token digest, so the signature of a token is checked once
+_verified_payloads: LRUCache[bytes, dict[str, Any]] = LRUCache(
+    maxsize=app_config.jwt_cache_maxsize, ttl=app_config.jwt_cache_max_ttl
 )
 
 
 class UserCredentials(BaseModel):
     provider_account_id: str = Field(alias="sub")
     email: str
+    # Resolved from the subject by the auth layer, `None` if the user isn't registered yet
+    user_id: PydanticObjectId | None = None
     model_config = ConfigDict(extra="allow")
 
 
 async def validate_jwt_token(
     auth_credentials: Annotated[
         HTTPAuthorizationCredentials, Depends(token_auth_scheme)
-    ]
+    ],
+    redis: Annotated[Redis, Depends(DependencyStub("redis"))],
 ):
     token = auth_credentials.credentials
     try:
-        return await get_token_payload(token)
+        return await get_token_payload(token, redis)
     except TokenInvalidError as e:
         logger.error("Invalid token: %s", e)
         raise HTTPException(status_code=401, detail="Invalid token") from None
 
 
-def get_current_user_credentials(
-    token_payload: Annotated[dict[str, str], Depends(validate_jwt_token)]
+async def get_current_user_credentials(
+    token_payload: Annotated[dict[str, str], Depends(validate_jwt_token)],
+    redis: Annotated[Redis, Depends(DependencyStub("redis"))],
 ) -> UserCredentials:
     try:
-        return UserCredentials(**token_payload)
+        user_credentials = UserCredentials(**token_payload)
     except ValidationError:
         raise HTTPException(status_code=401, detail="Invalid token") from None
 
+    user_credentials.user_id = await resolve_user_id(redis, user_credentials)
+    return user_credentials
+
+
+def _get_user_id_cache_key(subject: str) -> str:
+    return f"auth:sub:user_id:{subject}"
+
+
+async def resolve_user_id(
+    redis: Redis, user_credentials: UserCredentials
+) -> PydanticObjectId | None:
+    """
+    Map the token subject to the user id once and cache it, so that downstream code
+    can look up the user by the primary key instead of the email.
+    """
+    cache_key = _get_user_id_cache_key(user_credentials.provider_account_id)
+    if cached_user_id := await redis.get(cache_key):
+        return PydanticObjectId(cached_user_id.decode())
+
+    user_id: PydanticObjectId | None = None
+    if account := await Account.get_motor_collection().find_one(
+        {"provider_account_id": user_credentials.provider_account_id},
+        {"user_id": 1},
+    ):
+        user_id = account["user_id"]
+    elif user := await User.get_motor_collection().find_one(
+        {"email": user_credentials.email}, {"_id": 1}
+    ):
+        user_id = user["_id"]
+
+    # Don't cache misses: the user is usually registered right after the first request
+    if user_id is not None:
+        await redis.set(cache_key, str(user_id), ex=app_config.auth_user_id_cache_ttl)
+
+    return user_id
+
+
+async def forget_resolved_user_ids(redis: Redis, *subjects: str) -> None:
+    if subjects:
+        await redis.delete(*map(_get_user_id_cache_key, subjects))
+
+
+async def get_current_user(
+    user_credentials: Annotated[UserCredentials, Depends(get_current_user_credentials)],
+    user_loader: Annotated[UserLoader, Depends(get_user_loader)],
+) -> User:
+    if user_credentials.user_id is not None:
+        user = await user_loader.load_by_id(user_credentials.user_id)
+    else:
+        user = await user_loader.load_by_email(user_credentials.email)
+
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+async def get_token_payload(token: str, redis: Redis | None = None) -> dict[str, Any]:
+    """
+    Verify the token and return its payload. Verified payloads are cached until
+    the token expires, and shared between workers through Redis if it's enabled.
+    """
+    digest = _get_token_digest(token)
+    if (payload := _verified_payloads.get(digest)) is not None:
+        return payload.copy()
+
+    redis = redis if app_config.jwt_cache_shared else None
+    raw_payload = await redis.get(_get_payload_key(digest)) if redis else None
+    payload = orjson.loads(raw_payload) if raw_payload else await _verify_token(token)
+
+    # Tokens without `exp` or expiring right now aren't cached
+    if (ttl := _get_payload_cache_ttl(payload)) is not None:
+        _verified_payloads.set(digest, payload, ttl=ttl)
+        if redis is not None and not raw_payload:
+            await redis.set(
+                _get_payload_key(digest), orjson.dumps(payload), px=int(ttl * 1000)
+            )
+
+    return payload.copy()
+
+
+def _get_token_digest(token: str) -> bytes:
+    # Audience and issuer are part of the key, so a payload verified
+    # against another configuration is never reused
+    return hashlib.sha256(
+        f"{app_config.auth0_audience}\n{app_config.auth0_jwt_issuer}\n{token}".encode()
+    ).digest()
+
+
+def _get_payload_key(digest: bytes) -> str:
+    return f"auth:jwt:payload:{digest.hex()}"
+
+
+def _get_payload_cache_ttl(payload: dict[str, Any]) -> float | None:
+    expires_at = payload.get("exp")
+    if not isinstance(expires_at, int | float):
+        return None
+
+    # Same leeway as the verification, so a cached token is accepted exactly as long
+    ttl = min(
+        expires_at + app_config.jwt_leeway - time.time(), app_config.jwt_cache_max_ttl
+    )
+    return ttl if ttl > 0 else None
+
 
-async def get_token_payload(token: str) -> dict[str, str]:
+async def _verify_token(token: str) -> dict[str, Any]:
     try:
-        jwt_struct = await _async_jwks_client.get_signing_key_from_jwt(token)
+        jwt_struct = await jwks_client.get_signing_key_from_jwt(token)
     except jwt.PyJWKClientError as error:
         raise TokenInvalidError(str(error)) from error
     except jwt.DecodeError as error:
@@ -156,6 +399,7 @@ async def get_token_payload(token: str) -> dict[str, str]:
             algorithms=["RS256"],
             audience=app_config.auth0_audience,
             issuer=app_config.auth0_jwt_issuer,
+            leeway=app_config.jwt_leeway,
         )
     except Exception as e:
         raise TokenInvalidError(str(e)) from e
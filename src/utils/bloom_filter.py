@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import math
+
+from typing import TYPE_CHECKING
+from typing import Final
+
+from redis.asyncio import Redis
+
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterable
+
+
+_BATCH_SIZE: Final[int] = 1000
+
+# Bits are set in the main filter and in the one that is being rebuilt at the moment (if any),
+# otherwise the items added during a rebuild would be lost after the rename.
+# Missing filters are never created here: a partially filled filter would give false negatives.
+_ADD_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        for _, offset in ipairs(ARGV) do
+            redis.call('SETBIT', key, offset, 1)
+        end
+    end
+end
+"""
+
+
+def get_optimal_parameters(capacity: int, error_rate: float) -> tuple[int, int]:
+    """Return the number of bits and the number of hash functions for the given capacity"""
+    size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hash_count = max(1, round(size / capacity * math.log(2)))
+    return size, hash_count
+
+
+def get_bit_offsets(item: str, *, size: int, hash_count: int) -> list[int]:
+    # Kirsch-Mitzenmacher double hashing: k hash functions out of two 64-bit halves of one digest
+    digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+    first_hash = int.from_bytes(digest[:8], "little")
+    second_hash = int.from_bytes(digest[8:], "little")
+    return [(first_hash + i * second_hash) % size for i in range(hash_count)]
+
+
+class RedisBloomFilter:
+    """
+    Bloom filter stored in a plain Redis bitmap, so it doesn't require the RedisBloom module
+    and is shared between all the workers. A missing filter (e.g. before the first rebuild)
+    is treated as "might contain" by `might_contain`, so it never gives false negatives.
+    """
+
+    def __init__(self, redis: Redis, key: str, *, capacity: int, error_rate: float):
+        self._redis = redis
+        self._key = key
+        self._rebuild_key = f"{key}:rebuild"
+        self._size, self._hash_count = get_optimal_parameters(capacity, error_rate)
+        self._add_script = redis.register_script(_ADD_SCRIPT)
+
+    async def add(self, item: str) -> None:
+        await self._add_script(
+            keys=[self._key, self._rebuild_key], args=self._get_bit_offsets(item)
+        )
+
+    async def might_contain(self, item: str) -> bool:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.exists(self._key)
+            for offset in self._get_bit_offsets(item):
+                pipe.getbit(self._key, offset)
+            exists, *bits = await pipe.execute()
+
+        return not exists or all(bits)
+
+    async def rebuild(self, items: AsyncIterable[str]) -> None:
+        """Fill a new filter with the items and atomically replace the current one with it"""
+        await self._redis.delete(self._rebuild_key)
+        # Allocate the whole bitmap at once, it also makes the key "exist" for `add`
+        await self._redis.setbit(self._rebuild_key, self._size - 1, 0)
+
+        batch: list[int] = []
+        async for item in items:
+            batch.extend(self._get_bit_offsets(item))
+            if len(batch) >= _BATCH_SIZE * self._hash_count:
+                await self._set_bits(batch)
+                batch.clear()
+
+        if batch:
+            await self._set_bits(batch)
+
+        await self._redis.rename(self._rebuild_key, self._key)
+
+    async def _set_bits(self, offsets: list[int]) -> None:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for offset in offsets:
+                pipe.setbit(self._rebuild_key, offset, 1)
+            await pipe.execute()
+
+    def _get_bit_offsets(self, item: str) -> list[int]:
+        return get_bit_offsets(item, size=self._size, hash_count=self._hash_count)
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+
+from collections.abc import Awaitable
+from collections.abc import Callable
+from collections.abc import Hashable
+from collections.abc import Iterable
+from collections.abc import Mapping
+from typing import Generic
+from typing import TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class DataLoader(Generic[K, V]):
+    """
+    Collects all the keys requested during one iteration of the event loop and resolves
+    them with a single call of `batch_load_fn`. Results are cached for the lifetime
+    of the loader, so it's meant to be created per request.
+    """
+
+    def __init__(self, batch_load_fn: Callable[[list[K]], Awaitable[Mapping[K, V]]]):
+        self._batch_load_fn = batch_load_fn
+        self._futures: dict[K, asyncio.Future[V | None]] = {}
+        self._queue: list[K] = []
+        self._batch_tasks: set[asyncio.Task[None]] = set()
+
+    def load(self, key: K) -> asyncio.Future[V | None]:
+        if (future := self._futures.get(key)) is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[key] = future
+
+        if not self._queue:
+            loop.call_soon(self._dispatch_batch)
+        self._queue.append(key)
+
+        return future
+
+    async def load_many(self, keys: Iterable[K]) -> list[V | None]:
+        return await asyncio.gather(*(self.load(key) for key in keys))
+
+    def prime(self, key: K, value: V) -> None:
+        if key in self._futures:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        self._futures[key] = future
+
+    def _dispatch_batch(self) -> None:
+        keys, self._queue = self._queue, []
+        task = asyncio.create_task(self._load_batch(keys))
+        # Keep a strong reference, otherwise the task might be garbage collected mid-execution
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _load_batch(self, keys: list[K]) -> None:
+        try:
+            values = await self._batch_load_fn(keys)
+        except Exception as ex:
+            for key in keys:
+                # Don't cache failures, the next `load` of the key will try again
+                future = self._futures.pop(key)
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        for key in keys:
+            future = self._futures[key]
+            if not future.done():
+                future.set_result(values.get(key))
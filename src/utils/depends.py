@@ -1,14 +1,20 @@
 from __future__ import annotations
 
 from typing import TYPE_CHECKING
+from typing import Annotated
 
 
 if TYPE_CHECKING:
     import enum
 
+from fastapi import Depends
 from fastapi import Query
 from pydantic import create_model
 
+from src.services.user_loader import UserLoader
+from src.services.user_profile_cache import UserProfileCache
+from src.utils.stub import DependencyStub
+
 
 def int_enum_query(
     alias: str, enum_class: type[enum.IntEnum] | type[enum.IntFlag], **query_kwargs
@@ -31,3 +37,15 @@ def int_enum_query(
         return pydantic_model(enum=q).enum  # type: ignore[call-arg]
 
     return inner
+
+
+def get_user_loader(
+    profile_cache: Annotated[
+        UserProfileCache, Depends(DependencyStub("user_profile_cache"))
+    ]
+) -> UserLoader:
+    """
+    FastAPI caches dependencies per request, so everything that depends on this function
+    within one request (services, `get_current_user`) shares the same loader.
+    """
+    return UserLoader(profile_cache)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Final
+
+from PIL import Image
+from PIL import ImageOps
+from PIL import UnidentifiedImageError
+
+
+AVATAR_SIZES: Final[tuple[int, ...]] = (48, 128, 512)
+
+_ALLOWED_FORMATS: Final[frozenset[str]] = frozenset({"JPEG", "PNG", "WEBP", "GIF"})
+_WEBP_QUALITY: Final[int] = 85
+
+
+class InvalidImageError(Exception):
+    def __init__(self, reason: str):
+        # Passing the reason to the base class keeps the error picklable between processes
+        super().__init__(reason)
+        self.reason = reason
+
+
+@dataclass(frozen=True, slots=True)
+class ImageVariant:
+    size: int
+    content: bytes
+    content_type: str = "image/webp"
+
+
+def make_avatar_variants(
+    data: bytes, sizes: tuple[int, ...], max_pixels: int
+) -> list[ImageVariant]:
+    """
+    Decode and validate the image, then produce square WebP variants of the given sizes.
+    Metadata (EXIF, ICC profiles, comments) is not copied to the variants.
+    It's CPU-bound, so it's meant to be run in a worker process.
+    """
+    # Protects against decompression bombs, Pillow raises an error for bigger images
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format not in _ALLOWED_FORMATS:
+                raise InvalidImageError(f"Unsupported image format {image.format}")
+            image.verify()
+
+        # The image can't be used anymore after `verify`, so it has to be opened again
+        with Image.open(io.BytesIO(data)) as image:
+            # Apply the EXIF orientation before EXIF is dropped
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if _has_alpha(image) else "RGB")
+
+            variants = []
+            for size in sizes:
+                variant = ImageOps.fit(
+                    image, (size, size), method=Image.Resampling.LANCZOS
+                )
+                buffer = io.BytesIO()
+                variant.save(buffer, format="WEBP", quality=_WEBP_QUALITY)
+                variants.append(ImageVariant(size=size, content=buffer.getvalue()))
+    except UnidentifiedImageError:
+        raise InvalidImageError("Unknown image format") from None
+    except (Image.DecompressionBombError, OSError) as ex:
+        raise InvalidImageError(str(ex)) from None
+
+    return variants
+
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info
+
+
+class ImageProcessor:
+    """
+    Runs image processing in a bounded process pool, so that decoding and resizing
+    never block the event loop. At most `max_pending` images are queued at once,
+    which also bounds the memory taken by the uploaded bytes waiting for a worker.
+    """
+
+    def __init__(self, *, max_workers: int, max_pending: int, max_pixels: int):
+        self._max_workers = max_workers
+        self._max_pixels = max_pixels
+        self._pending_semaphore = asyncio.Semaphore(max_pending)
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self) -> None:
+        # Forking a process that already runs threads (motor, ddtrace) is unsafe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def make_avatar_variants(
+        self, data: bytes, sizes: tuple[int, ...] = AVATAR_SIZES
+    ) -> list[ImageVariant]:
+        if self._executor is None:
+            raise RuntimeError("Image processor is not started")
+
+        async with self._pending_semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, make_avatar_variants, data, sizes, self._max_pixels
+            )
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import bisect
+import math
+
+from typing import Any
+from typing import Final
+
+
+# Upper bounds of the buckets in seconds, the last bucket is unbounded
+DEFAULT_LATENCY_BUCKETS: Final[tuple[float, ...]] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class LatencyHistogram:
+    """
+    Counts of the observed durations by bucket, cheap enough to be updated on every
+    call. Percentiles are estimated as the upper bound of the bucket they fall into.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self._counts[bisect.bisect_left(self._buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, percentile: float) -> float | None:
+        if not self.count:
+            return None
+
+        rank = max(math.ceil(percentile / 100 * self.count), 1)
+        seen = 0
+        for bound, count in zip(self._buckets, self._counts, strict=False):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self) -> dict[str, Any]:
+        bounds = [*map(str, self._buckets), "+Inf"]
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": dict(zip(bounds, self._counts, strict=True)),
+        }
+
+    def reset(self) -> None:
+        self._counts = [0] * (len(self._buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
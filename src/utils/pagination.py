@@ -1,42 +1,68 @@
 from __future__ import annotations
 
 import base64
+import binascii
 import datetime
+import functools
+import hashlib
+import hmac
+import struct
 
 from typing import Any
+from typing import Final
 from typing import Generic
 from typing import TypeVar
 
+from bson import ObjectId
 from fastapi import HTTPException
 from fastapi import Query
 from pydantic import BaseModel
 from starlette.status import HTTP_400_BAD_REQUEST
 
+from src.config import app_config
+
 
 T = TypeVar("T", bound=type[BaseModel])
 
+# A cursor is `version | entity name | fields | signature`, base64url-encoded without
+# padding. Every string is prefixed with its length, and every value with its type tag.
+_CURSOR_VERSION: Final[int] = 1
+_SIGNATURE_SIZE: Final[int] = 16
+
+_TAG_FALSE: Final[int] = 1
+_TAG_TRUE: Final[int] = 2
+_TAG_INT: Final[int] = 3
+_TAG_FLOAT: Final[int] = 4
+_TAG_STR: Final[int] = 5
+_TAG_DATETIME: Final[int] = 6
+_TAG_OBJECT_ID: Final[int] = 7
+
+_INT = struct.Struct(">q")
+_FLOAT = struct.Struct(">d")
+_LENGTH = struct.Struct(">H")
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.UTC)
+
 
 def pagination(
     payload_pydantic_model: T, expected_entity_name: str, **next_cursor_kwargs: Any
 ):
-    def wrapper(next_cursor: str = Query(**next_cursor_kwargs)) -> T:
+    def wrapper(next_cursor: str | None = Query(**next_cursor_kwargs)) -> T:
+        if next_cursor is None:
+            try:
+                return next_cursor_kwargs["default"]
+            except KeyError:
+                raise HTTPException(
+                    status_code=HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
+                ) from None
+
         try:
             decoded_cursor = decode_pagination_cursor(
                 next_cursor, payload_pydantic_model
             )
-        except (ValueError, OverflowError, MemoryError) as e:
+        except ValueError as e:
             raise HTTPException(
                 status_code=HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
             ) from e
-        except (
-            TypeError
-        ):  # means it probably default to None and base64 complains about it
-            try:
-                return next_cursor_kwargs["default"]
-            except KeyError:
-                raise HTTPException(
-                    status_code=HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor"
-                ) from None
 
         if decoded_cursor.entity_name != expected_entity_name:
             raise HTTPException(
@@ -54,42 +80,124 @@ class Cursor(BaseModel, Generic[T]):
     payload: T
 
 
-def json_decoder_fallback(o: Any) -> Any:
-    if isinstance(o, datetime.date | datetime.datetime):
-        return o.isoformat()
+@functools.cache
+def _get_cursor_model(payload_pydantic_model: T) -> type[Cursor[T]]:
+    # Every parametrization creates a new model class, so it's done once per payload model
+    return Cursor[payload_pydantic_model]
 
 
 def encode_pagination_cursor(entity_name: str, **data: Any) -> str:
-    cursor_key_value_pairs = ",".join(
-        f"{key}|{value}" for key, value in data.items() if value
-    )
-    return base64.b64encode(f"{entity_name}:{cursor_key_value_pairs}".encode()).decode(
-        "utf-8"
-    )
+    # Missing fields get the defaults of the payload model, which are `None`
+    fields = {key: value for key, value in data.items() if value is not None}
+    parts = [bytes([_CURSOR_VERSION]), _pack_str(entity_name), bytes([len(fields)])]
+    for key, value in fields.items():
+        parts.append(_pack_str(key))
+        parts.append(_pack_value(value))
+
+    body = b"".join(parts)
+    return base64.urlsafe_b64encode(body + _sign(body)).rstrip(b"=").decode()
 
 
 def decode_pagination_cursor(
     encoded_cursor: str, payload_pydantic_model: T
 ) -> Cursor[T]:
-    decoded_str = base64.b64decode(encoded_cursor).decode("utf-8")
-
-    entity_name, _, payload = decoded_str.partition(":")
-
-    if not entity_name:
-        raise ValueError("Invalid cursor: entity name is missing")
-
-    if not payload:
-        raise ValueError("Invalid cursor: payload is missing")
+    try:
+        raw = base64.urlsafe_b64decode(
+            encoded_cursor + "=" * (-len(encoded_cursor) % 4)
+        )
+    except (binascii.Error, ValueError) as e:
+        raise ValueError("Invalid cursor: not base64url") from e
+
+    body, signature = raw[:-_SIGNATURE_SIZE], raw[-_SIGNATURE_SIZE:]
+    if len(raw) <= _SIGNATURE_SIZE or not hmac.compare_digest(signature, _sign(body)):
+        raise ValueError("Invalid cursor: signature mismatch")
+
+    try:
+        entity_name, payload = _unpack_body(body)
+    except (struct.error, IndexError, UnicodeDecodeError, OverflowError) as e:
+        raise ValueError("Invalid cursor: payload is malformed") from e
+
+    return _get_cursor_model(payload_pydantic_model).model_validate(
+        {"entity_name": entity_name, "payload": payload}
+    )
 
-    key_value_pairs = payload.split(",")
-    if key_value_pairs[0] == "":
-        raise ValueError("Invalid cursor: payload is invalid")
 
-    return Cursor[payload_pydantic_model].model_validate(
-        {
-            "entity_name": entity_name,
-            "payload": dict(
-                [tuple(key_value_pair.split("|")) for key_value_pair in key_value_pairs]
-            ),
-        }
-    )
+def _sign(body: bytes) -> bytes:
+    secret = app_config.pagination_cursor_secret.get_secret_value().encode()
+    return hmac.new(secret, body, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+
+
+def _pack_str(value: str) -> bytes:
+    encoded = value.encode()
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def _pack_value(value: Any) -> bytes:
+    # bool goes first, since it's a subclass of int
+    if isinstance(value, bool):
+        return bytes([_TAG_TRUE if value else _TAG_FALSE])
+    if isinstance(value, int):
+        return bytes([_TAG_INT]) + _INT.pack(value)
+    if isinstance(value, float):
+        return bytes([_TAG_FLOAT]) + _FLOAT.pack(value)
+    if isinstance(value, str):
+        return bytes([_TAG_STR]) + _pack_str(value)
+    if isinstance(value, datetime.datetime):
+        # Naive datetimes come from MongoDB and are in UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.UTC)
+        microseconds = (value - _EPOCH) // datetime.timedelta(microseconds=1)
+        return bytes([_TAG_DATETIME]) + _INT.pack(microseconds)
+    if isinstance(value, ObjectId):
+        return bytes([_TAG_OBJECT_ID]) + value.binary
+    raise TypeError(f"Type can't be stored in a cursor: {type(value).__name__}")
+
+
+def _unpack_body(body: bytes) -> tuple[str, dict[str, Any]]:
+    if body[0] != _CURSOR_VERSION:
+        raise ValueError("Invalid cursor: unknown version")
+
+    entity_name, offset = _unpack_str(body, 1)
+    fields_count = body[offset]
+    offset += 1
+
+    payload: dict[str, Any] = {}
+    for _ in range(fields_count):
+        key, offset = _unpack_str(body, offset)
+        payload[key], offset = _unpack_value(body, offset)
+
+    if offset != len(body):
+        raise ValueError("Invalid cursor: trailing data")
+    return entity_name, payload
+
+
+def _unpack_str(body: bytes, offset: int) -> tuple[str, int]:
+    (length,) = _LENGTH.unpack_from(body, offset)
+    start = offset + _LENGTH.size
+    if start + length > len(body):
+        raise ValueError("Invalid cursor: string is truncated")
+    return body[start : start + length].decode(), start + length
+
+
+def _unpack_value(body: bytes, offset: int) -> tuple[Any, int]:
+    tag = body[offset]
+    offset += 1
+    if tag in (_TAG_FALSE, _TAG_TRUE):
+        return tag == _TAG_TRUE, offset
+    if tag == _TAG_INT:
+        return _INT.unpack_from(body, offset)[0], offset + _INT.size
+    if tag == _TAG_FLOAT:
+        return _FLOAT.unpack_from(body, offset)[0], offset + _FLOAT.size
+    if tag == _TAG_STR:
+        return _unpack_str(body, offset)
+    if tag == _TAG_DATETIME:
+        (microseconds,) = _INT.unpack_from(body, offset)
+        return (
+            _EPOCH + datetime.timedelta(microseconds=microseconds),
+            offset + _INT.size,
+        )
+    if tag == _TAG_OBJECT_ID:
+        if offset + 12 > len(body):
+            raise ValueError("Invalid cursor: ObjectId is truncated")
+        return ObjectId(body[offset : offset + 12]), offset + 12
+    raise ValueError(f"Invalid cursor: unknown type tag {tag}")
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import math
+import time
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from typing import Literal
+
+import redis.exceptions
+import structlog
+
+from src.utils.cache import LRUCache
+
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+# Takes a token from the bucket at KEYS[1] if there is one. The bucket is refilled
+# continuously using the clock of Redis, so that all the app instances agree on it.
+# ARGV: capacity, tokens refilled per second.
+# Returns: whether a token was taken, tokens left, milliseconds until the bucket is full.
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1])
+local updated_at = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    updated_at = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_rate / 1000)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+
+local full_after = math.ceil((capacity - tokens) * 1000 / refill_rate)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', now)
+redis.call('PEXPIRE', KEYS[1], math.max(full_after, 1))
+return {allowed, tostring(tokens), full_after}
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimit:
+    """Up to `limit` hits at once, refilled at `limit` hits per `period` seconds."""
+
+    limit: int
+    period: float
+
+    @property
+    def refill_rate(self) -> float:
+        return self.limit / self.period
+
+
+@dataclass(frozen=True, slots=True)
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    # Seconds until the bucket is full again
+    reset_after: float
+    # Seconds until the next hit is allowed, 0 if this one was
+    retry_after: float
+
+    @classmethod
+    def from_bucket(
+        cls, rate_limit: RateLimit, *, allowed: bool, tokens: float, full_after: float
+    ) -> RateLimitResult:
+        return cls(
+            allowed=allowed,
+            limit=rate_limit.limit,
+            remaining=math.floor(tokens),
+            reset_after=full_after,
+            retry_after=0.0 if allowed else (1 - tokens) / rate_limit.refill_rate,
+        )
+
+    @property
+    def headers(self) -> dict[str, str]:
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(self.retry_after))
+        return headers
+
+
+class LocalTokenBucket:
+    """
+    Token buckets kept in the memory of this process. With several app instances every
+    one of them allows the full rate, so the limit is only approximate.
+    """
+
+    def __init__(self, maxsize: int):
+        # (tokens, monotonic time of the last update), dropped once the bucket is full
+        self._buckets: LRUCache[str, tuple[float, float]] = LRUCache(
+            maxsize=maxsize, ttl=0
+        )
+
+    def hit(self, key: str, rate_limit: RateLimit) -> RateLimitResult:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key) or (float(rate_limit.limit), now)
+        tokens = min(
+            rate_limit.limit, tokens + (now - updated_at) * rate_limit.refill_rate
+        )
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        full_after = (rate_limit.limit - tokens) / rate_limit.refill_rate
+        if full_after > 0:
+            self._buckets.set(key, (tokens, now), ttl=full_after)
+        else:
+            self._buckets.pop(key)
+
+        return RateLimitResult.from_bucket(
+            rate_limit, allowed=allowed, tokens=tokens, full_after=full_after
+        )
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter. In the `redis` mode the buckets are shared by all the
+    app instances, and if Redis is unavailable the local buckets are used instead.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        *,
+        mode: Literal["redis", "local"] = "redis",
+        local_maxsize: int = 100_000,
+        key_prefix: str = "ratelimit",
+    ):
+        self._mode = mode
+        self._key_prefix = key_prefix
+        self._local_bucket = LocalTokenBucket(maxsize=local_maxsize)
+        self._script = redis.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    async def hit(self, key: str, rate_limit: RateLimit) -> RateLimitResult:
+        if self._mode == "local":
+            return self._local_bucket.hit(key, rate_limit)
+
+        try:
+            allowed, tokens, full_after_ms = await self._script(
+                keys=[f"{self._key_prefix}:{key}"],
+                args=[rate_limit.limit, rate_limit.refill_rate],
+            )
+        except redis.exceptions.RedisError:
+            logger.warning("Falling back to the local rate limiter", exc_info=True)
+            return self._local_bucket.hit(key, rate_limit)
+
+        return RateLimitResult.from_bucket(
+            rate_limit,
+            allowed=bool(allowed),
+            tokens=float(tokens),
+            full_after=int(full_after_ms) / 1000,
+        )
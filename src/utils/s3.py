@@ -1,42 +1,263 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
+import datetime
 import time
 
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from typing import Final
+from typing import NoReturn
+
 import aioboto3
+import structlog
 
-from fastapi import UploadFile
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
 
 from src.config import app_config
+from src.utils.cache import LRUCache
+from src.utils.metrics import LatencyHistogram
+
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+    from collections.abc import Sequence
+
+    from aiobotocore.client import AioBaseClient
+
+
+# For objects whose key is derived from their content, so the key changes with the content
+IMMUTABLE_CACHE_CONTROL: Final[str] = "public, max-age=31536000, immutable"
+
+# The most keys a single DeleteObjects request accepts
+_DELETE_BATCH_SIZE: Final[int] = 1000
+# Content-addressed objects aren't deleted, but it's rechecked now and then in case a bucket
+# is cleaned up
+_KNOWN_KEYS_TTL: Final[int] = 60 * 60
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class S3Object:
+    key: str
+    content: bytes
+    content_type: str
+
+
+@dataclass(frozen=True, slots=True)
+class PresignedPost:
+    url: str
+    # Form fields that have to be sent along with the file
+    fields: dict[str, str]
+
+
+@dataclass(frozen=True, slots=True)
+class S3ObjectInfo:
+    size: int
+    content_type: str | None
+
+
+class S3Storage:
+    """
+    Long-lived S3 client shared by all the requests, so the credentials, the endpoint
+    and the connection pool are set up once. It's opened and closed by the app lifespan.
+
+    The credentials need `s3:ListBucket` on the bucket, without it S3 answers HEAD
+    requests for missing keys with 403 rather than 404. A 403 is taken as a missing
+    object, so the existing objects would be uploaded again instead of being skipped.
+    """
+
+    def __init__(
+        self,
+        boto3_session: aioboto3.Session,
+        *,
+        bucket_name: str,
+        endpoint_url: str | None = None,
+        max_pool_connections: int,
+        connect_timeout: float,
+        read_timeout: float,
+        max_attempts: int,
+        known_keys_cache_size: int = 10_000,
+    ):
+        self._boto3_session = boto3_session
+        self._bucket_name = bucket_name
+        self._endpoint_url = endpoint_url
+        self._config = AioConfig(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={"max_attempts": max_attempts, "mode": "standard"},
+        )
+        self._exit_stack = contextlib.AsyncExitStack()
+        self._client: AioBaseClient | None = None
+        # Content-addressed keys that are known to be stored already
+        self._known_keys: LRUCache[str, bool] = LRUCache(
+            maxsize=known_keys_cache_size, ttl=_KNOWN_KEYS_TTL
+        )
+        # Latency of every call to S3 by the operation
+        self.latencies: defaultdict[str, LatencyHistogram] = defaultdict(
+            LatencyHistogram
+        )
+
+    async def start(self) -> None:
+        self._client = await self._exit_stack.enter_async_context(
+            self._boto3_session.client(
+                "s3", endpoint_url=self._endpoint_url, config=self._config
+            )
+        )
+
+    async def close(self) -> None:
+        await self._exit_stack.aclose()
+        self._client = None
+
+    @property
+    def client(self) -> AioBaseClient:
+        if self._client is None:
+            raise RuntimeError("S3 storage is not started")
+        return self._client
 
+    async def upload_objects(
+        self,
+        objects: Sequence[S3Object],
+        *,
+        cache_control: str = IMMUTABLE_CACHE_CONTROL,
+        skip_existing: bool = False,
+    ) -> list[str]:
+        """
+        Upload the objects concurrently and return their public URLs. `skip_existing`
+        is meant for keys derived from the content, the objects that are stored
+        already aren't uploaded again.
+        """
+        await asyncio.gather(
+            *(
+                self._put_object(s3_object, cache_control, skip_existing=skip_existing)
+                for s3_object in objects
+            )
+        )
+        return [get_public_url(s3_object.key) for s3_object in objects]
 
-# TODO implement pre-signed url upload when public_url is False
-async def upload_file(
-    boto3_session: aioboto3.Session,
-    file: UploadFile,
-    *,
-    return_public_url: bool,
-    cache_file: bool = True,
-    file_name_prefix: str | None = None,
-) -> str:
-    file_descriptor = file.file
-    extra_args = {
-        "ContentType": file.content_type,
-    }
-    file_name = file.filename
-
-    if file_name_prefix:
-        file_name = f"{file_name_prefix}-{file_name}"
-
-    if not cache_file:
-        extra_args["CacheControl"] = "max-age=0, must-revalidate"
-
-    async with boto3_session.client("s3") as s3:
-        await file.seek(0)
-        await s3.upload_fileobj(
-            file_descriptor,
-            app_config.s3_bucket_name,
-            file_name,
-            ExtraArgs=extra_args,
+    async def generate_presigned_post(
+        self, key: str, *, content_type: str, max_size: int, expires_in: int
+    ) -> PresignedPost:
+        """
+        Let a client upload an object straight to S3. The policy pins the key and the
+        content type, and S3 rejects uploads larger than `max_size` bytes.
+        """
+        presigned_post = await self.client.generate_presigned_post(
+            Bucket=self._bucket_name,
+            Key=key,
+            Fields={"Content-Type": content_type},
+            Conditions=[
+                {"Content-Type": content_type},
+                ["content-length-range", 1, max_size],
+            ],
+            ExpiresIn=expires_in,
         )
+        return PresignedPost(url=presigned_post["url"], fields=presigned_post["fields"])
+
+    async def get_object_info(self, key: str) -> S3ObjectInfo | None:
+        try:
+            async with self._measure("head_object"):
+                response = await self.client.head_object(
+                    Bucket=self._bucket_name, Key=key
+                )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] in ("403", "404", "NoSuchKey"):
+                return None
+            raise
+
+        return S3ObjectInfo(
+            size=response["ContentLength"], content_type=response.get("ContentType")
+        )
+
+    async def exists(self, key: str) -> bool:
+        """Whether the object is stored, the keys that are found are remembered for a while."""
+        if self._known_keys.get(key):
+            return True
+
+        exists = await self.get_object_info(key) is not None
+        if exists:
+            self._known_keys.set(key, True)
+        return exists
+
+    async def download(self, key: str) -> bytes:
+        async with self._measure("get_object"):
+            response = await self.client.get_object(Bucket=self._bucket_name, Key=key)
+            async with response["Body"] as body:
+                return await body.read()
+
+    async def delete(self, key: str) -> None:
+        async with self._measure("delete_object"):
+            await self.client.delete_object(Bucket=self._bucket_name, Key=key)
+
+    async def delete_older_than(self, prefix: str, max_age: datetime.timedelta) -> int:
+        """Delete the objects under the prefix that were stored before `max_age` ago."""
+        stored_before = datetime.datetime.now(datetime.UTC) - max_age
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=self._bucket_name, Prefix=prefix):
+            keys.extend(
+                s3_object["Key"]
+                for s3_object in page.get("Contents", [])
+                if s3_object["LastModified"] < stored_before
+            )
+
+        for start in range(0, len(keys), _DELETE_BATCH_SIZE):
+            async with self._measure("delete_objects"):
+                await self.client.delete_objects(
+                    Bucket=self._bucket_name,
+                    Delete={
+                        "Objects": [
+                            {"Key": key}
+                            for key in keys[start : start + _DELETE_BATCH_SIZE]
+                        ],
+                        "Quiet": True,
+                    },
+                )
+        return len(keys)
+
+    async def report_stats(self, interval: float) -> NoReturn:
+        while True:
+            await asyncio.sleep(interval)
+            for operation, histogram in self.latencies.items():
+                if histogram.count:
+                    logger.info(
+                        "S3 latency", operation=operation, **histogram.snapshot()
+                    )
+                    histogram.reset()
+
+    async def _put_object(
+        self, s3_object: S3Object, cache_control: str, *, skip_existing: bool
+    ) -> None:
+        if skip_existing and await self.exists(s3_object.key):
+            return
+
+        async with self._measure("put_object"):
+            await self.client.put_object(
+                Bucket=self._bucket_name,
+                Key=s3_object.key,
+                Body=s3_object.content,
+                ContentType=s3_object.content_type,
+                CacheControl=cache_control,
+            )
+        if skip_existing:
+            self._known_keys.set(s3_object.key, True)
+
+    @contextlib.asynccontextmanager
+    async def _measure(self, operation: str) -> AsyncIterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latencies[operation].observe(time.perf_counter() - started_at)
+
 
-    return f"https://{app_config.s3_bucket_name}.s3.amazonaws.com/{file_name}?timestamp={int(time.time())}"
+def get_public_url(key: str) -> str:
+    if app_config.s3_endpoint_url:
+        # S3-compatible stand-ins, like MinIO, serve the buckets as path prefixes
+        return f"{app_config.s3_endpoint_url.rstrip('/')}/{app_config.s3_bucket_name}/{key}"
+    return f"https://{app_config.s3_bucket_name}.s3.amazonaws.com/{key}"
@@ -15,6 +15,9 @@ from pydantic import BaseModel
 from pydantic import ValidationError
 from starlette.requests import Request
 
+from src.config import app_config
+from src.utils.rate_limit import RateLimiter
+
 
 T = TypeVar("T")
 P = ParamSpec("P")
@@ -70,6 +73,41 @@ def validate_data(
     return decorator
 
 
+def rate_limit(
+    event_name: str,
+    *,
+    get_rate_limiter: Callable[[], RateLimiter],
+    get_key: Callable[[str], str],
+) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    """
+    Limits how often the event can be handled per `get_key(sid)`, using the limit
+    configured for the event name. A limited event isn't handled, and the client
+    gets an error instead if it asked for an acknowledgement.
+    """
+    limit = app_config.rate_limit_socketio_events.get(
+        event_name, app_config.rate_limit_socketio_default
+    )
+
+    def decorator(func: Callable[P, T]) -> Callable[P, T]:
+        if limit is None:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            sid: str = args[0]
+            result = await get_rate_limiter().hit(
+                f"socketio:{event_name}:{get_key(sid)}", limit
+            )
+            if not result.allowed:
+                return {"error": "rate_limited", "retry_after": result.retry_after}
+
+            return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def _trim_arguments(
     func: Callable[..., Any],
     args: tuple[Any, ...],
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+
+from collections import deque
+from typing import TYPE_CHECKING
+
+import structlog
+
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable
+    from collections.abc import Callable
+
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+class OverflowPolicy(enum.StrEnum):
+    drop = enum.auto()
+    disconnect = enum.auto()
+
+
+class _Connection:
+    __slots__ = ("lanes", "active_lanes", "queued")
+
+    def __init__(self):
+        # Pending handlers by event name, events of the same name run one after another
+        self.lanes: dict[str, deque[Callable[[], Awaitable[None]]]] = {}
+        self.active_lanes: set[str] = set()
+        self.queued = 0
+
+
+class EventDispatcher:
+    """
+    Runs the handlers of incoming events. Events of the same name from a connection are
+    handled in the order they arrived, at most `concurrency_per_connection` events of
+    different names from a connection are handled at once, and at most `concurrency`
+    events in total. Once `queue_depth` events of a connection are waiting, the next
+    ones are dropped or the connection is closed, depending on `overflow_policy`.
+    """
+
+    def __init__(
+        self,
+        *,
+        concurrency_per_connection: int,
+        queue_depth: int,
+        concurrency: int,
+        overflow_policy: OverflowPolicy,
+        disconnect: Callable[[str], Awaitable[None]],
+    ):
+        self._concurrency_per_connection = concurrency_per_connection
+        self._queue_depth = queue_depth
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._overflow_policy = overflow_policy
+        self._disconnect = disconnect
+        self._connections: dict[str, _Connection] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def submit(
+        self, sid: str, event_name: str, handler: Callable[[], Awaitable[None]]
+    ) -> bool:
+        """Queue the handler, returns `False` if the queue of the connection is full."""
+        connection = self._connections.setdefault(sid, _Connection())
+        if connection.queued >= self._queue_depth:
+            self._handle_overflow(sid, event_name)
+            return False
+
+        connection.lanes.setdefault(event_name, deque()).append(handler)
+        connection.queued += 1
+        self._start_lanes(sid, connection)
+        return True
+
+    def discard(self, sid: str) -> None:
+        """Drop the events of a closed connection that haven't been handled yet."""
+        connection = self._connections.pop(sid, None)
+        if connection is not None:
+            # Lanes that are running right now stop after their current handler
+            for lane in connection.lanes.values():
+                lane.clear()
+            connection.queued = 0
+
+    def _start_lanes(self, sid: str, connection: _Connection) -> None:
+        for event_name, lane in connection.lanes.items():
+            if len(connection.active_lanes) >= self._concurrency_per_connection:
+                return
+            if lane and event_name not in connection.active_lanes:
+                connection.active_lanes.add(event_name)
+                task = asyncio.create_task(self._run_lane(sid, connection, event_name))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run_lane(
+        self, sid: str, connection: _Connection, event_name: str
+    ) -> None:
+        lane = connection.lanes[event_name]
+        try:
+            while lane:
+                handler = lane.popleft()
+                connection.queued -= 1
+                async with self._semaphore:
+                    try:
+                        await handler()
+                    except Exception:
+                        logger.exception(
+                            "Event handler failed", sid=sid, event_name=event_name
+                        )
+        finally:
+            connection.active_lanes.discard(event_name)
+            if not lane:
+                connection.lanes.pop(event_name, None)
+
+        if self._connections.get(sid) is connection:
+            self._start_lanes(sid, connection)
+
+    def _handle_overflow(self, sid: str, event_name: str) -> None:
+        logger.warning(
+            "Too many events are queued for the connection",
+            sid=sid,
+            event_name=event_name,
+            policy=self._overflow_policy,
+        )
+        if self._overflow_policy == OverflowPolicy.disconnect:
+            self.discard(sid)
+            task = asyncio.create_task(self._disconnect(sid))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
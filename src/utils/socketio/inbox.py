@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import re
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Final
+
+from src.utils.socketio.serializer import RawJSON
+from src.utils.socketio.serializer import dumps
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from redis.asyncio import Redis
+
+
+# Event that carries the events a user missed while being offline
+INBOX_REPLAY_EVENT_NAME: Final[str] = "inbox:replay"
+
+_INBOX_KEY_PREFIX: Final[str] = "socketio:inbox:"
+_STREAM_ID_PATTERN = re.compile(r"(\d+)-(\d+)")
+
+
+def _get_inbox_key(email: str) -> str:
+    return f"{_INBOX_KEY_PREFIX}{email}"
+
+
+def is_valid_event_id(event_id: str) -> bool:
+    return _STREAM_ID_PATTERN.fullmatch(event_id) is not None
+
+
+def _get_next_event_id(event_id: str) -> str:
+    timestamp, sequence = _STREAM_ID_PATTERN.fullmatch(event_id).groups()
+    return f"{timestamp}-{int(sequence) + 1}"
+
+
+@dataclass(frozen=True, slots=True)
+class InboxEvent:
+    id: str
+    event_name: str
+    data: RawJSON
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"id": self.id, "event": self.event_name, "data": self.data}
+
+
+class EventInbox:
+    """
+    Events emitted to users who weren't connected, kept in a Redis stream per user.
+    Every stream keeps about the last `maxlen` events, and is dropped once nothing
+    was added to it for `ttl` seconds. Clients present the ID of the last event they
+    have seen when they reconnect (`0-0` if they haven't seen any), and get the events
+    that came after it, while the events up to it are removed.
+    """
+
+    def __init__(self, redis: Redis, *, maxlen: int, ttl: int):
+        self._redis = redis
+        self._maxlen = maxlen
+        self._ttl = ttl
+
+    async def append_many(self, events: Iterable[tuple[str, str, Any]]) -> None:
+        """Store the `(email, event name, data)` events in the inboxes of their users."""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for email, event_name, data in events:
+                key = _get_inbox_key(email)
+                pipe.xadd(
+                    key,
+                    {"event": event_name, "data": dumps(data)},
+                    maxlen=self._maxlen,
+                    approximate=True,
+                )
+                pipe.expire(key, self._ttl)
+            if pipe:
+                await pipe.execute()
+
+    async def read_since(self, email: str, last_event_id: str) -> list[InboxEvent]:
+        """Acknowledge the events up to `last_event_id`, and read the ones after it."""
+        key = _get_inbox_key(email)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            # MINID keeps the entries from the given ID on, so the last seen one
+            # is removed as well
+            pipe.xtrim(key, minid=_get_next_event_id(last_event_id), approximate=False)
+            # "(" makes the range exclusive, so the last seen event isn't sent again
+            pipe.xrange(key, min=f"({last_event_id}", count=self._maxlen)
+            _, entries = await pipe.execute()
+        return [
+            InboxEvent(
+                id=entry_id.decode(),
+                event_name=fields[b"event"].decode(),
+                data=RawJSON(fields[b"data"]),
+            )
+            for entry_id, fields in entries
+        ]
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+from typing import Any
+
+import msgpack
+import orjson
+
+from pydantic import BaseModel
+from socketio.msgpack_packet import MsgPackPacket
+
+from src.utils.socketio.serializer import RawJSON
+
+
+def _default(obj: Any) -> Any:
+    # msgpack can't embed JSON, so pre-encoded payloads have to be decoded once here
+    if isinstance(obj, RawJSON):
+        return orjson.loads(obj.data)
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    raise TypeError(f"Type is not msgpack serializable: {type(obj).__name__}")
+
+
+class RawJSONMsgPackPacket(MsgPackPacket):
+    def encode(self) -> bytes:
+        return msgpack.dumps(self._to_dict(), default=_default)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from typing import TYPE_CHECKING
+from typing import Final
+from typing import NoReturn
+
+import structlog
+
+from redis.asyncio import Redis
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+_PRESENCE_KEY_PREFIX: Final[str] = "socketio:presence:"
+_SWEEP_LOCK_KEY: Final[str] = "socketio:presence_sweep_lock"
+
+logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+
+
+def get_user_room(email: str) -> str:
+    """Room that every connection of the user joins."""
+    return f"user:{email}"
+
+
+def _get_presence_key(email: str) -> str:
+    return f"{_PRESENCE_KEY_PREFIX}{email}"
+
+
+class PresenceRegistry:
+    """
+    Tracks the connections of every user across all workers. Each user has a sorted set
+    of their sids scored by the time the sid expires at, so a user can be connected from
+    several devices at once. Every worker keeps extending the expiration of its own sids,
+    so the sids of a crashed worker expire on their own and get swept.
+    """
+
+    def __init__(self, redis: Redis, *, ttl: int, heartbeat_interval: int):
+        self._redis = redis
+        self._ttl = ttl
+        self._heartbeat_interval = heartbeat_interval
+        # Connections handled by this worker, it's what the heartbeat extends
+        self._local_emails_by_sid: dict[str, str] = {}
+
+    async def add(self, email: str, sid: str) -> None:
+        self._local_emails_by_sid[sid] = email
+        key = _get_presence_key(email)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {sid: time.time() + self._ttl})
+            pipe.expire(key, self._ttl)
+            await pipe.execute()
+
+    async def remove(self, email: str, sid: str) -> None:
+        self._local_emails_by_sid.pop(sid, None)
+        await self._redis.zrem(_get_presence_key(email), sid)
+
+    async def get_sids(self, email: str) -> list[str]:
+        sids = await self._redis.zrangebyscore(
+            _get_presence_key(email), time.time(), "+inf"
+        )
+        return [sid.decode() for sid in sids]
+
+    async def get_sids_many(self, emails: Iterable[str]) -> dict[str, list[str]]:
+        emails = list(dict.fromkeys(emails))
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for email in emails:
+                pipe.zrangebyscore(_get_presence_key(email), now, "+inf")
+            results = await pipe.execute()
+
+        return {
+            email: [sid.decode() for sid in sids]
+            for email, sids in zip(emails, results, strict=True)
+        }
+
+    def is_local(self, sid: str) -> bool:
+        """Whether the connection is handled by this worker."""
+        return sid in self._local_emails_by_sid
+
+    async def is_online(self, email: str) -> bool:
+        return (
+            await self._redis.zcount(_get_presence_key(email), time.time(), "+inf") > 0
+        )
+
+    async def are_online(self, emails: Iterable[str]) -> dict[str, bool]:
+        emails = list(dict.fromkeys(emails))
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for email in emails:
+                pipe.zcount(_get_presence_key(email), now, "+inf")
+            counts = await pipe.execute()
+
+        return {email: count > 0 for email, count in zip(emails, counts, strict=True)}
+
+    async def maintain(self) -> NoReturn:
+        """
+        Extend the expiration of the local sids, and sweep the expired ones. Sweeping
+        is done by one worker per interval, since it has to scan all the keys.
+        """
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            try:
+                await self._send_heartbeat()
+                if await self._redis.set(
+                    _SWEEP_LOCK_KEY, 1, nx=True, ex=self._heartbeat_interval
+                ):
+                    await self._sweep_expired()
+            except Exception:
+                logger.exception("Failed to maintain the presence registry")
+
+    async def _send_heartbeat(self) -> None:
+        if not self._local_emails_by_sid:
+            return
+
+        expires_at = time.time() + self._ttl
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for sid, email in self._local_emails_by_sid.items():
+                key = _get_presence_key(email)
+                # `xx`, so a sid removed meanwhile by `remove` isn't added back
+                pipe.zadd(key, {sid: expires_at}, xx=True)
+                pipe.expire(key, self._ttl)
+            await pipe.execute()
+
+    async def _sweep_expired(self) -> None:
+        now = time.time()
+        async for key in self._redis.scan_iter(
+            match=f"{_PRESENCE_KEY_PREFIX}*", count=1000, _type="zset"
+        ):
+            await self._redis.zremrangebyscore(key, "-inf", now)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Literal
+
+import orjson
+
+from pydantic import BaseModel
+from socketio.packet import Packet
+
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+class RawJSON:
+    """
+    Payload that is already encoded to JSON. It's embedded into packets as is, and it's
+    cheap to pickle, so a payload is encoded once even if it's sent through Redis.
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    @classmethod
+    def from_model(cls, model: BaseModel) -> RawJSON:
+        return cls(model.model_dump_json().encode())
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, RawJSON) and self.data == other.data
+
+    def __hash__(self) -> int:
+        return hash(self.data)
+
+
+def to_payload(data: BaseModel | Any) -> RawJSON | Any:
+    return RawJSON.from_model(data) if isinstance(data, BaseModel) else data
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, RawJSON):
+        return orjson.Fragment(obj.data)
+    if isinstance(obj, BaseModel):
+        return orjson.Fragment(obj.model_dump_json())
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj: Any, *, sort_keys: bool = False) -> bytes:
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+class OrjsonModule:
+    """Drop-in replacement of the `json` module for python-socketio and python-engineio."""
+
+    JSONDecodeError = orjson.JSONDecodeError
+
+    @staticmethod
+    def dumps(obj: Any, **_: Any) -> str:
+        # Keyword arguments like `separators` are ignored, orjson output is always compact
+        return dumps(obj).decode()
+
+    loads: Callable[[bytes | str], Any] = staticmethod(orjson.loads)
+
+
+def get_packet_class(serializer: Literal["json", "msgpack"]) -> type[Packet]:
+    if serializer == "msgpack":
+        # msgpack is an optional dependency, so it's imported only when it's enabled
+        from src.utils.socketio.msgpack_packet import RawJSONMsgPackPacket
+
+        return RawJSONMsgPackPacket
+
+    return Packet
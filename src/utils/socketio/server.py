@@ -1,9 +1,22 @@
 from __future__ import annotations
 
+import functools
+
+from typing import TYPE_CHECKING
+
 import socketio
 
 from rodi import Services
 
+from src.utils.socketio.dispatcher import EventDispatcher
+from src.utils.socketio.dispatcher import OverflowPolicy
+from src.utils.socketio.session import SessionStore
+
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable
+    from collections.abc import Callable
+
 
 class AsyncSocketIOServer(socketio.AsyncServer):
     services: Services
@@ -15,6 +28,11 @@ class AsyncSocketIOServer(socketio.AsyncServer):
         json=None,
         async_handlers=True,
         namespaces=None,
+        *,
+        handler_concurrency_per_connection: int = 4,
+        handler_queue_depth: int = 64,
+        handler_concurrency: int = 256,
+        handler_overflow_policy: OverflowPolicy = OverflowPolicy.drop,
         **kwargs,
     ):
         super().__init__(
@@ -25,3 +43,48 @@ class AsyncSocketIOServer(socketio.AsyncServer):
             namespaces=namespaces,
             **kwargs,
         )
+        self.sessions = SessionStore()
+        self.dispatcher = EventDispatcher(
+            concurrency_per_connection=handler_concurrency_per_connection,
+            queue_depth=handler_queue_depth,
+            concurrency=handler_concurrency,
+            overflow_policy=handler_overflow_policy,
+            disconnect=self.disconnect,
+        )
+        self._connected_handlers: list[Callable[[str], Awaitable[None]]] = []
+
+    def on_connected(
+        self, handler: Callable[[str], Awaitable[None]]
+    ) -> Callable[[str], Awaitable[None]]:
+        """Register a handler that's called with the sid once a connection is acknowledged."""
+        self._connected_handlers.append(handler)
+        return handler
+
+    async def _handle_connect(self, eio_sid, namespace, data):
+        # The "connect" handler is called before the client is sent the CONNECT packet,
+        # so the events it emits arrive before the connection is established
+        await super()._handle_connect(eio_sid, namespace, data)
+        namespace = namespace or "/"
+        sid = self.manager.sid_from_eio_sid(eio_sid, namespace)
+        if sid is None or not self.manager.is_connected(sid, namespace):
+            return
+
+        for handler in self._connected_handlers:
+            await handler(sid)
+
+    async def _handle_event(self, eio_sid, namespace, id, data):
+        # python-socketio starts an unbounded task for every event,
+        # so the handlers are run through the dispatcher instead
+        namespace = namespace or "/"
+        sid = self.manager.sid_from_eio_sid(eio_sid, namespace)
+        if not self.async_handlers or not self.manager.is_connected(sid, namespace):
+            return await super()._handle_event(eio_sid, namespace, id, data)
+
+        self.logger.info('received event "%s" from %s [%s]', data[0], sid, namespace)
+        self.dispatcher.submit(
+            sid,
+            data[0],
+            functools.partial(
+                self._handle_event_internal, self, sid, eio_sid, data, namespace, id
+            ),
+        )
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from typing import NamedTuple
+
+
+if TYPE_CHECKING:
+    from beanie import PydanticObjectId
+
+    from src.db.models import User
+
+
+class SocketSession(NamedTuple):
+    """Identity of the user behind a connection, everything else is loaded on demand."""
+
+    user_id: PydanticObjectId
+    email: str
+    username: str | None
+    email_verified: bool
+
+    @classmethod
+    def from_user(cls, user: User) -> SocketSession:
+        return cls(
+            user_id=user.id,
+            email=user.email,
+            username=user.username,
+            email_verified=user.email_verified_at is not None,
+        )
+
+
+class SessionStore:
+    """
+    Sessions of the connections handled by this process. Unlike `AsyncServer.session`,
+    reading a session is a plain dict lookup, and nothing is copied or saved back.
+    """
+
+    def __init__(self):
+        self._sessions: dict[str, SocketSession] = {}
+
+    def set(self, sid: str, session: SocketSession) -> None:
+        self._sessions[sid] = session
+
+    def get(self, sid: str) -> SocketSession:
+        return self._sessions[sid]
+
+    def pop(self, sid: str) -> SocketSession | None:
+        return self._sessions.pop(sid, None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
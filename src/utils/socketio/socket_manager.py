@@ -1,8 +1,13 @@
 from __future__ import annotations
 
 import asyncio
+import pickle
 
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
 from typing import Any
+from typing import Final
 
 import socketio
 import structlog
@@ -10,12 +15,81 @@ import structlog
 from pydantic import BaseModel
 
 from src.utils.socketio.exceptions import SocketIOManagerError
+from src.utils.socketio.presence import get_user_room
+from src.utils.socketio.serializer import RawJSON
+from src.utils.socketio.serializer import dumps
+from src.utils.socketio.serializer import to_payload
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from collections.abc import Sequence
+
+    from src.utils.socketio.inbox import EventInbox
+    from src.utils.socketio.presence import PresenceRegistry
+
+
+# Event that carries several events, as a list of `{"event": ..., "data": ...}`
+BATCH_EVENT_NAME: Final[str] = "batch"
+
+
+@dataclass(frozen=True, slots=True)
+class Emission:
+    email: str
+    event_name: str
+    payload: BaseModel | dict[str, Any]
+
+
+@dataclass(frozen=True, slots=True)
+class DeliveryReport:
+    email: str
+    event_name: str
+    # Whether the recipient had at least one connection when the event was published
+    delivered: bool
 
 
 class SocketIOManager:
-    def __init__(self, native_client_manager: socketio.AsyncRedisManager):
+    """
+    Events are put into an outgoing buffer, which is flushed after `batch_window` seconds,
+    or on the next iteration of the event loop if it's 0. A recipient with several events
+    in the buffer gets them in a single `batch` event, in the order they were emitted.
+    Urgent events flush the buffer right away. If `batch_window` is `None`,
+    every event is published immediately as an event of its own.
+
+    With batching, emits are best-effort: awaiting one only means that the event was
+    buffered, and the events of a background flush that fails are logged and dropped.
+    Urgent emits and `flush` raise if the events couldn't be published.
+
+    If all the connections of a recipient are handled by `local_server`, the events are
+    delivered to them directly, and only the events of the other recipients are
+    published to Redis for the other workers to deliver. Connections are only known from
+    the presence lookups that emits make anyway, no lookup is made just for this.
+
+    Events emitted to recipients who aren't connected are stored in `inbox`, if it's
+    set, to be replayed when they reconnect.
+    """
+
+    def __init__(
+        self,
+        native_client_manager: socketio.AsyncRedisManager,
+        presence_registry: PresenceRegistry,
+        *,
+        batch_window: float | None = None,
+        local_server: socketio.AsyncServer | None = None,
+        inbox: EventInbox | None = None,
+    ):
         self._native_client_manager = native_client_manager
+        self._presence_registry = presence_registry
+        self._batch_window = batch_window
+        self._local_server = local_server
+        self._inbox = inbox
         self._logger: structlog.stdlib.BoundLogger = structlog.get_logger(__name__)
+        # (email, event name, data, whether it's delivered locally)
+        # in the order the events were emitted
+        self._pending_events: list[tuple[str, str, Any, bool]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._flush_tasks: set[asyncio.Task[None]] = set()
+        self._flush_lock = asyncio.Lock()
 
     async def emit_to_user_by_email(
         self,
@@ -24,49 +98,240 @@ class SocketIOManager:
         payload: BaseModel | dict[str, Any],
         *,
         raise_if_recipient_not_connected: bool = True,
+        urgent: bool = False,
     ):
         self._logger.info(
             "Emitting event to user by email", email=email, event_name=event_name
         )
-        target_sid = await self._native_client_manager.redis.get(
-            f"socketio:email:sid:{email}"
+        # Presence is looked up only if it's needed anyway, otherwise the event is sent
+        # to the room of the user through Redis, which reaches them on any worker
+        is_local = False
+        if raise_if_recipient_not_connected or self._inbox is not None:
+            sids = (await self._presence_registry.get_sids_many([email]))[email]
+            if raise_if_recipient_not_connected and not sids:
+                raise SocketIOManagerError(
+                    message="User is not connected to socketio",
+                    event_name=event_name,
+                    target=email,
+                )
+
+            if not sids and self._inbox is not None:
+                await self._inbox.append_many(
+                    [(email, event_name, to_payload(payload))]
+                )
+                return
+
+            is_local = self._is_local(sids)
+
+        await self._emit(
+            [(email, event_name, to_payload(payload), is_local)], urgent=urgent
         )
-        if target_sid is None and raise_if_recipient_not_connected:
-            raise SocketIOManagerError(
-                message="User is not connected to socketio",
-                event_name=event_name,
-                target=email,
-            )
 
-        if isinstance(target_sid, bytes):
-            target_sid = target_sid.decode("utf-8")
+    async def emit_many(
+        self,
+        emissions: Sequence[Emission],
+        *,
+        urgent: bool = False,
+        store_if_offline: bool = True,
+    ) -> list[DeliveryReport]:
+        """
+        Emit events to several users with one round trip for the presence lookup.
+        Returns a report for every emission, in the same order.
+        """
+        if not emissions:
+            return []
 
-        if isinstance(payload, BaseModel):
-            payload = payload.model_dump(mode="json")
+        sids_by_email = await self._presence_registry.get_sids_many(
+            emission.email for emission in emissions
+        )
+        await self._emit(
+            [
+                (
+                    emission.email,
+                    emission.event_name,
+                    to_payload(emission.payload),
+                    self._is_local(sids_by_email[emission.email]),
+                )
+                for emission in emissions
+                if sids_by_email[emission.email]
+            ],
+            urgent=urgent,
+        )
+        if store_if_offline and self._inbox is not None:
+            await self._inbox.append_many(
+                (emission.email, emission.event_name, to_payload(emission.payload))
+                for emission in emissions
+                if not sids_by_email[emission.email]
+            )
 
-        await self._native_client_manager.emit(event_name, payload, room=target_sid)
+        reports = [
+            DeliveryReport(
+                email=emission.email,
+                event_name=emission.event_name,
+                delivered=bool(sids_by_email[emission.email]),
+            )
+            for emission in emissions
+        ]
         self._logger.info(
-            "Event was successfully emitted to the client",
-            email=email,
-            sid=target_sid,
-            event_name=event_name,
+            "Events were emitted to the clients",
+            delivered=sum(report.delivered for report in reports),
+            not_connected=sum(not report.delivered for report in reports),
         )
+        return reports
 
-    async def emit_to_user_in_bulk(
-        self,
-        email: str,
-        event_names: list[str],
-        payload: list[BaseModel | dict[str, Any]],
-        raise_on_not_connected: bool = True,
-    ):
-        return await asyncio.gather(
-            *[
-                self.emit_to_user_by_email(
-                    email,
-                    event_name,
-                    payload,
-                    raise_if_recipient_not_connected=raise_on_not_connected,
+    async def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        # One flush at a time, so that an urgent flush can't overtake an earlier one
+        async with self._flush_lock:
+            pending_events, self._pending_events = self._pending_events, []
+            if pending_events:
+                await self._send(pending_events)
+
+    def _is_local(self, sids: list[str]) -> bool:
+        return (
+            self._local_server is not None
+            and bool(sids)
+            and all(self._presence_registry.is_local(sid) for sid in sids)
+        )
+
+    async def _emit(
+        self, events: list[tuple[str, str, Any, bool]], *, urgent: bool
+    ) -> None:
+        if self._batch_window is None:
+            if events:
+                await self._send(events)
+            return
+
+        self._pending_events.extend(events)
+        if urgent:
+            # Whatever is pending is sent along, so the order is preserved
+            await self.flush()
+        elif self._pending_events and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self._batch_window, self._start_flush
+            )
+
+    def _start_flush(self) -> None:
+        self._flush_handle = None
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._on_flush_done)
+
+    def _on_flush_done(self, task: asyncio.Task[None]) -> None:
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and (error := task.exception()) is not None:
+            self._logger.error(
+                "Failed to publish the buffered events, they are dropped",
+                exc_info=error,
+            )
+
+    async def _send(self, events: list[tuple[str, str, Any, bool]]) -> None:
+        # All the events of a recipient go the same way, so that they arrive in the order
+        # they were emitted even if some of them were emitted while the recipient
+        # had a connection on another worker
+        remote_emails = {email for email, _, _, is_local in events if not is_local}
+        local_events = [event[:3] for event in events if event[0] not in remote_emails]
+        remote_events = [event[:3] for event in events if event[0] in remote_emails]
+        # Clients only get `batch` events if batching is turned on
+        build_messages = (
+            _build_messages if self._batch_window is None else _build_batch_messages
+        )
+        if remote_events:
+            await self._publish_many(build_messages(remote_events))
+        for event_name, data, rooms in build_messages(local_events):
+            await self._local_server.emit(
+                event_name, data, room=rooms, ignore_queue=True
+            )
+
+    async def _publish_many(
+        self, messages: Iterable[tuple[str, Any, list[str]]]
+    ) -> None:
+        # Same messages as `AsyncPubSubManager.emit` publishes for every server
+        # to handle, but sent in a single pipeline instead of one round trip each
+        native_client_manager = self._native_client_manager
+        async with native_client_manager.redis.pipeline(transaction=False) as pipe:
+            for event_name, data, rooms in messages:
+                pipe.publish(
+                    native_client_manager.channel,
+                    pickle.dumps(
+                        {
+                            "method": "emit",
+                            "event": event_name,
+                            "data": data,
+                            "namespace": "/",
+                            "room": rooms,
+                            "skip_sid": None,
+                            "callback": None,
+                            "host_id": native_client_manager.host_id,
+                        }
+                    ),
                 )
-                for (payload, event_name) in zip(payload, event_names, strict=True)
+            await pipe.execute()
+
+
+def _build_messages(
+    events: Iterable[tuple[str, str, Any]]
+) -> list[tuple[str, Any, list[str]]]:
+    """
+    Turn the events into messages, one per event in the order they were emitted.
+    An event that is the same as an earlier message is merged into it, unless
+    the recipient has a message after that one, which it would overtake then.
+    """
+    messages: list[tuple[str, Any, list[str]]] = []
+    message_index_by_key: dict[tuple[str, bytes], int] = {}
+    last_message_index_by_email: dict[str, int] = {}
+    for email, event_name, data in events:
+        message_key = (event_name, _get_data_key(data))
+        message_index = message_index_by_key.get(message_key)
+        if (
+            message_index is None
+            or last_message_index_by_email.get(email, -1) >= message_index
+        ):
+            message_index = len(messages)
+            messages.append((event_name, data, []))
+            message_index_by_key[message_key] = message_index
+
+        messages[message_index][2].append(get_user_room(email))
+        last_message_index_by_email[email] = message_index
+
+    return messages
+
+
+def _build_batch_messages(
+    events: Iterable[tuple[str, str, Any]]
+) -> list[tuple[str, Any, list[str]]]:
+    """
+    Turn the events into messages, one per recipient, and merge the messages that are
+    the same for several recipients into one addressed to all of their rooms.
+    """
+    events_by_email: dict[str, list[tuple[str, Any]]] = defaultdict(list)
+    for email, event_name, data in events:
+        events_by_email[email].append((event_name, data))
+
+    rooms_by_message: dict[tuple[str, bytes], list[str]] = defaultdict(list)
+    data_by_message: dict[tuple[str, bytes], Any] = {}
+    for email, recipient_events in events_by_email.items():
+        if len(recipient_events) == 1:
+            event_name, data = recipient_events[0]
+        else:
+            event_name = BATCH_EVENT_NAME
+            data = [
+                {"event": recipient_event_name, "data": recipient_data}
+                for recipient_event_name, recipient_data in recipient_events
             ]
-        )
+
+        message_key = (event_name, _get_data_key(data))
+        rooms_by_message[message_key].append(get_user_room(email))
+        data_by_message[message_key] = data
+
+    return [
+        (event_name, data_by_message[(event_name, data_key)], rooms)
+        for (event_name, data_key), rooms in rooms_by_message.items()
+    ]
+
+
+def _get_data_key(data: Any) -> bytes:
+    return data.data if isinstance(data, RawJSON) else dumps(data, sort_keys=True)
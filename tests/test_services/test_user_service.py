@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import datetime
+import io
+
+from typing import TYPE_CHECKING
+from typing import Any
+
+import aioboto3
+import aiohttp
+import pytest
+
+from botocore.exceptions import ClientError
+from faker import Faker
+from fastapi import UploadFile
+from PIL import Image
+from redis.asyncio import Redis
+
+from src.config import app_config
+from src.db.models import User
+from src.exceptions import BusinessLogicError
+from src.services.user_profile_cache import UserProfileCache
+from src.services.user_service import UserService
+from src.utils.images import AVATAR_SIZES
+from src.utils.images import ImageProcessor
+from src.utils.images import ImageVariant
+from src.utils.s3 import S3Object
+from src.utils.s3 import S3Storage
+from src.utils.s3 import get_public_url
+
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+
+pytestmark = pytest.mark.anyio
+
+# The uploads are made against an S3-compatible stand-in, like MinIO
+requires_s3 = pytest.mark.skipif(
+    app_config.s3_endpoint_url is None, reason="S3 endpoint is not configured"
+)
+
+
+def _encode_png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), "red").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+async def s3_storage():
+    s3_storage = S3Storage(
+        aioboto3.Session(
+            aws_access_key_id=app_config.s3_access_key,
+            aws_secret_access_key=app_config.s3_secret_key,
+            region_name=app_config.s3_region_name,
+        ),
+        bucket_name=app_config.s3_bucket_name,
+        endpoint_url=app_config.s3_endpoint_url,
+        max_pool_connections=10,
+        connect_timeout=5,
+        read_timeout=30,
+        max_attempts=1,
+    )
+    await s3_storage.start()
+    try:
+        await s3_storage.client.create_bucket(Bucket=app_config.s3_bucket_name)
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+            raise
+    yield s3_storage
+    await s3_storage.close()
+
+
+@pytest.fixture
+async def user_service(motor_client, s3_storage):
+    redis = Redis.from_url(str(app_config.redis_dsn))
+    image_processor = ImageProcessor(max_workers=1, max_pending=1, max_pixels=1_000_000)
+    image_processor.start()
+    yield UserService(
+        motor_client,
+        s3_storage,
+        redis,
+        UserProfileCache(redis, maxsize=100, ttl=60, enabled=False),
+        image_processor,
+    )
+    image_processor.shutdown()
+    await redis.close()
+
+
+async def _create_user(faker: Faker) -> User:
+    user = User(
+        email=faker.unique.email(),
+        username=faker.unique.user_name(),
+        emailVerified=None,
+    )
+    await user.create()
+    return user
+
+
+@requires_s3
+async def test_uploaded_avatar_is_applied_once_completed(
+    user_service, s3_storage, faker: Faker
+):
+    user = await _create_user(faker)
+    upload = await user_service.create_avatar_upload(user.id, "image/png")
+
+    form = aiohttp.FormData(upload.fields)
+    form.add_field("file", _encode_png(), content_type="image/png")
+    async with aiohttp.ClientSession() as session, session.post(
+        upload.url, data=form
+    ) as response:
+        assert response.ok
+
+    user = await user_service.complete_avatar_upload(user.id, upload.key)
+
+    assert user.image_variants
+    assert user.image in user.image_variants.values()
+    # The uploaded original is deleted once its variants are stored
+    assert await s3_storage.get_object_info(upload.key) is None
+
+
+@requires_s3
+async def test_upload_of_another_user_is_rejected(user_service, faker: Faker):
+    owner = await _create_user(faker)
+    other_user = await _create_user(faker)
+    upload = await user_service.create_avatar_upload(owner.id, "image/png")
+
+    with pytest.raises(BusinessLogicError) as exc_info:
+        await user_service.complete_avatar_upload(other_user.id, upload.key)
+
+    assert exc_info.value.code == "unknown_upload"
+
+
+@requires_s3
+async def test_objects_older_than_max_age_are_deleted(s3_storage, faker: Faker):
+    prefix = f"test/{faker.uuid4()}/"
+    await s3_storage.upload_objects(
+        [
+            S3Object(key=f"{prefix}{i}", content=b"x", content_type="text/plain")
+            for i in range(3)
+        ]
+    )
+
+    assert await s3_storage.delete_older_than(prefix, datetime.timedelta(hours=1)) == 0
+    assert await s3_storage.delete_older_than(prefix, datetime.timedelta(0)) == 3
+    assert await s3_storage.get_object_info(f"{prefix}0") is None
+
+
+class InMemoryRedis:
+    def __init__(self):
+        self.values: dict[str, bytes] = {}
+
+    def register_script(self, script: str) -> None:
+        return None
+
+    async def get(self, key: str) -> bytes | None:
+        return self.values.get(key)
+
+    async def set(self, key: str, value: bytes, **kwargs: Any) -> None:
+        self.values[key] = value
+
+
+class S3StorageStub:
+    def __init__(self):
+        self.stored_keys: set[str] = set()
+
+    async def exists(self, key: str) -> bool:
+        return key in self.stored_keys
+
+    async def upload_objects(
+        self, objects: Sequence[S3Object], **kwargs: Any
+    ) -> list[str]:
+        self.stored_keys.update(s3_object.key for s3_object in objects)
+        return [get_public_url(s3_object.key) for s3_object in objects]
+
+
+class ImageProcessorSpy:
+    def __init__(self):
+        self.call_count = 0
+
+    async def make_avatar_variants(self, content: bytes) -> list[ImageVariant]:
+        self.call_count += 1
+        return [
+            ImageVariant(size=size, content=content + str(size).encode())
+            for size in AVATAR_SIZES
+        ]
+
+
+async def test_stored_avatar_variants_are_reused():
+    s3_storage = S3StorageStub()
+    image_processor = ImageProcessorSpy()
+    user_service = UserService(None, s3_storage, InMemoryRedis(), None, image_processor)
+
+    fields = await user_service._store_avatar(b"image", "digest")
+    assert await user_service._store_avatar(b"image", "digest") == fields
+    assert image_processor.call_count == 1
+
+    # The variants are made again once they are not stored anymore
+    s3_storage.stored_keys.clear()
+    assert await user_service._store_avatar(b"image", "digest") == fields
+    assert image_processor.call_count == 2
+    assert len(s3_storage.stored_keys) == len(AVATAR_SIZES)
+
+
+async def test_too_large_avatar_is_rejected(monkeypatch):
+    monkeypatch.setattr(app_config, "avatar_max_upload_size", 10)
+
+    content, _ = await UserService._read_avatar(UploadFile(io.BytesIO(b"x" * 10)))
+    assert content == b"x" * 10
+
+    with pytest.raises(BusinessLogicError) as exc_info:
+        await UserService._read_avatar(UploadFile(io.BytesIO(b"x" * 11)))
+
+    assert exc_info.value.code == "image_too_large"
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from src.utils.bloom_filter import get_bit_offsets
+from src.utils.bloom_filter import get_optimal_parameters
+
+
+def test_get_optimal_parameters():
+    size, hash_count = get_optimal_parameters(1_000_000, 0.01)
+
+    assert 9_500_000 < size < 9_700_000
+    assert hash_count == 7
+
+
+def test_get_bit_offsets_are_deterministic_and_in_range():
+    offsets = get_bit_offsets("glef1x", size=1000, hash_count=7)
+
+    assert offsets == get_bit_offsets("glef1x", size=1000, hash_count=7)
+    assert len(offsets) == 7
+    assert all(0 <= offset < 1000 for offset in offsets)
+
+
+def test_false_positive_rate_is_close_to_the_expected_one():
+    capacity, error_rate = 10_000, 0.01
+    size, hash_count = get_optimal_parameters(capacity, error_rate)
+
+    bits: set[int] = set()
+    for i in range(capacity):
+        bits.update(get_bit_offsets(f"user_{i}", size=size, hash_count=hash_count))
+
+    false_positives = sum(
+        all(
+            offset in bits
+            for offset in get_bit_offsets(
+                f"another_user_{i}", size=size, hash_count=hash_count
+            )
+        )
+        for i in range(capacity)
+    )
+
+    assert false_positives / capacity < error_rate * 2
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import time
+
+from src.utils.cache import LRUCache
+
+
+def test_get_returns_cached_value_and_counts_hits():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert (cache.stats.hits, cache.stats.misses) == (1, 1)
+    assert cache.stats.hit_rate == 0.5
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+
+
+def test_expired_entries_are_not_returned(monkeypatch):
+    cache: LRUCache[str, int] = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=120)
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 90)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_pop_removes_entry():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+
+    assert cache.pop("a") == 1
+    assert cache.pop("a") is None
+    assert len(cache) == 0
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from src.utils.dataloader import DataLoader
+
+
+pytestmark = pytest.mark.anyio
+
+
+class BatchLoadSpy:
+    def __init__(self):
+        self.batches: list[list[int]] = []
+
+    async def __call__(self, keys: list[int]) -> dict[int, str]:
+        self.batches.append(keys)
+        return {key: str(key) for key in keys if key != 0}
+
+
+async def test_loads_in_the_same_iteration_are_batched():
+    batch_load = BatchLoadSpy()
+    loader = DataLoader(batch_load)
+
+    result = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1))
+
+    assert result == ["1", "2", "1"]
+    assert batch_load.batches == [[1, 2]]
+
+
+async def test_loaded_keys_are_cached():
+    batch_load = BatchLoadSpy()
+    loader = DataLoader(batch_load)
+
+    await loader.load(1)
+    assert await loader.load_many([1, 2]) == ["1", "2"]
+    assert batch_load.batches == [[1], [2]]
+
+
+async def test_missing_keys_resolve_to_none():
+    loader = DataLoader(BatchLoadSpy())
+
+    assert await loader.load(0) is None
+
+
+async def test_primed_keys_are_not_loaded():
+    batch_load = BatchLoadSpy()
+    loader = DataLoader(batch_load)
+    loader.prime(1, "primed")
+
+    assert await loader.load(1) == "primed"
+    assert batch_load.batches == []
+
+
+async def test_failures_are_not_cached():
+    calls = 0
+
+    async def flaky_batch_load(keys: list[int]) -> dict[int, str]:
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ConnectionError
+        return {key: str(key) for key in keys}
+
+    loader = DataLoader(flaky_batch_load)
+
+    with pytest.raises(ConnectionError):
+        await loader.load(1)
+    assert await loader.load(1) == "1"
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from src.utils.socketio.dispatcher import EventDispatcher
+from src.utils.socketio.dispatcher import OverflowPolicy
+
+
+pytestmark = pytest.mark.anyio
+
+
+class DisconnectSpy:
+    def __init__(self):
+        self.sids: list[str] = []
+
+    async def __call__(self, sid: str) -> None:
+        self.sids.append(sid)
+
+
+async def test_events_of_the_same_name_are_handled_in_order():
+    dispatcher = EventDispatcher(
+        concurrency_per_connection=4,
+        queue_depth=64,
+        concurrency=256,
+        overflow_policy=OverflowPolicy.drop,
+        disconnect=DisconnectSpy(),
+    )
+    handled = []
+
+    def make_handler(index: int):
+        async def handler():
+            # Later events finish sooner if they aren't waiting for earlier ones
+            await asyncio.sleep((5 - index) * 0.001)
+            handled.append(index)
+
+        return handler
+
+    for index in range(5):
+        assert dispatcher.submit("sid", "message", make_handler(index))
+    await asyncio.sleep(0.05)
+
+    assert handled == [0, 1, 2, 3, 4]
+
+
+async def test_concurrency_per_connection_is_limited():
+    dispatcher = EventDispatcher(
+        concurrency_per_connection=2,
+        queue_depth=64,
+        concurrency=256,
+        overflow_policy=OverflowPolicy.drop,
+        disconnect=DisconnectSpy(),
+    )
+    running = 0
+    max_running = 0
+
+    async def handler():
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.001)
+        running -= 1
+
+    for index in range(6):
+        dispatcher.submit("sid", f"event-{index}", handler)
+    await asyncio.sleep(0.05)
+
+    assert max_running == 2
+    assert running == 0
+
+
+async def test_overflowing_events_are_dropped_or_disconnect():
+    release = asyncio.Event()
+
+    async def handler():
+        await release.wait()
+
+    disconnect = DisconnectSpy()
+    dispatcher = EventDispatcher(
+        concurrency_per_connection=4,
+        queue_depth=2,
+        concurrency=256,
+        overflow_policy=OverflowPolicy.drop,
+        disconnect=disconnect,
+    )
+    assert dispatcher.submit("sid", "message", handler)
+    await asyncio.sleep(0)
+    # The first one is running, so two more fit into the queue
+    assert dispatcher.submit("sid", "message", handler)
+    assert dispatcher.submit("sid", "message", handler)
+    assert not dispatcher.submit("sid", "message", handler)
+    assert disconnect.sids == []
+
+    disconnect = DisconnectSpy()
+    dispatcher = EventDispatcher(
+        concurrency_per_connection=4,
+        queue_depth=0,
+        concurrency=256,
+        overflow_policy=OverflowPolicy.disconnect,
+        disconnect=disconnect,
+    )
+    assert not dispatcher.submit("sid", "message", handler)
+    await asyncio.sleep(0)
+    assert disconnect.sids == ["sid"]
+
+    release.set()
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import io
+
+import pytest
+
+from PIL import Image
+
+from src.utils.images import InvalidImageError
+from src.utils.images import make_avatar_variants
+
+
+def _encode_jpeg(size: tuple[int, int]) -> bytes:
+    exif = Image.Exif()
+    exif[0x0110] = "Secret camera model"
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "red").save(buffer, format="JPEG", exif=exif)
+    return buffer.getvalue()
+
+
+def test_variants_are_square_webp_images_without_metadata():
+    variants = make_avatar_variants(
+        _encode_jpeg((640, 480)), sizes=(48, 128), max_pixels=1_000_000
+    )
+
+    assert [variant.size for variant in variants] == [48, 128]
+    for variant in variants:
+        with Image.open(io.BytesIO(variant.content)) as image:
+            assert image.format == "WEBP"
+            assert image.size == (variant.size, variant.size)
+            assert "exif" not in image.info
+
+
+def test_invalid_image_is_rejected():
+    with pytest.raises(InvalidImageError):
+        make_avatar_variants(b"not an image", sizes=(48,), max_pixels=1_000_000)
+
+
+def test_too_large_image_is_rejected():
+    with pytest.raises(InvalidImageError):
+        make_avatar_variants(_encode_jpeg((640, 480)), sizes=(48,), max_pixels=1_000)
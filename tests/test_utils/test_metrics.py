@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import math
+
+from src.utils.metrics import LatencyHistogram
+
+
+def test_percentiles_are_estimated_by_bucket():
+    histogram = LatencyHistogram(buckets=(0.01, 0.1, 1.0))
+    for seconds in (0.005, 0.005, 0.05, 0.5, 5.0):
+        histogram.observe(seconds)
+
+    assert histogram.count == 5
+    assert histogram.percentile(40) == 0.01
+    assert histogram.percentile(60) == 0.1
+    assert histogram.percentile(100) == math.inf
+    assert histogram.snapshot()["buckets"] == {
+        "0.01": 2,
+        "0.1": 1,
+        "1.0": 1,
+        "+Inf": 1,
+    }
+
+
+def test_reset_forgets_observations():
+    histogram = LatencyHistogram()
+    histogram.observe(0.2)
+    histogram.reset()
+
+    assert histogram.count == 0
+    assert histogram.percentile(50) is None
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import datetime
+
+import pytest
+
+from bson import ObjectId
+from pydantic import AwareDatetime
+from pydantic import BaseModel
+
+from src.utils.pagination import decode_pagination_cursor
+from src.utils.pagination import encode_pagination_cursor
+
+
+class CursorPayload(BaseModel):
+    last_created_at: AwareDatetime
+    last_id: ObjectId | None = None
+    name: str | None = None
+    model_config = {"arbitrary_types_allowed": True}
+
+
+def test_cursor_round_trips_typed_values():
+    created_at = datetime.datetime(2023, 9, 1, 12, 30, 15, 123456, tzinfo=datetime.UTC)
+    last_id = ObjectId()
+
+    cursor = encode_pagination_cursor(
+        "conversation",
+        last_created_at=created_at,
+        last_id=last_id,
+        name="a|b,c:d",
+    )
+    decoded = decode_pagination_cursor(cursor, CursorPayload)
+
+    assert decoded.entity_name == "conversation"
+    assert decoded.payload == CursorPayload(
+        last_created_at=created_at, last_id=last_id, name="a|b,c:d"
+    )
+
+
+def test_missing_values_get_defaults():
+    created_at = datetime.datetime(2023, 9, 1, tzinfo=datetime.UTC)
+    cursor = encode_pagination_cursor(
+        "conversation", last_created_at=created_at, name=None
+    )
+
+    assert decode_pagination_cursor(cursor, CursorPayload).payload.name is None
+
+
+def test_tampered_cursor_is_rejected():
+    cursor = encode_pagination_cursor(
+        "conversation", last_created_at=datetime.datetime.now(datetime.UTC)
+    )
+    tampered = cursor[:4] + ("A" if cursor[4] != "A" else "B") + cursor[5:]
+
+    with pytest.raises(ValueError):
+        decode_pagination_cursor(tampered, CursorPayload)
+    with pytest.raises(ValueError):
+        decode_pagination_cursor("not a cursor", CursorPayload)
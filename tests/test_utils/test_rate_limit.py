@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import time
+
+from typing import Any
+
+import pytest
+
+from src.middlewares.rate_limit_middleware import RateLimitMiddleware
+from src.utils import auth
+from src.utils.rate_limit import LocalTokenBucket
+from src.utils.rate_limit import RateLimit
+
+
+def test_bucket_allows_a_burst_up_to_the_limit():
+    bucket = LocalTokenBucket(maxsize=10)
+    rate_limit = RateLimit(limit=3, period=60)
+
+    results = [bucket.hit("user", rate_limit) for _ in range(4)]
+
+    assert [result.allowed for result in results] == [True, True, True, False]
+    assert [result.remaining for result in results] == [2, 1, 0, 0]
+    assert results[-1].retry_after > 0
+    assert results[-1].headers["Retry-After"] == "20"
+    assert bucket.hit("another user", rate_limit).allowed
+
+
+def test_bucket_is_refilled_over_time(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    bucket = LocalTokenBucket(maxsize=10)
+    rate_limit = RateLimit(limit=2, period=10)
+
+    assert bucket.hit("user", rate_limit).allowed
+    assert bucket.hit("user", rate_limit).allowed
+    assert not bucket.hit("user", rate_limit).allowed
+
+    now += 5
+    assert bucket.hit("user", rate_limit).allowed
+    assert not bucket.hit("user", rate_limit).allowed
+
+
+@pytest.mark.anyio
+async def test_clients_are_keyed_by_the_verified_subject_or_the_address(monkeypatch):
+    async def verify_token(token: str) -> dict[str, Any]:
+        if token != "valid":
+            raise auth.TokenInvalidError("Invalid signature")
+        return {"sub": "google|1", "exp": time.time() + 60}
+
+    monkeypatch.setattr(auth, "_verify_token", verify_token)
+    middleware = RateLimitMiddleware(
+        None,
+        rate_limiter=None,
+        rate_limits={},
+        client_ip_header="X-Forwarded-For",
+    )
+
+    def make_scope(authorization: str | None, forwarded_for: str) -> dict[str, Any]:
+        headers = [(b"x-forwarded-for", forwarded_for.encode())]
+        if authorization is not None:
+            headers.append((b"authorization", authorization.encode()))
+        return {"type": "http", "headers": headers, "client": ("10.0.0.1", 4000)}
+
+    assert (
+        await middleware._get_client_key(make_scope("Bearer valid", "1.1.1.1"))
+        == "sub:google|1"
+    )
+    # Made-up tokens and addresses prepended by the client don't get buckets of their own
+    assert (
+        await middleware._get_client_key(
+            make_scope("Bearer made-up", "6.6.6.6, 2.2.2.2")
+        )
+        == "ip:2.2.2.2"
+    )
+    assert await middleware._get_client_key(make_scope(None, "2.2.2.2")) == "ip:2.2.2.2"
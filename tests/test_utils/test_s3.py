@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from typing import Any
+
+import aioboto3
+import pytest
+
+from botocore.exceptions import ClientError
+
+from src.utils.s3 import S3Object
+from src.utils.s3 import S3Storage
+
+
+pytestmark = pytest.mark.anyio
+
+
+class S3ClientSpy:
+    def __init__(self, stored_keys: set[str], *, missing_key_error_code: str = "404"):
+        self.stored_keys = stored_keys
+        self.missing_key_error_code = missing_key_error_code
+        self.head_calls: list[str] = []
+        self.put_calls: list[str] = []
+
+    async def head_object(self, **kwargs: Any) -> dict[str, Any]:
+        self.head_calls.append(kwargs["Key"])
+        if kwargs["Key"] not in self.stored_keys:
+            raise ClientError(
+                {"Error": {"Code": self.missing_key_error_code}}, "HeadObject"
+            )
+        return {"ContentLength": 1, "ContentType": "image/webp"}
+
+    async def put_object(self, **kwargs: Any) -> None:
+        self.put_calls.append(kwargs["Key"])
+        self.stored_keys.add(kwargs["Key"])
+
+
+def _create_storage(client: S3ClientSpy) -> S3Storage:
+    storage = S3Storage(
+        aioboto3.Session(),
+        bucket_name="bucket",
+        max_pool_connections=1,
+        connect_timeout=1,
+        read_timeout=1,
+        max_attempts=1,
+    )
+    storage._client = client
+    return storage
+
+
+def _create_object(key: str) -> S3Object:
+    return S3Object(key=key, content=b"content", content_type="image/webp")
+
+
+async def test_existing_objects_are_not_uploaded_again():
+    client = S3ClientSpy({"avatars/stored.webp"})
+    storage = _create_storage(client)
+
+    await storage.upload_objects(
+        [_create_object("avatars/stored.webp"), _create_object("avatars/new.webp")],
+        skip_existing=True,
+    )
+    await storage.upload_objects(
+        [_create_object("avatars/stored.webp"), _create_object("avatars/new.webp")],
+        skip_existing=True,
+    )
+
+    assert client.put_calls == ["avatars/new.webp"]
+    # The keys that are found or uploaded aren't checked again
+    assert sorted(client.head_calls) == ["avatars/new.webp", "avatars/stored.webp"]
+
+
+async def test_objects_are_uploaded_without_skip_existing():
+    client = S3ClientSpy({"avatars/stored.webp"})
+    storage = _create_storage(client)
+
+    await storage.upload_objects([_create_object("avatars/stored.webp")])
+
+    assert client.put_calls == ["avatars/stored.webp"]
+    assert client.head_calls == []
+
+
+async def test_forbidden_head_is_taken_as_a_missing_object():
+    # S3 answers with 403 for missing keys to the credentials without s3:ListBucket
+    client = S3ClientSpy(set(), missing_key_error_code="403")
+    storage = _create_storage(client)
+
+    assert not await storage.exists("avatars/missing.webp")
+    assert await storage.get_object_info("avatars/missing.webp") is None
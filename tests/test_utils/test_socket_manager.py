@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from typing import Any
+
+import pytest
+
+from src.utils.socketio.presence import get_user_room
+from src.utils.socketio.socket_manager import BATCH_EVENT_NAME
+from src.utils.socketio.socket_manager import Emission
+from src.utils.socketio.socket_manager import SocketIOManager
+
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+
+pytestmark = pytest.mark.anyio
+
+
+class PresenceRegistryStub:
+    """Every user has one connection, which is handled by this worker."""
+
+    async def get_sids_many(self, emails: Iterable[str]) -> dict[str, list[str]]:
+        return {email: [f"sid of {email}"] for email in emails}
+
+    def is_local(self, sid: str) -> bool:
+        return True
+
+
+class LocalServerSpy:
+    def __init__(self):
+        self.messages: list[tuple[str, Any, list[str]]] = []
+
+    async def emit(self, event_name: str, data: Any, *, room: list[str], **kwargs: Any):
+        self.messages.append((event_name, data, list(room)))
+
+
+def _create_manager(
+    batch_window: float | None,
+) -> tuple[SocketIOManager, LocalServerSpy]:
+    local_server = LocalServerSpy()
+    manager = SocketIOManager(
+        None,
+        PresenceRegistryStub(),
+        batch_window=batch_window,
+        local_server=local_server,
+    )
+    return manager, local_server
+
+
+async def test_events_are_sent_one_by_one_without_batching():
+    manager, local_server = _create_manager(batch_window=None)
+
+    await manager.emit_many(
+        [
+            Emission("alice", "message", {"id": 1}),
+            Emission("alice", "message", {"id": 2}),
+            Emission("bob", "message", {"id": 1}),
+        ]
+    )
+
+    assert local_server.messages == [
+        # The same event is sent once to all of its recipients
+        ("message", {"id": 1}, [get_user_room("alice"), get_user_room("bob")]),
+        ("message", {"id": 2}, [get_user_room("alice")]),
+    ]
+
+
+async def test_events_are_not_merged_if_it_would_reorder_them():
+    manager, local_server = _create_manager(batch_window=None)
+
+    await manager.emit_many(
+        [
+            Emission("alice", "message", {"id": 1}),
+            Emission("bob", "message", {"id": 2}),
+            Emission("bob", "message", {"id": 1}),
+        ]
+    )
+
+    assert local_server.messages == [
+        ("message", {"id": 1}, [get_user_room("alice")]),
+        ("message", {"id": 2}, [get_user_room("bob")]),
+        ("message", {"id": 1}, [get_user_room("bob")]),
+    ]
+
+
+async def test_events_of_a_recipient_are_batched_with_batching():
+    manager, local_server = _create_manager(batch_window=0)
+
+    await manager.emit_many(
+        [
+            Emission("alice", "message", {"id": 1}),
+            Emission("alice", "message", {"id": 2}),
+        ]
+    )
+    await manager.flush()
+
+    assert local_server.messages == [
+        (
+            BATCH_EVENT_NAME,
+            [
+                {"event": "message", "data": {"id": 1}},
+                {"event": "message", "data": {"id": 2}},
+            ],
+            [get_user_room("alice")],
+        )
+    ]
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import pickle
+
+from pydantic import BaseModel
+from socketio.packet import EVENT
+from socketio.packet import Packet
+
+from src.utils.socketio.serializer import OrjsonModule
+from src.utils.socketio.serializer import RawJSON
+from src.utils.socketio.serializer import to_payload
+
+
+class Payload(BaseModel):
+    text: str
+    count: int
+
+
+def test_models_are_embedded_as_encoded_json(monkeypatch):
+    monkeypatch.setattr(Packet, "json", OrjsonModule)
+    payload = to_payload(Payload(text="hi", count=1))
+
+    packet = Packet(EVENT, data=["message:new", payload, {"seen": True}])
+
+    assert isinstance(payload, RawJSON)
+    assert packet.encode() == '2["message:new",{"text":"hi","count":1},{"seen":true}]'
+
+
+def test_raw_json_survives_pickling():
+    payload = RawJSON(b'{"text":"hi"}')
+
+    assert pickle.loads(pickle.dumps(payload)) == payload
+
+
+def test_loads_decodes_packets():
+    assert OrjsonModule.loads('["event",{"a":1}]') == ["event", {"a": 1}]